@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# End-to-end latency benchmark of user flows: real handlers, in-memory queue and storage, fake telegram.
+# Simulated game server answers commands through ResponsesQueue.
+# Usage: python bench/bench_flows.py --users 50 --output bench_result.json --baseline bench/baseline.json
+import argparse
+import datetime
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from telegram import CallbackQuery, Chat, Message, MessageEntity, Update, User  # noqa: E402
+
+import main  # noqa: E402
+from lib.consts import QUEUE_NAME_CMD, QUEUE_NAME_INIT, QUEUE_NAME_DICT, QUEUE_NAME_RESPONSES, \
+    CMD_GET_CLASS_LIST, CMD_SET_CLASS_LIST, CMD_SET_CLASS_DESCRIPTION, CMD_FEEDBACK, CMD_FEEDBACK_RECEIVE, \
+    MAIN_MENU_CREATE, MAIN_MENU_STATUS, MAIN_MENU_DELETE, MAIN_MENU_FEEDBACK  # noqa: E402
+from lib.codec import Codec  # noqa: E402
+from lib.offline import memory_broker  # noqa: E402
+
+BENCH_CLASSES = ["Warrior", "Mage"]
+STARTUP_TIMEOUT = 30
+STEP_TIMEOUT = 10
+# blocking main loop listens dictionary queue until 5 seconds of inactivity, wait it out before measuring
+WARMUP_TIME = 6
+
+# every step is (kind, payload, number of messages bot should send in reply)
+FLOWS = {
+    "start": [("command", "/start", 1)],
+    "create": [("callback", MAIN_MENU_CREATE, 1),
+               ("callback", "class_" + BENCH_CLASSES[0], 2),
+               ("text", "Hero", 2)],
+    "status": [("callback", MAIN_MENU_STATUS, 2)],
+    "delete": [("callback", MAIN_MENU_DELETE, 1),
+               ("text", "CONFIRM", 2)],
+    "feedback": [("callback", MAIN_MENU_FEEDBACK, 1),
+                 ("text", "Nice game", 2)],
+}
+
+
+class SentLog:
+    # Collects messages sent by fake bot per chat
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.sent = {}
+
+    def __call__(self, sent_at: float, chat_id: int, text: str):
+        with self.cond:
+            self.sent.setdefault(chat_id, []).append(sent_at)
+            self.cond.notify_all()
+
+    def wait(self, chat_id: int, count: int, timeout: float) -> float:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while len(self.sent.get(chat_id, [])) < count:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError("Chat {0} received {1} messages of {2}".format(
+                        chat_id, len(self.sent.get(chat_id, [])), count))
+                self.cond.wait(left)
+            return self.sent[chat_id][count - 1]
+
+
+def game_server(stop: threading.Event):
+    # Answers bot commands like the game server does
+    while not stop.is_set():
+        for queue_name in (QUEUE_NAME_INIT, QUEUE_NAME_CMD):
+            item = memory_broker.get(queue_name, 0.01)
+            if item is None:
+                continue
+            cmd = Codec.decode(item[1], item[0])
+            if cmd.get("cmd_type") == CMD_GET_CLASS_LIST:
+                memory_broker.publish(QUEUE_NAME_DICT, json.dumps({
+                    "cmd_type": CMD_SET_CLASS_LIST,
+                    "class_list": {i: {"en": i, "ru": i} for i in BENCH_CLASSES}}))
+                for i in BENCH_CLASSES:
+                    for locale in ("en", "ru"):
+                        memory_broker.publish(QUEUE_NAME_DICT, json.dumps({
+                            "cmd_type": CMD_SET_CLASS_DESCRIPTION, "class_name": i, "locale": locale,
+                            "class_description": "{0} description".format(i), "class_stats": "STR 10"}))
+                continue
+            resp = {"user_id": cmd.get("user_id"), "cmd_type": cmd.get("cmd_type"), "message": "done",
+                    "char_info": "Hero, level 1"}
+            if cmd.get("cmd_type") == CMD_FEEDBACK:
+                resp["cmd_type"] = CMD_FEEDBACK_RECEIVE
+            memory_broker.publish(QUEUE_NAME_RESPONSES, json.dumps(resp))
+
+
+def make_update(update_id: int, chat_id: int, kind: str, payload: str) -> Update:
+    user = User(id=chat_id, first_name="Bench", is_bot=False, username="bench{0}".format(chat_id),
+                language_code="en")
+    chat = Chat(id=chat_id, type=Chat.PRIVATE, username=user.username)
+    message = Message(message_id=update_id, date=datetime.datetime.now(), chat=chat, from_user=user, text=payload,
+                      bot=main.updater.bot)
+    if kind == "command":
+        message.entities = [MessageEntity(type=MessageEntity.BOT_COMMAND, offset=0, length=len(payload))]
+    if kind == "callback":
+        query = CallbackQuery(id=str(update_id), from_user=user, chat_instance=str(chat_id), data=payload,
+                              message=message, bot=main.updater.bot)
+        return Update(update_id, callback_query=query)
+    return Update(update_id, message=message)
+
+
+def run_user(chat_id: int, flows: List[str], sent_log: SentLog, latencies: Dict, counter, errors: List):
+    expected = 0
+    for flow in flows:
+        for kind, payload, replies in FLOWS[flow]:
+            expected += replies
+            started = time.perf_counter()
+            main.updater.bot.push_update(make_update(next(counter), chat_id, kind, payload))
+            try:
+                finished = sent_log.wait(chat_id, expected, STEP_TIMEOUT)
+            except TimeoutError as exc:
+                errors.append(str(exc))
+                return
+            latencies[flow].append(finished - started)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct))] * 1000, 3)
+
+
+def run(users: int, rounds: int, latency: float) -> Dict:
+    cfg_dir = tempfile.mkdtemp()
+    cfg_path = os.path.join(cfg_dir, "bench.json")
+    with open(os.path.join(ROOT, "cfg", "offline.json.sample")) as fp:
+        bench_config = json.load(fp)
+    bench_config["LOG_LEVEL"] = "WARNING"
+    bench_config["FAKE_TELEGRAM_LATENCY"] = latency
+    with open(cfg_path, "w") as fp:
+        json.dump(bench_config, fp)
+    memory_broker.purge()
+    sys.argv = ["main.py", "--config", cfg_path]
+    threading.Thread(target=main.main, daemon=True).start()
+    stop = threading.Event()
+    threading.Thread(target=game_server, args=(stop,), daemon=True).start()
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not (getattr(main, "updater", None) and getattr(main, "class_list", None)):
+        if time.monotonic() > deadline:
+            raise TimeoutError("Bot not started in {0} seconds".format(STARTUP_TIMEOUT))
+        time.sleep(0.1)
+    time.sleep(WARMUP_TIME)
+    sent_log = SentLog()
+    main.updater.bot.listeners.append(sent_log)
+
+    flows = [flow for flow in FLOWS for _ in range(rounds)]
+    latencies = {flow: [] for flow in FLOWS}
+    errors = []
+    update_ids = itertools.count(1)
+    threads = [threading.Thread(target=run_user, args=(1000000 + i, flows, sent_log, latencies, update_ids, errors))
+               for i in range(users)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    main.is_shutdown = True
+
+    updates = sum(len(i) for i in latencies.values())
+    return {"users": users,
+            "rounds": rounds,
+            "telegram_latency": latency,
+            "updates": updates,
+            "errors": len(errors),
+            "seconds": round(elapsed, 3),
+            "updates_per_second": round(updates / elapsed, 2) if elapsed > 0 else 0,
+            "flows": {flow: {"count": len(values),
+                             "p50_ms": percentile(values, 0.5),
+                             "p95_ms": percentile(values, 0.95),
+                             "p99_ms": percentile(values, 0.99)}
+                      for flow, values in latencies.items()}}
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float, min_delta: float) -> List[str]:
+    regressions = []
+    if result["errors"]:
+        regressions.append("{0} flows failed".format(result["errors"]))
+    if result["updates_per_second"] < baseline["updates_per_second"] * (1 - tolerance):
+        regressions.append("throughput {0} updates/s, baseline {1}".format(result["updates_per_second"],
+                                                                           baseline["updates_per_second"]))
+    for flow, stats in baseline["flows"].items():
+        current = result["flows"].get(flow)
+        if current is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if current[key] > stats[key] * (1 + tolerance) and current[key] - stats[key] > min_delta:
+                regressions.append("{0} {1} {2}, baseline {3}".format(flow, key, current[key], stats[key]))
+    return regressions
+
+
+def bench():
+    parser = argparse.ArgumentParser(description='Idle RPG bot user flows benchmark.')
+    parser.add_argument("--users", help="Number of simultaneous users", type=int, default=20)
+    parser.add_argument("--rounds", help="How many times each user repeats each flow", type=int, default=5)
+    parser.add_argument("--latency", help="Fake telegram latency in seconds", type=float, default=0)
+    parser.add_argument("--output", help="Where to save result json", default=None)
+    parser.add_argument("--baseline", help="Baseline json to compare with", default=None)
+    parser.add_argument("--tolerance", help="Allowed slowdown against baseline", type=float, default=0.25)
+    parser.add_argument("--min-delta-ms", help="Ignore latency growth smaller than this", type=float, default=5)
+    parser.add_argument("--save-baseline", help="Save result as baseline", action="store_true")
+    args = parser.parse_args()
+
+    result = run(args.users, args.rounds, args.latency)
+    print(json.dumps(result, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(result, fp, indent=2)
+    if args.baseline is not None:
+        if args.save_baseline:
+            with open(args.baseline, "w") as fp:
+                json.dump(result, fp, indent=2)
+            return 0
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(result, baseline, args.tolerance, args.min_delta_ms)
+        for i in regressions:
+            print("REGRESSION: " + i, file=sys.stderr)
+        return 1 if regressions else 0
+    return 1 if result["errors"] else 0
+
+
+if __name__ == '__main__':
+    # main loop thread keeps running, so leave without waiting for it
+    code = bench()
+    sys.stdout.flush()
+    os._exit(code)
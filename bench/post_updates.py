@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Replays recorded telegram updates to the bot webhook, like telegram does.
+# Updates file is json list of updates or one update per line, update_id and date are refreshed on send.
+# Usage: python bench/post_updates.py --url http://127.0.0.1:8443/telegram --updates bench/updates.sample.json
+import argparse
+import concurrent.futures
+import itertools
+import json
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List
+
+
+def read_updates(path: str) -> List[Dict]:
+    with open(path) as fp:
+        text = fp.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def post_update(url: str, update: Dict) -> float:
+    request = urllib.request.Request(url, data=json.dumps(update).encode("UTF-8"),
+                                     headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def replay():
+    parser = argparse.ArgumentParser(description='Post recorded telegram updates to the bot webhook.')
+    parser.add_argument("--url", help="Webhook url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--updates", help="File with recorded updates", default="bench/updates.sample.json")
+    parser.add_argument("--repeat", help="How many times to send all updates", type=int, default=1)
+    parser.add_argument("--concurrency", help="Number of simultaneous requests", type=int, default=1)
+    args = parser.parse_args()
+
+    updates = read_updates(args.updates)
+    update_ids = itertools.count(int(time.time()))
+
+    def prepare(update: Dict) -> Dict:
+        update = dict(update, update_id=next(update_ids))
+        for key in ("message", "edited_message"):
+            if key in update:
+                update[key] = dict(update[key], date=int(time.time()))
+        return update
+
+    batch = [prepare(i) for _ in range(args.repeat) for i in updates]
+    errors = 0
+    latencies = []
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(post_update, args.url, i) for i in batch]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except (urllib.error.URLError, OSError) as exc:
+                errors += 1
+                print("Error {0} when post update".format(exc), file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(json.dumps({"updates": len(batch),
+                      "errors": errors,
+                      "seconds": round(elapsed, 3),
+                      "updates_per_second": round(len(batch) / elapsed, 2) if elapsed > 0 else 0,
+                      "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3) if latencies else 0,
+                      "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0}, indent=2))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(replay())
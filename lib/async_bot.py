@@ -0,0 +1,170 @@
+import asyncio
+import concurrent.futures
+import functools
+from typing import Callable, Dict
+
+from telegram.ext import Dispatcher
+
+from .codec import Codec
+from .config import Config
+from .consts import LOG_ASYNC, ASYNC_EXECUTOR_WORKERS, ASYNC_POLL_TIMEOUT, ASYNC_PREFETCH, ASYNC_SHUTDOWN_CHECK, \
+    ASYNC_RECONNECT_DELAY, ASYNC_RECONNECT_MAX_DELAY, QUEUE_NAME_FAILED, QUEUE_HEADER_ERROR, QUEUE_EXCHANGE_RESPONSES
+from .offline import MEMORY_BACKEND
+from .utility import get_logger
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+
+class AsyncBot:
+    # Runs telegram update fetching and all queue consumers concurrently on one event loop.
+    # python-telegram-bot 13 has no asyncio client, so blocking bot calls and handlers go to the loop executor
+    def __init__(self, config: Config, dispatcher: Dispatcher, codec: Codec, consumers: Dict[str, Callable],
+                 is_shutdown: Callable[[], bool], poll_updates: bool = True,
+                 bindings: Callable[[], Dict[str, str]] = None):
+        if aio_pika is None:
+            raise RuntimeError("aio-pika is required for asyncio mode")
+        if config.queue_host == MEMORY_BACKEND:
+            raise RuntimeError("asyncio mode can't work with memory queue")
+        self.config = config
+        self.dispatcher = dispatcher
+        self.codec = codec
+        self.consumers = consumers
+        self.is_shutdown = is_shutdown
+        # in webhook mode updates come to updater's web server
+        self.poll_updates = poll_updates
+        # bindings() returns queue: routing key in responses exchange, they are made on every connect
+        self.bindings = bindings
+        self.logger = get_logger(LOG_ASYNC, config.log_level)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS,
+                                                              thread_name_prefix="AsyncBot")
+        self.loop = None
+        self.channel = None
+        # chat id: task of its last update, next update of the chat waits for it, so dialog steps keep order
+        self.chat_tasks = {}
+        self.reconnect_requested = False
+
+    def run(self):
+        asyncio.run(self._run())
+
+    def reconnect(self, consumers: Dict[str, Callable] = None):
+        # called from other thread after queue settings change, consumers are replaced if given
+        if consumers is not None:
+            self.consumers = consumers
+        self.reconnect_requested = True
+
+    async def _connect(self):
+        if self.config.queue_password is None:
+            return await aio_pika.connect_robust(host=self.config.queue_host, port=self.config.queue_port)
+        return await aio_pika.connect_robust(host=self.config.queue_host, port=self.config.queue_port,
+                                             login=self.config.queue_user, password=self.config.queue_password)
+
+    async def _run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.set_default_executor(self.executor)
+        poller = asyncio.create_task(self._poll_updates()) if self.poll_updates else None
+        delay = ASYNC_RECONNECT_DELAY
+        while not self.is_shutdown():
+            self.reconnect_requested = False
+            try:
+                connection = await self._connect()
+            except (OSError, aio_pika.exceptions.AMQPError) as exc:
+                # robust connection reconnects itself only after the first connect succeeded
+                self.logger.critical("Error {0} when connect to queue, next try in {1} seconds".format(exc, delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, ASYNC_RECONNECT_MAX_DELAY)
+                continue
+            delay = ASYNC_RECONNECT_DELAY
+            async with connection:
+                self.channel = await connection.channel()
+                await self.channel.set_qos(prefetch_count=ASYNC_PREFETCH)
+                await self.channel.declare_queue(QUEUE_NAME_FAILED, durable=True)
+                if self.bindings is not None:
+                    exchange = await self.channel.declare_exchange(QUEUE_EXCHANGE_RESPONSES,
+                                                                   aio_pika.ExchangeType.DIRECT, durable=True)
+                    for queue_name, routing_key in self.bindings().items():
+                        queue = await self.channel.declare_queue(queue_name, durable=True)
+                        await queue.bind(exchange, routing_key)
+                for queue_name, callback in self.consumers.items():
+                    queue = await self.channel.declare_queue(queue_name, durable=True)
+                    await queue.consume(functools.partial(self._on_message, queue_name, callback))
+                    self.logger.info("Start listen queue {0}".format(queue_name))
+                while not self.is_shutdown() and not self.reconnect_requested:
+                    if poller is not None and poller.done():
+                        poller.result()
+                    await asyncio.sleep(ASYNC_SHUTDOWN_CHECK)
+            if self.reconnect_requested:
+                # unacknowledged messages are redelivered to new connection
+                self.logger.info("Reconnect to queue with new settings")
+        if poller is not None:
+            poller.cancel()
+        self.executor.shutdown(wait=True)
+        self.logger.info("Async bot stopped")
+
+    async def _on_message(self, queue_name: str, callback: Callable, message):
+        # formatted by log writer thread, if record passes rate limit
+        self.logger.info("Received message %s with delivery_tag %s from %s", message.body, message.delivery_tag,
+                         queue_name)
+        # ack after reply is sent to telegram, reject without requeue if callback failed, to not loop on broken message
+        try:
+            async with message.process(requeue=False):
+                msg = self.codec.decode(message.body, message)
+                done = self.loop.create_future()
+                await self.loop.run_in_executor(None, callback, msg, functools.partial(self._on_done, done))
+                exc = await done
+                if exc is not None:
+                    await self._move_to_failed(message, exc)
+        except Exception as exc:
+            self.logger.critical("Error {0} when process message {1} from {2}, rejected".format(exc, message.body,
+                                                                                                queue_name))
+            return
+        self.logger.info("Message with delivery_tag %s from %s acknowledged", message.delivery_tag, queue_name)
+
+    def _on_done(self, done: asyncio.Future, exc: Exception = None):
+        # called from send worker thread
+        self.loop.call_soon_threadsafe(lambda: done.done() or done.set_result(exc))
+
+    async def _move_to_failed(self, message, exc: Exception):
+        headers = dict(message.headers or {})
+        headers[QUEUE_HEADER_ERROR] = str(exc)
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(body=message.body, headers=headers, content_type=message.content_type,
+                             content_encoding=message.content_encoding,
+                             delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+            routing_key=QUEUE_NAME_FAILED)
+        self.logger.error("Message {0} was not delivered because of {1}, moved to {2}".format(message.body, exc,
+                                                                                              QUEUE_NAME_FAILED))
+
+    async def _poll_updates(self):
+        offset = None
+        while True:
+            try:
+                updates = await self.loop.run_in_executor(None, functools.partial(self.dispatcher.bot.get_updates,
+                                                                                  offset=offset,
+                                                                                  timeout=ASYNC_POLL_TIMEOUT))
+            except Exception as exc:
+                self.logger.error("Error {0} when get updates".format(exc))
+                await asyncio.sleep(ASYNC_SHUTDOWN_CHECK)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self._dispatch(update)
+
+    def _dispatch(self, update):
+        # updates of different chats are processed concurrently, of one chat one by one in order of arrival
+        chat = update.effective_chat
+        chat_id = chat.id if chat is not None else None
+        task = self.loop.create_task(self._process_update(update, self.chat_tasks.get(chat_id)))
+        if chat_id is not None:
+            self.chat_tasks[chat_id] = task
+            task.add_done_callback(lambda t: self.chat_tasks.get(chat_id) is t and self.chat_tasks.pop(chat_id))
+
+    async def _process_update(self, update, previous: asyncio.Task = None):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.loop.run_in_executor(None, self.dispatcher.process_update, update)
+        except Exception as exc:
+            self.logger.error("Error {0} when process update {1}".format(exc, update.update_id))
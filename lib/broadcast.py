@@ -0,0 +1,236 @@
+import collections
+import functools
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Union
+
+import psycopg2
+from telegram import error as tlg_error
+
+from .consts import LOG_BROADCAST, BROADCAST_WINDOW, BROADCAST_FLUSH_SIZE, BROADCAST_FLUSH_TIME
+from .keyboards import KEYBOARD_MAIN
+from .sender import PRIORITY_BULK, SendScheduler
+from .utility import get_logger
+
+RECIPIENT_PENDING = 0
+RECIPIENT_DELIVERED = 1
+RECIPIENT_FAILED = 2
+RECIPIENT_BLOCKED = 3
+
+
+class Broadcast:
+    __slots__ = ("id", "message_key", "args", "keyboard", "priority", "total", "delivered", "failed", "blocked",
+                 "recipients", "results", "in_flight", "started", "saved")
+
+    def __init__(self, broadcast_id: int, message_key: str, args: List[str], keyboard: str, priority: int,
+                 total: int, recipients: Iterable[int], delivered: int = 0, failed: int = 0, blocked: int = 0):
+        self.id = broadcast_id
+        self.message_key = message_key
+        self.args = args
+        self.keyboard = keyboard
+        self.priority = priority
+        self.total = total
+        self.delivered = delivered
+        self.failed = failed
+        self.blocked = blocked
+        self.recipients = collections.deque(recipients)
+        # (telegram_id, status) not saved yet
+        self.results = []
+        self.in_flight = 0
+        self.started = time.monotonic()
+        self.saved = self.started
+
+    def is_finished(self) -> bool:
+        return not self.recipients and self.in_flight == 0
+
+
+class Broadcaster:
+    # Sends one message to many users in background: renders it in recipient locale, passes to send scheduler
+    # not more than window messages at once, so users are not blocked by broadcast, and saves progress
+    # to continue after restart
+    def __init__(self, persist, sender: SendScheduler, render: Callable, log_level, window: int = BROADCAST_WINDOW):
+        self.persist = persist
+        self.sender = sender
+        # render(chat_id, message_key, args, keyboard) returns text and reply markup for the recipient
+        self.render = render
+        self.logger = get_logger(LOG_BROADCAST, log_level)
+        self.window = window
+        self.cond = threading.Condition()
+        self.requests = []
+        self.active = []
+        self.in_flight = 0
+        self.is_stopped = False
+        # unfinished broadcasts are read again, while DB is unavailable
+        self.is_resumed = False
+        self.thread = None
+        self.delivered = 0
+        self.failed = 0
+        self.blocked = 0
+        self.finished = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="Broadcaster", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = None):
+        # waits for messages already passed to sender and saves progress, the rest is sent after restart
+        with self.cond:
+            self.is_stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.logger.info("Broadcaster stopped")
+
+    def broadcast(self, message_key: str, recipients: Union[Iterable[int], Callable[[], Iterable[int]]],
+                  args: Iterable = (), keyboard: str = KEYBOARD_MAIN, priority: int = PRIORITY_BULK,
+                  on_created: Callable = None):
+        # doesn't wait: broadcast is saved and sent by broadcaster thread, on_created is called when it's saved.
+        # recipients can be loader, then they are read in broadcaster thread, not in caller's
+        if not callable(recipients):
+            recipients = list(dict.fromkeys(recipients))
+        request = (message_key, [str(i) for i in args], keyboard, priority, recipients, on_created)
+        with self.cond:
+            self.requests.append(request)
+            self.cond.notify_all()
+
+    def get_stats(self) -> Dict:
+        with self.cond:
+            return {"active": len(self.active),
+                    "finished": self.finished,
+                    "pending": sum(len(i.recipients) + i.in_flight for i in self.active),
+                    "delivered": self.delivered,
+                    "failed": self.failed,
+                    "blocked": self.blocked}
+
+    def _resume(self):
+        try:
+            unfinished = self.persist.get_unfinished_broadcasts()
+        except psycopg2.Error as exc:
+            self.logger.error("Error {0} when read unfinished broadcasts, retry later".format(exc))
+            return
+        for i in unfinished:
+            with self.cond:
+                # broadcast created while resume failed is already running
+                if any(j.id == i["id"] for j in self.active):
+                    continue
+                self.active.append(Broadcast(i["id"], i["message_key"], i["args"], i["keyboard"], i["priority"],
+                                             i["total"], i["recipients"], i["delivered"], i["failed"],
+                                             i["blocked"]))
+            self.logger.info("Resume broadcast {0} of {1}, {2} recipients left".format(i["id"], i["message_key"],
+                                                                                       len(i["recipients"])))
+        self.is_resumed = True
+
+    def _run(self):
+        while True:
+            if not self.is_resumed:
+                self._resume()
+            with self.cond:
+                if not (self.is_stopped or self.requests or self._can_submit()):
+                    self.cond.wait(BROADCAST_FLUSH_TIME)
+                requests = self.requests
+                self.requests = []
+                is_stopped = self.is_stopped
+            for message_key, args, keyboard, priority, recipients, on_created in requests:
+                self._create(message_key, args, keyboard, priority, recipients, on_created)
+            if is_stopped:
+                break
+            self._submit()
+            self._save()
+        with self.cond:
+            deadline = time.monotonic() + BROADCAST_FLUSH_TIME
+            while self.in_flight > 0 and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+        self._save(force=True)
+
+    def _can_submit(self) -> bool:
+        return self.in_flight < self.window and any(i.recipients for i in self.active)
+
+    def _create(self, message_key: str, args: List[str], keyboard: str, priority: int,
+                recipients: Union[List[int], Callable[[], Iterable[int]]], on_created: Callable):
+        try:
+            if callable(recipients):
+                recipients = list(dict.fromkeys(recipients()))
+            broadcast_id = self.persist.create_broadcast(message_key, args, keyboard, priority, recipients)
+        except psycopg2.Error as exc:
+            self.logger.error("Error {0} when create broadcast of {1}".format(exc, message_key))
+            if on_created is not None:
+                on_created(exc)
+            return
+        with self.cond:
+            self.active.append(Broadcast(broadcast_id, message_key, args, keyboard, priority, len(recipients),
+                                         recipients))
+        self.logger.info("Started broadcast {0} of {1} to {2} recipients".format(broadcast_id, message_key,
+                                                                                 len(recipients)))
+        if on_created is not None:
+            on_created(None)
+
+    def _submit(self):
+        for broadcast in list(self.active):
+            while broadcast.recipients:
+                with self.cond:
+                    if self.in_flight >= self.window:
+                        return
+                    self.in_flight += 1
+                    broadcast.in_flight += 1
+                chat_id = broadcast.recipients.popleft()
+                try:
+                    text, reply_markup = self.render(chat_id, broadcast.message_key, broadcast.args,
+                                                     broadcast.keyboard)
+                except (KeyError, IndexError, ValueError) as exc:
+                    self.logger.error("Error {0} when render broadcast {1} for {2}".format(exc, broadcast.id,
+                                                                                           chat_id))
+                    self._on_done(broadcast, chat_id, exc)
+                    continue
+                self.sender.send(chat_id, text, reply_markup, broadcast.priority,
+                                 functools.partial(self._on_done, broadcast, chat_id))
+
+    def _on_done(self, broadcast: Broadcast, chat_id: int, exc: Exception = None):
+        # called from send worker thread
+        if exc is None:
+            status = RECIPIENT_DELIVERED
+        elif isinstance(exc, tlg_error.Unauthorized):
+            # user blocked the bot or deleted account
+            status = RECIPIENT_BLOCKED
+        else:
+            status = RECIPIENT_FAILED
+        with self.cond:
+            if status == RECIPIENT_DELIVERED:
+                broadcast.delivered += 1
+                self.delivered += 1
+            elif status == RECIPIENT_BLOCKED:
+                broadcast.blocked += 1
+                self.blocked += 1
+            else:
+                broadcast.failed += 1
+                self.failed += 1
+            broadcast.results.append((chat_id, status))
+            broadcast.in_flight -= 1
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def _save(self, force: bool = False):
+        now = time.monotonic()
+        for broadcast in list(self.active):
+            with self.cond:
+                is_finished = broadcast.is_finished()
+                if not (force or is_finished or len(broadcast.results) >= BROADCAST_FLUSH_SIZE or
+                        (broadcast.results and now - broadcast.saved >= BROADCAST_FLUSH_TIME)):
+                    continue
+                results = broadcast.results
+                broadcast.results = []
+                delivered, failed, blocked = broadcast.delivered, broadcast.failed, broadcast.blocked
+            try:
+                self.persist.save_broadcast_progress(broadcast.id, results, delivered, failed, blocked, is_finished)
+            except psycopg2.Error as exc:
+                self.logger.error("Error {0} when save progress of broadcast {1}".format(exc, broadcast.id))
+                with self.cond:
+                    broadcast.results = results + broadcast.results
+                continue
+            broadcast.saved = now
+            if is_finished:
+                with self.cond:
+                    self.active.remove(broadcast)
+                    self.finished += 1
+                self.logger.info("Finished broadcast {0} of {1} in {2} seconds: delivered {3}, failed {4}, "
+                                 "blocked {5}".format(broadcast.id, broadcast.message_key,
+                                                      round(now - broadcast.started, 1), delivered, failed, blocked))
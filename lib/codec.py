@@ -0,0 +1,68 @@
+import gzip
+import json
+import zlib
+from typing import Dict, Tuple
+
+import pika
+
+from .mq import get_message_properties
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/msgpack"
+CONTENT_ENCODING_PLAIN = "UTF-8"
+CONTENT_ENCODING_ZLIB = "zlib"
+CONTENT_ENCODING_GZIP = "gzip"
+HEADER_ACCEPT = "accept"
+
+
+class Codec:
+    # Encodes queue messages in configured content type, compressing big ones, and decodes any supported message
+    def __init__(self, content_type: str = CONTENT_TYPE_JSON, compress_threshold: int = 0):
+        if content_type == CONTENT_TYPE_MSGPACK and msgpack is None:
+            raise RuntimeError("msgpack is required for content type {0}".format(content_type))
+        if content_type not in (CONTENT_TYPE_JSON, CONTENT_TYPE_MSGPACK):
+            raise ValueError("Unknown content type {0}".format(content_type))
+        self.content_type = content_type
+        self.compress_threshold = compress_threshold
+        # tell the server, which formats the bot is able to read
+        if msgpack is not None:
+            self.accept = CONTENT_TYPE_MSGPACK + ", " + CONTENT_TYPE_JSON
+        else:
+            self.accept = CONTENT_TYPE_JSON
+
+    def encode(self, obj: Dict, persistent: bool = True) -> Tuple[bytes, pika.BasicProperties]:
+        if self.content_type == CONTENT_TYPE_MSGPACK:
+            body = msgpack.packb(obj, use_bin_type=True)
+        else:
+            body = json.dumps(obj).encode("UTF-8")
+        content_encoding = CONTENT_ENCODING_PLAIN
+        if 0 < self.compress_threshold <= len(body):
+            body = zlib.compress(body)
+            content_encoding = CONTENT_ENCODING_ZLIB
+        properties = get_message_properties(persistent)
+        properties.content_type = self.content_type
+        properties.content_encoding = content_encoding
+        properties.headers = {HEADER_ACCEPT: self.accept}
+        return body, properties
+
+    @staticmethod
+    def decode(body: bytes, properties: pika.BasicProperties = None) -> Dict:
+        content_type = CONTENT_TYPE_JSON
+        content_encoding = None
+        if properties is not None:
+            content_type = properties.content_type or CONTENT_TYPE_JSON
+            content_encoding = properties.content_encoding
+        if content_encoding == CONTENT_ENCODING_ZLIB:
+            body = zlib.decompress(body)
+        elif content_encoding == CONTENT_ENCODING_GZIP:
+            body = gzip.decompress(body)
+        if content_type == CONTENT_TYPE_MSGPACK:
+            if msgpack is None:
+                raise ValueError("Can't decode {0} message, msgpack is not installed".format(content_type))
+            return msgpack.unpackb(body, raw=False)
+        return json.loads(body)
@@ -1,15 +1,30 @@
 import codecs
 import datetime
 import json
-from .consts import LOG_CONFIG
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, Optional, Set, Tuple
+from .consts import LOG_CONFIG, QUEUE_PUBLISHER_POOL_SIZE, QUEUE_DEFAULT_CONTENT_TYPE, TELEGRAM_GLOBAL_RATE, \
+    TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_SEND_WORKERS, TELEGRAM_SEND_QUEUE, WEBHOOK_PORT, WEBHOOK_PATH, \
+    DISPATCHER_WORKERS, L18N_RELOAD_TIME, PERSIST_FLUSH_TIME, PERSIST_FLUSH_SIZE, \
+    PERSIST_ITERSIZE, PERSIST_POOL_SIZE, LOCALE_CACHE_SIZE, LOCALE_CACHE_TTL, LOCALE_CACHE_NEGATIVE_TTL, SESSION_TTL, \
+    SESSION_BACKEND_MEMORY, SESSION_CACHE_TIME, LOG_RATE, LOG_BURST, METRICS_LISTEN
 from .security import is_password_encrypted, encrypt_password, decrypt_password
 from .utility import get_logger
 
 CONFIG_PARAM_LOG_LEVEL = "LOG_LEVEL"
+CONFIG_PARAM_LOG_RATE = "LOG_RATE"
+CONFIG_PARAM_LOG_BURST = "LOG_BURST"
 CONFIG_PARAM_QUEUE_PASSWORD = "QUEUE_PASSWORD"
 CONFIG_PARAM_QUEUE_USER = "QUEUE_USER"
 CONFIG_PARAM_QUEUE_HOST = "QUEUE_HOST"
 CONFIG_PARAM_QUEUE_PORT = "QUEUE_PORT"
+CONFIG_PARAM_QUEUE_POOL_SIZE = "QUEUE_POOL_SIZE"
+CONFIG_PARAM_QUEUE_CONTENT_TYPE = "QUEUE_CONTENT_TYPE"
+CONFIG_PARAM_QUEUE_COMPRESS_THRESHOLD = "QUEUE_COMPRESS_THRESHOLD"
 CONFIG_PARAM_NEW_PATH = "CONFIG_PATH"
 CONFIG_PARAM_CONFIG_RELOAD_TIME = "CONFIG_RELOAD_TIME"
 CONFIG_PARAM_BOT_SECRET = "BOT_SECRET"
@@ -20,15 +35,55 @@ CONFIG_PARAM_DB_NAME = "DB_NAME"
 CONFIG_PARAM_DB_HOST = "DB_HOST"
 CONFIG_PARAM_DB_USER = "DB_USER"
 CONFIG_PARAM_DB_PASSWORD = "DB_PASSWORD"
+CONFIG_PARAM_DB_FLUSH_TIME = "DB_FLUSH_TIME"
+CONFIG_PARAM_DB_FLUSH_SIZE = "DB_FLUSH_SIZE"
+CONFIG_PARAM_DB_ITERSIZE = "DB_ITERSIZE"
+CONFIG_PARAM_DB_POOL_SIZE = "DB_POOL_SIZE"
+CONFIG_PARAM_LOCALE_CACHE_SIZE = "LOCALE_CACHE_SIZE"
+CONFIG_PARAM_LOCALE_CACHE_TTL = "LOCALE_CACHE_TTL"
+CONFIG_PARAM_LOCALE_CACHE_NEGATIVE_TTL = "LOCALE_CACHE_NEGATIVE_TTL"
+CONFIG_PARAM_SESSION_TTL = "SESSION_TTL"
+CONFIG_PARAM_SESSION_BACKEND = "SESSION_BACKEND"
+CONFIG_PARAM_SESSION_CACHE_TIME = "SESSION_CACHE_TIME"
+CONFIG_PARAM_SHARD_INSTANCE = "SHARD_INSTANCE"
+CONFIG_PARAM_SHARD_INSTANCES = "SHARD_INSTANCES"
+CONFIG_PARAM_SHARD_RETIRED = "SHARD_RETIRED"
+CONFIG_PARAM_TELEGRAM_API = "TELEGRAM_API"
+CONFIG_PARAM_FAKE_TELEGRAM_LATENCY = "FAKE_TELEGRAM_LATENCY"
+CONFIG_PARAM_TELEGRAM_GLOBAL_RATE = "TELEGRAM_GLOBAL_RATE"
+CONFIG_PARAM_TELEGRAM_CHAT_RATE = "TELEGRAM_CHAT_RATE"
+CONFIG_PARAM_TELEGRAM_CHAT_BURST = "TELEGRAM_CHAT_BURST"
+CONFIG_PARAM_TELEGRAM_SEND_WORKERS = "TELEGRAM_SEND_WORKERS"
+CONFIG_PARAM_TELEGRAM_SEND_QUEUE = "TELEGRAM_SEND_QUEUE"
+CONFIG_PARAM_WEBHOOK_LISTEN = "WEBHOOK_LISTEN"
+CONFIG_PARAM_WEBHOOK_PORT = "WEBHOOK_PORT"
+CONFIG_PARAM_WEBHOOK_PATH = "WEBHOOK_PATH"
+CONFIG_PARAM_WEBHOOK_URL = "WEBHOOK_URL"
+CONFIG_PARAM_DISPATCHER_WORKERS = "DISPATCHER_WORKERS"
+CONFIG_PARAM_METRICS_LISTEN = "METRICS_LISTEN"
+CONFIG_PARAM_METRICS_PORT = "METRICS_PORT"
+CONFIG_PARAM_L18N_RELOAD_TIME = "L18N_RELOAD_TIME"
+
+# settings, which running bot uses as they are changed in file
+CONFIG_HOT_SETTINGS = frozenset(("log_level", "log_rate", "log_burst", "admin_list", "shard_instances",
+                                 "shard_retired", "reload_time"))
+# settings, which are used after reconnect of their client
+CONFIG_QUEUE_SETTINGS = frozenset(("queue_host", "queue_port", "queue_user", "queue_password"))
+CONFIG_DB_SETTINGS = frozenset(("db_host", "db_port", "db_name", "db_user", "db_password"))
+CONFIG_RELOADABLE_SETTINGS = CONFIG_HOT_SETTINGS | CONFIG_QUEUE_SETTINGS | CONFIG_DB_SETTINGS
+# state of config object, not settings
+CONFIG_STATE = frozenset(("logger", "file_path", "old_file_path", "db_password_read", "next_reload", "reloaded"))
 
 
 class Config:
     def __init__(self, file: str, reload: bool = False):
         f = file
-        fp = codecs.open(f, 'r', "utf-8")
-        config = json.load(fp)
+        with codecs.open(f, 'r', "utf-8") as fp:
+            config = json.load(fp)
         if not reload:
             self.logger = get_logger(LOG_CONFIG, is_system=True)
+        else:
+            self.logger = logging.getLogger(LOG_CONFIG)
         self.logger.info("Read settings from {0}".format(file))
         self.file_path = file
         self.old_file_path = file
@@ -37,41 +92,65 @@ class Config:
         self.queue_host = config.get(CONFIG_PARAM_QUEUE_HOST)
         self.queue_user = config.get(CONFIG_PARAM_QUEUE_USER)
         self.queue_password = config.get(CONFIG_PARAM_QUEUE_PASSWORD)
-        self.secret = config.get(CONFIG_PARAM_BOT_SECRET)
-        if not is_password_encrypted(self.secret):
-            self.logger.info("Secret in plain text, start encryption")
-            new_password = encrypt_password(self.secret, self.server_name, self.queue_port)
-            self._save_secret(new_password)
-            self.logger.info("Secret was encrypted and saved")
-        else:
-            self.logger.info("Secret in cypher text, start decryption")
-            self.secret = decrypt_password(self.secret, self.server_name, self.queue_port)
-            self.logger.info("Secret was decrypted")
-        if not is_password_encrypted(self.queue_password):
-            self.logger.info("Password in plain text, start encryption")
-            new_password = encrypt_password(self.queue_password, self.server_name, self.queue_port)
-            self._save_password(new_password)
-            self.logger.info("Password was encrypted and saved")
-        else:
-            self.logger.info("Password in cypher text, start decryption")
-            self.queue_password = decrypt_password(self.queue_password, self.server_name, self.queue_port)
-            self.logger.info("Password was decrypted")
+        self.queue_pool_size = config.get(CONFIG_PARAM_QUEUE_POOL_SIZE, QUEUE_PUBLISHER_POOL_SIZE)
+        self.queue_content_type = config.get(CONFIG_PARAM_QUEUE_CONTENT_TYPE, QUEUE_DEFAULT_CONTENT_TYPE)
+        self.queue_compress_threshold = config.get(CONFIG_PARAM_QUEUE_COMPRESS_THRESHOLD, 0)
+        # fields, which were in plain text, are encrypted and written back to file at once
+        encrypted = {}
+        self.secret = self._get_secret(config, CONFIG_PARAM_BOT_SECRET, self.queue_port, encrypted)
+        self.queue_password = self._get_secret(config, CONFIG_PARAM_QUEUE_PASSWORD, self.queue_port, encrypted)
         self.db_name = config.get(CONFIG_PARAM_DB_NAME)
         self.db_port = config.get(CONFIG_PARAM_DB_PORT)
         self.db_host = config.get(CONFIG_PARAM_DB_HOST)
         self.db_user = config.get(CONFIG_PARAM_DB_USER)
         self.db_password_read = config.get(CONFIG_PARAM_DB_PASSWORD)
-        if is_password_encrypted(self.db_password_read):
-            self.logger.info("DB password encrypted, do nothing")
-            self.db_password = decrypt_password(self.db_password_read, self.server_name, self.db_port)
-        else:
-            self.logger.info("DB password in plain text, start encrypt")
-            password = encrypt_password(self.db_password_read, self.server_name, self.db_port)
-            self._save_db_password(password)
-            self.logger.info("DB password encrypted and save back in config")
-            self.db_password = self.db_password_read
+        self.db_password = self._get_secret(config, CONFIG_PARAM_DB_PASSWORD, self.db_port, encrypted)
+        if encrypted:
+            self._save_encrypted(config, encrypted)
+            self.logger.info("{0} encrypted and saved back in config".format(", ".join(encrypted)))
+        # user settings are saved in background, batch is written every flush time or when it reaches flush size
+        self.db_flush_time = config.get(CONFIG_PARAM_DB_FLUSH_TIME, PERSIST_FLUSH_TIME)
+        self.db_flush_size = config.get(CONFIG_PARAM_DB_FLUSH_SIZE, PERSIST_FLUSH_SIZE)
+        self.db_itersize = config.get(CONFIG_PARAM_DB_ITERSIZE, PERSIST_ITERSIZE)
+        self.db_pool_size = config.get(CONFIG_PARAM_DB_POOL_SIZE, PERSIST_POOL_SIZE)
+        # languages of recently active users are kept in memory, others are read from DB when needed
+        self.locale_cache_size = config.get(CONFIG_PARAM_LOCALE_CACHE_SIZE, LOCALE_CACHE_SIZE)
+        self.locale_cache_ttl = config.get(CONFIG_PARAM_LOCALE_CACHE_TTL, LOCALE_CACHE_TTL)
+        self.locale_cache_negative_ttl = config.get(CONFIG_PARAM_LOCALE_CACHE_NEGATIVE_TTL, LOCALE_CACHE_NEGATIVE_TTL)
+        # unfinished dialogs (character creation, feedback) are forgotten after this number of idle seconds
+        self.session_ttl = config.get(CONFIG_PARAM_SESSION_TTL, SESSION_TTL)
+        # "db" keeps dialogs in DB, so several bot processes can serve one user, "memory" in this process only
+        self.session_backend = config.get(CONFIG_PARAM_SESSION_BACKEND, SESSION_BACKEND_MEMORY)
+        # how long dialog, read from DB, is used without reading it again
+        self.session_cache_time = config.get(CONFIG_PARAM_SESSION_CACHE_TIME, SESSION_CACHE_TIME)
+        # name of this bot process among SHARD_INSTANCES, server responses for its chats come to its own queue.
+        # Responses left in queues of SHARD_RETIRED instances are drained by new owners. No name - no sharding
+        self.shard_instance = config.get(CONFIG_PARAM_SHARD_INSTANCE)
+        self.shard_instances = config.get(CONFIG_PARAM_SHARD_INSTANCES, [])
+        self.shard_retired = config.get(CONFIG_PARAM_SHARD_RETIRED, [])
         self.log_level = config.get(CONFIG_PARAM_LOG_LEVEL)
-        self.admin_list = config.get(CONFIG_PARAM_ADMIN_LIST)
+        # info and debug records per second from one place in code, 0 to log everything
+        self.log_rate = config.get(CONFIG_PARAM_LOG_RATE, LOG_RATE)
+        self.log_burst = config.get(CONFIG_PARAM_LOG_BURST, LOG_BURST)
+        self.admin_list = frozenset(config.get(CONFIG_PARAM_ADMIN_LIST) or ())
+        self.telegram_api = config.get(CONFIG_PARAM_TELEGRAM_API)
+        self.fake_telegram_latency = config.get(CONFIG_PARAM_FAKE_TELEGRAM_LATENCY, 0)
+        self.telegram_global_rate = config.get(CONFIG_PARAM_TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.telegram_chat_rate = config.get(CONFIG_PARAM_TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_RATE)
+        self.telegram_chat_burst = config.get(CONFIG_PARAM_TELEGRAM_CHAT_BURST, TELEGRAM_CHAT_BURST)
+        self.telegram_send_workers = config.get(CONFIG_PARAM_TELEGRAM_SEND_WORKERS, TELEGRAM_SEND_WORKERS)
+        self.telegram_send_queue = config.get(CONFIG_PARAM_TELEGRAM_SEND_QUEUE, TELEGRAM_SEND_QUEUE)
+        # updates are received with webhook, if listen address set, otherwise with long polling
+        self.webhook_listen = config.get(CONFIG_PARAM_WEBHOOK_LISTEN)
+        self.webhook_port = config.get(CONFIG_PARAM_WEBHOOK_PORT, WEBHOOK_PORT)
+        self.webhook_path = config.get(CONFIG_PARAM_WEBHOOK_PATH, WEBHOOK_PATH)
+        self.webhook_url = config.get(CONFIG_PARAM_WEBHOOK_URL)
+        self.dispatcher_workers = config.get(CONFIG_PARAM_DISPATCHER_WORKERS, DISPATCHER_WORKERS)
+        # metrics for Prometheus are served on http://listen:port/metrics, if port set
+        self.metrics_listen = config.get(CONFIG_PARAM_METRICS_LISTEN, METRICS_LISTEN)
+        self.metrics_port = config.get(CONFIG_PARAM_METRICS_PORT)
+        # how often check localization files for changes, 0 to not reload them
+        self.l18n_reload_time = config.get(CONFIG_PARAM_L18N_RELOAD_TIME, L18N_RELOAD_TIME)
         self.logger.setLevel(self.log_level)
 
         if config.get(CONFIG_PARAM_NEW_PATH) is not None:
@@ -80,29 +159,104 @@ class Config:
         self.next_reload = datetime.datetime.now()
         self.reloaded = False
 
-    def _save_secret(self, password: str):
-        fp = codecs.open(self.file_path, 'r', "utf-8")
-        config = json.load(fp)
-        fp.close()
-        fp = codecs.open(self.file_path, 'w', "utf-8")
-        config[CONFIG_PARAM_BOT_SECRET] = password
-        json.dump(config, fp, indent=2)
-        fp.close()
+    def apply(self, new_config: "Config") -> Set[str]:
+        # takes reloadable settings, which differ in new_config, returns their names.
+        # They are replaced by one dict update, so other threads see either all old or all new values
+        changed = {k for k in CONFIG_RELOADABLE_SETTINGS if getattr(new_config, k) != getattr(self, k)}
+        restart = sorted(k for k, v in vars(new_config).items()
+                         if k not in CONFIG_RELOADABLE_SETTINGS and k not in CONFIG_STATE and v != getattr(self, k))
+        if restart:
+            self.logger.warning("Settings {0} were changed, restart to apply them".format(", ".join(restart)))
+        self.__dict__.update({k: getattr(new_config, k) for k in changed})
+        self.reloaded = True
+        return changed
+
+    def _get_secret(self, config: Dict, param: str, port: int, encrypted: Dict) -> str:
+        # returns plain value, encrypted value of plain text field is put in encrypted
+        value = config.get(param)
+        if is_password_encrypted(value):
+            self.logger.info("{0} in cypher text, start decryption".format(param))
+            return decrypt_password(value, self.server_name, port)
+        self.logger.info("{0} in plain text, start encryption".format(param))
+        encrypted[param] = encrypt_password(value, self.server_name, port)
+        return value
+
+    def _save_encrypted(self, config: Dict, encrypted: Dict):
+        # file is replaced at once, so crash while writing doesn't leave it broken
+        config = dict(config, **encrypted)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.file_path)), suffix=".tmp")
+        is_replaced = False
+        try:
+            with os.fdopen(fd, 'w', encoding="utf-8") as fp:
+                json.dump(config, fp, indent=2)
+            shutil.copymode(self.file_path, tmp_path)
+            os.replace(tmp_path, self.file_path)
+            is_replaced = True
+        finally:
+            # temp file is not left after any error, including interrupt
+            if not is_replaced:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+
+class ConfigWatcher:
+    # Checks config file mtime and size every reload time, file is parsed only when they change.
+    # on_change(names) is called after changed settings are applied, to reconnect clients, which use them
+    def __init__(self, config: Config, on_change: Callable[[Set[str]], None] = None):
+        self.config = config
+        # file, which was loaded, CONFIG_PATH in it can point to file of other system
+        self.path = config.old_file_path
+        self.logger = config.logger
+        self.on_change = on_change
+        self.stamp = self._stamp()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="ConfigWatcher", daemon=True)
+        self.thread.start()
+        self.logger.info("Config watcher started, check every {0} seconds".format(self.config.reload_time))
+        if self.stamp is None:
+            self.logger.warning("Config {0} is not found, it is reloaded when appears".format(self.path))
+
+    def stop(self):
+        self.stopped.set()
+
+    def _stamp(self) -> Optional[Tuple]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
 
-    def _save_password(self, password: str):
-        fp = codecs.open(self.file_path, 'r', "utf-8")
-        config = json.load(fp)
-        fp.close()
-        fp = codecs.open(self.file_path, 'w', "utf-8")
-        config[CONFIG_PARAM_QUEUE_PASSWORD] = password
-        json.dump(config, fp, indent=2)
-        fp.close()
+    def _run(self):
+        while not self.stopped.wait(self.config.reload_time or 0):
+            if not self.config.reload_time:
+                # reload was turned off in reloaded config, as at startup
+                self.logger.info("Config reload is disabled, watcher stopped")
+                break
+            self.check()
 
-    def _save_db_password(self, password: str):
-        fp = codecs.open(self.file_path, 'r', "utf-8")
-        config = json.load(fp)
-        fp.close()
-        fp = codecs.open(self.file_path, 'w', "utf-8")
-        config[CONFIG_PARAM_DB_PASSWORD] = password
-        json.dump(config, fp, indent=2)
-        fp.close()
+    def check(self) -> Set[str]:
+        self.config.next_reload = datetime.datetime.now() + datetime.timedelta(seconds=self.config.reload_time or 0)
+        stamp = self._stamp()
+        if stamp is None or stamp == self.stamp:
+            return set()
+        self.stamp = stamp
+        try:
+            new_config = Config(self.path, reload=True)
+        except Exception as exc:
+            # half written or broken file, wait for next change
+            self.logger.error("Error {0} when reload config {1}, previous settings kept".format(
+                exc, self.path))
+            return set()
+        # encrypting plain text passwords changes the file
+        self.stamp = self._stamp()
+        changed = self.config.apply(new_config)
+        if changed:
+            self.logger.info("Config reloaded, changed {0}".format(", ".join(sorted(changed))))
+            if self.on_change is not None:
+                self.on_change(changed)
+        return changed
@@ -16,6 +16,7 @@ CMD_GET_FEEDBACK = "get_feedback"
 CMD_SENT_FEEDBACK = "sent_feedback"
 CMD_CONFIRM_FEEDBACK = "confirm_feedback"
 CMD_REPLY_FEEDBACK = "reply_feedback"
+CMD_BROADCAST = "broadcast"
 
 CHARACTER_NAME_MAX_LENGTH = 255
 
@@ -25,9 +26,50 @@ QUEUE_NAME_INIT = "InitQueue"
 QUEUE_NAME_DICT = "DictionaryQueue"
 QUEUE_NAME_CMD = "CommandQueue"
 QUEUE_NAME_RESPONSES = "ResponsesQueue"
+# server messages, which bot failed to deliver to user
+QUEUE_NAME_FAILED = "FailedResponsesQueue"
+QUEUE_EXCHANGE_RESPONSES = "BotResponses"
+QUEUE_NAME_INSTANCE_PREFIX = "ResponsesQueue."
+QUEUE_HEADER_ERROR = "error"
 
 QUEUE_APP_ID = "Telegram bot"  # second after main app
 
+QUEUE_PUBLISHER_POOL_SIZE = 4
+QUEUE_PUBLISHER_WAIT = 5
+QUEUE_PUBLISH_RETRIES = 1
+QUEUE_IDLE_CHECK = 30
+QUEUE_CONFIRM_WINDOW = 1000
+QUEUE_DEFAULT_CONTENT_TYPE = "application/json"
+QUEUE_PREFETCH = 64
+
+ASYNC_EXECUTOR_WORKERS = 8
+ASYNC_POLL_TIMEOUT = 10
+ASYNC_PREFETCH = 16
+ASYNC_SHUTDOWN_CHECK = 1
+ASYNC_RECONNECT_DELAY = 0.5
+ASYNC_RECONNECT_MAX_DELAY = 30
+
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_SEND_WORKERS = 4
+TELEGRAM_SEND_QUEUE = 1000
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+DISPATCHER_WORKERS = 0
+METRICS_LISTEN = "127.0.0.1"
+# histogram buckets in seconds
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SEND_RETRIES = 2
+SEND_RETRY_DELAY = 1
+SEND_RATE_WINDOW = 60
+SEND_BUCKET_CLEANUP = 1000
+SEND_STOP_TIMEOUT = 10
+BROADCAST_WINDOW = 100
+BROADCAST_FLUSH_SIZE = 500
+BROADCAST_FLUSH_TIME = 5
+L18N_RELOAD_TIME = 5
+
 MAIN_MENU_CREATE = "main_create"
 MAIN_MENU_STATUS = "main_status"
 MAIN_MENU_SETTINGS = "main_setting"
@@ -54,18 +96,49 @@ MENU_ABOUT_TEXT = "This bot allow to play in ZPG (https://en.wikipedia.org/wiki/
                   "https://github.com/qvant/idle_rpg_bot and sources of main game on https://github.com/qvant/idleRPG."\
                   " Please, feel free to report bugs and give any other feedback via issues section of relevant github"
 
-STAGE_SELECT_CLASS = "select_class"
-STAGE_CHOOSE_NAME = "choose name"
-STAGE_CONFIRM_DELETION = "CONFIRM_DELETION"
-
 LOG_CONFIG = "Config"
 LOG_MAIN = "Main"
 LOG_QUEUE = "Queue"
 LOG_TELEGRAM = "Telegram"
+LOG_PUBLISHER = "Publisher"
+LOG_BATCH_PUBLISHER = "BatchPublisher"
+LOG_ASYNC = "Async"
+LOG_PERSIST = "LOG_PERSIST"
+LOG_SENDER = "Sender"
+LOG_BROADCAST = "Broadcast"
+LOG_L18N = "L18n"
+LOG_SESSIONS = "Sessions"
+LOG_SHARDING = "Sharding"
+LOG_METRICS = "Metrics"
+# records waiting for log writer thread, new ones are dropped when it is full
+LOG_QUEUE_SIZE = 10000
+# records per second from one place in code, warnings and errors are never limited
+LOG_RATE = 100
+LOG_BURST = 200
 
 MAX_MENU_LENGTH = 25
 MAX_FEEDBACK_LENGTH = 2048
 
 PERSIST_LOAD_BATCH = 100
+PERSIST_FLUSH_TIME = 1
+PERSIST_FLUSH_SIZE = 500
+PERSIST_ITERSIZE = 10000
+PERSIST_POOL_SIZE = 4
+PERSIST_POOL_WAIT = 5
+PERSIST_IDLE_CHECK = 30
+PERSIST_RETRIES = 1
+PERSIST_RECONNECT_DELAY = 0.5
+PERSIST_RECONNECT_MAX_DELAY = 30
+LOCALE_CACHE_SIZE = 100000
+LOCALE_CACHE_TTL = 3600
+LOCALE_CACHE_NEGATIVE_TTL = 300
+SESSION_TTL = 3600
+SESSION_WHEEL_TICK = 10
+SESSION_BACKEND_MEMORY = "memory"
+SESSION_BACKEND_DB = "db"
+SESSION_CACHE_TIME = 5
+SHARD_VNODES = 64
+
+FAKE_BOT_TOKEN = "123456:fake"
 
 LOCALE_PREFIX = "LOCALE_"
@@ -0,0 +1,61 @@
+import threading
+from typing import Callable, Dict, Iterable, Optional
+
+from telegram import InlineKeyboardMarkup
+
+from .l18n import L18n
+
+KEYBOARD_MAIN = "main"
+KEYBOARD_ADMIN = "admin"
+KEYBOARD_READ = "read"
+KEYBOARD_SHUTDOWN = "shutdown"
+KEYBOARD_LOCALE = "locale"
+KEYBOARD_CLASS = "class"
+
+# keyboards, which differ for admins
+ROLE_KEYBOARDS = (KEYBOARD_MAIN,)
+
+
+class KeyboardCache:
+    # Built keyboards by locale, role and kind. Markup is not changed after build, so one object serves all messages
+    def __init__(self, builders: Dict[str, Callable]):
+        # builder(trans, is_admin) returns rows of buttons or None, if keyboard can't be built yet
+        self.builders = builders
+        self.lock = threading.Lock()
+        self.keyboards = {}
+        # keyboard built from data, which was invalidated while building, is not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind: str, trans: L18n, is_admin: bool = False) -> Optional[InlineKeyboardMarkup]:
+        key = (trans.code, is_admin and kind in ROLE_KEYBOARDS, kind)
+        markup = self.keyboards.get(key)
+        if markup is not None:
+            self.hits += 1
+            return markup
+        self.misses += 1
+        generation = self.generation
+        rows = self.builders[kind](trans, key[1])
+        if rows is None:
+            return None
+        markup = InlineKeyboardMarkup(rows)
+        with self.lock:
+            if generation != self.generation:
+                return markup
+            return self.keyboards.setdefault(key, markup)
+
+    def warm(self, translations: Iterable[L18n]):
+        for trans in translations:
+            for kind in self.builders:
+                self.get(kind, trans)
+                if kind in ROLE_KEYBOARDS:
+                    self.get(kind, trans, True)
+
+    def invalidate(self, kind: str = None):
+        with self.lock:
+            self.generation += 1
+            self.keyboards = {k: v for k, v in self.keyboards.items() if kind is not None and k[2] != kind}
+
+    def get_stats(self) -> Dict:
+        return {"keyboards": len(self.keyboards), "hits": self.hits, "misses": self.misses}
@@ -1,7 +1,199 @@
-import json
 import codecs
+import hashlib
+import json
+import marshal
+import os
+import string
+import tempfile
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from . import messages
+from .consts import LOG_L18N
+from .utility import get_logger
 
 DEFAULT_LOCALE = 'english'
+L18N_DIR = "l18n"
+L18N_CACHE_DIR = ".l18n_cache"
+L18N_CACHE_VERSION = 2
+
+
+def get_required_messages() -> List[str]:
+    # every message the bot code asks for
+    return [v for k, v in vars(messages).items() if k.startswith("M_")]
+
+
+def parse_template(template: str) -> Tuple[str, ...]:
+    # placeholders of format template, ValueError if template is broken
+    return tuple(field for _, field, _, _ in string.Formatter().parse(template) if field is not None)
+
+
+def compile_catalog(name: str, own: Dict[str, str], default: Dict[str, str],
+                    required: Iterable[str] = None) -> Tuple[Dict[str, str], List[str]]:
+    # Resolves fallback to default locale once, so every message is one dict lookup, and checks templates.
+    # Returns messages and found problems, placeholders are parsed only for the check
+    if required is None:
+        required = get_required_messages()
+    problems = []
+    msg_map = dict(default)
+    msg_map.update(own)
+    fields = {}
+    for msg_type, template in msg_map.items():
+        try:
+            fields[msg_type] = parse_template(template)
+        except ValueError as exc:
+            problems.append("{0}: broken template {1} ({2})".format(name, msg_type, exc))
+    for msg_type in required:
+        if msg_type not in msg_map:
+            problems.append("{0}: missing message {1}".format(name, msg_type))
+        elif msg_type not in own:
+            problems.append("{0}: message {1} is not translated, {2} used".format(name, msg_type, DEFAULT_LOCALE))
+    if own is not default:
+        for msg_type in own:
+            if msg_type in default and msg_type in fields and \
+                    sorted(fields[msg_type]) != sorted(parse_template(default[msg_type])):
+                problems.append("{0}: message {1} has placeholders {2}, {3} has {4}".format(
+                    name, msg_type, fields[msg_type], DEFAULT_LOCALE, parse_template(default[msg_type])))
+    return msg_map, problems
+
+
+class Catalog:
+    __slots__ = ("name", "messages", "problems", "sources")
+
+    def __init__(self, name: str, msg_map: Dict[str, str], problems: List[str], sources: List[Tuple]):
+        self.name = name
+        self.messages = msg_map
+        self.problems = problems
+        # (file name, mtime, size, hash) of files the catalog is compiled from
+        self.sources = sources
+
+
+class CatalogRegistry:
+    # Process wide compiled catalogs: default locale is read once and shared by all locales.
+    # Compiled catalogs are saved on disk and reused while source files have the same mtime or content hash
+    def __init__(self, directory: str = L18N_DIR, cache_directory: Optional[str] = L18N_CACHE_DIR):
+        self.directory = directory
+        self.cache_directory = cache_directory
+        self.lock = threading.RLock()
+        self.catalogs = {}
+        self.sources = {}
+        required = get_required_messages()
+        self.required = required
+        self.required_hash = hashlib.sha1("\n".join(sorted(required)).encode("UTF-8")).hexdigest()
+
+    def get(self, name: str) -> Catalog:
+        with self.lock:
+            catalog = self.catalogs.get(name)
+            if catalog is None:
+                catalog = self._load(name)
+                self.catalogs[name] = catalog
+            return catalog
+
+    def get_changed(self) -> List[str]:
+        # names of loaded catalogs, which source files were changed
+        changed = []
+        with self.lock:
+            for name, catalog in self.catalogs.items():
+                sources = [self._check_source(i) for i in catalog.sources]
+                if None in sources:
+                    changed.append(name)
+                else:
+                    # remember new mtime of touched, but not changed file, to not hash it again
+                    catalog.sources = sources
+        return changed
+
+    def reload(self, name: str) -> Catalog:
+        catalog = self._load(name)
+        with self.lock:
+            self.catalogs[name] = catalog
+        return catalog
+
+    def get_file(self, name: str) -> str:
+        return os.path.join(self.directory, name + ".lng")
+
+    def _stamp(self, name: str) -> Tuple:
+        stat = os.stat(self.get_file(name))
+        return name, stat.st_mtime_ns, stat.st_size
+
+    def _check_source(self, source: Tuple) -> Optional[Tuple]:
+        # returns actual source stamp, None if the file was changed
+        name, mtime, size, digest = source
+        try:
+            stamp = self._stamp(name)
+            if stamp == (name, mtime, size):
+                return source
+            # file touched, but maybe not changed
+            with open(self.get_file(name), "rb") as fp:
+                if hashlib.sha1(fp.read()).hexdigest() == digest:
+                    return stamp + (digest,)
+        except OSError:
+            pass
+        return None
+
+    def _read_source(self, name: str) -> Tuple[Dict[str, str], Tuple]:
+        with self.lock:
+            stamp = self._stamp(name)
+            cached = self.sources.get(name)
+            if cached is not None and cached[1][:3] == stamp:
+                return cached
+            with open(self.get_file(name), "rb") as fp:
+                data = fp.read()
+            source = (json.loads(codecs.decode(data, "utf-8-sig")), stamp + (hashlib.sha1(data).hexdigest(),))
+            self.sources[name] = source
+            return source
+
+    def _get_cache_file(self, name: str) -> str:
+        return os.path.join(self.cache_directory, name + ".cache")
+
+    def _read_cache(self, name: str) -> Optional[Catalog]:
+        try:
+            with open(self._get_cache_file(name), "rb") as fp:
+                data = marshal.load(fp)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(data, dict) or data.get("version") != L18N_CACHE_VERSION or \
+                data.get("required") != self.required_hash:
+            return None
+        sources = [self._check_source(tuple(i)) for i in data["sources"]]
+        if None in sources:
+            return None
+        catalog = Catalog(name, data["messages"], data["problems"], sources)
+        if sources != data["sources"]:
+            self._write_cache(catalog)
+        return catalog
+
+    def _write_cache(self, catalog: Catalog):
+        data = {"version": L18N_CACHE_VERSION, "required": self.required_hash, "sources": catalog.sources,
+                "messages": catalog.messages, "problems": catalog.problems}
+        try:
+            os.makedirs(self.cache_directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fp:
+                marshal.dump(data, fp)
+            os.replace(tmp_path, self._get_cache_file(catalog.name))
+        except OSError:
+            # cache is only speed up, catalog works without it
+            pass
+
+    def _load(self, name: str) -> Catalog:
+        if self.cache_directory is not None:
+            catalog = self._read_cache(name)
+            if catalog is not None:
+                return catalog
+        own, own_source = self._read_source(name)
+        if name == DEFAULT_LOCALE:
+            default, sources = own, [own_source]
+        else:
+            default, default_source = self._read_source(DEFAULT_LOCALE)
+            sources = [own_source, default_source]
+        msg_map, problems = compile_catalog(name, own, default, self.required)
+        catalog = Catalog(name, msg_map, problems, sources)
+        if self.cache_directory is not None:
+            self._write_cache(catalog)
+        return catalog
+
+
+catalogs = CatalogRegistry()
 
 
 # TODO: replace for gettext
@@ -12,32 +204,82 @@ class L18n:
         self.code = ''
         self.encoding = None
         self.msg_map = {}
-        self.alternative = None
+        self.problems = []
+        # messages received from server, they survive catalog reload
+        self.added = {}
+        self.lock = threading.Lock()
 
     def set_locale(self, name: str):
         self.locale = name
         self.code = name[:2]
-        f = "l18n//" + name + ".lng"
-        fp = codecs.open(f, 'r', "utf-8")
-        self.msg_map = json.load(fp)
-        if self.locale != DEFAULT_LOCALE:
-            self.alternative = L18n()
-            self.alternative.set_locale(DEFAULT_LOCALE)
+        self.swap(catalogs.get(name))
+
+    def swap(self, catalog: Catalog):
+        # replaces all messages at once, lookups in progress see either old or new catalog
+        msg_map = dict(catalog.messages)
+        if self.encoding is not None:
+            msg_map = {k: str(v.encode(self.encoding)) for k, v in msg_map.items()}
+        with self.lock:
+            msg_map.update(self.added)
+            self.problems = catalog.problems
+            self.msg_map = msg_map
 
     def add_message(self, msg_type: str, msg_text: str):
-        self.msg_map[msg_type] = msg_text
+        if self.encoding is not None:
+            msg_text = str(msg_text.encode(self.encoding))
+        with self.lock:
+            self.added[msg_type] = msg_text
+            self.msg_map[msg_type] = msg_text
 
     def is_message_exists(self, msg_type: str):
-        return msg_type in self.msg_map.keys()
+        return msg_type in self.msg_map
 
     def get_message(self, msg_type: str):
-        if msg_type in self.msg_map.keys():
-            msg = self.msg_map[msg_type]
-        elif self.locale != DEFAULT_LOCALE:
-            msg = self.alternative.get_message(msg_type)
-        else:
+        try:
+            return self.msg_map[msg_type]
+        except KeyError:
             raise KeyError("Can't find message {} in locale {} (default locale {})".format(msg_type, self.locale,
-                                                                                           DEFAULT_LOCALE))
-        if self.encoding is not None:
-            msg = str(msg.encode(self.encoding))
-        return msg
+                                                                                           DEFAULT_LOCALE)) from None
+
+
+class CatalogWatcher:
+    # Checks .lng files in background and swaps changed catalogs into translations in use
+    def __init__(self, translations: Dict[str, L18n], interval: float, log_level, on_reload: Callable = None):
+        self.translations = translations
+        self.interval = interval
+        self.logger = get_logger(LOG_L18N, log_level)
+        # on_reload(names) is called after catalogs are swapped
+        self.on_reload = on_reload
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="CatalogWatcher", daemon=True)
+        self.thread.start()
+        self.logger.info("Localization files watcher started, check every {0} seconds".format(self.interval))
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def check(self) -> List[str]:
+        reloaded = []
+        for name in catalogs.get_changed():
+            try:
+                catalog = catalogs.reload(name)
+            except (OSError, ValueError) as exc:
+                self.logger.error("Error {0} when reload localization {1}, previous version kept".format(exc, name))
+                continue
+            for trans in list(self.translations.values()):
+                if trans.locale == name:
+                    trans.swap(catalog)
+            for problem in catalog.problems:
+                self.logger.warning("Localization problem: {0}".format(problem))
+            reloaded.append(name)
+            self.logger.info("Localization {0} reloaded".format(name))
+        if reloaded and self.on_reload is not None:
+            self.on_reload(reloaded)
+        return reloaded
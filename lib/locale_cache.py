@@ -0,0 +1,72 @@
+import collections
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+# cached absence of stored locale, so users without settings don't go to DB every update
+NO_LOCALE = ""
+
+
+class LocaleCache:
+    # Chosen languages of recently active users. Missing users are read from DB by loader(telegram_id),
+    # least recently used are evicted when size is exceeded, entries expire after ttl to see changes of other processes
+    def __init__(self, loader: Callable[[int], Optional[str]], max_size: int, ttl: float, negative_ttl: float):
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # telegram_id: (locale or NO_LOCALE, expiration time)
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, telegram_id: int) -> Optional[str]:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(telegram_id)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(telegram_id)
+                if entry[0] == NO_LOCALE:
+                    self.negative_hits += 1
+                    return None
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # DB errors go to caller, nothing is cached then
+        return self._put(telegram_id, self.loader(telegram_id), now)
+
+    def set(self, telegram_id: int, locale: Optional[str]):
+        self._put(telegram_id, locale, time.monotonic())
+
+    def delete(self, telegram_id: int):
+        self._put(telegram_id, None, time.monotonic())
+
+    def get_cached(self) -> List[int]:
+        with self.lock:
+            return list(self.entries.keys())
+
+    def _put(self, telegram_id: int, locale: Optional[str], now: float) -> Optional[str]:
+        if locale is None:
+            entry = (NO_LOCALE, now + self.negative_ttl)
+        else:
+            entry = (locale, now + self.ttl)
+        with self.lock:
+            self.entries[telegram_id] = entry
+            self.entries.move_to_end(telegram_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+        return locale
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            requests = self.hits + self.negative_hits + self.misses
+            return {"size": len(self.entries),
+                    "hits": self.hits,
+                    "negative_hits": self.negative_hits,
+                    "misses": self.misses,
+                    "evicted": self.evicted,
+                    "hit_ratio": round((self.hits + self.negative_hits) / requests, 3) if requests else 0}
@@ -51,3 +51,10 @@ M_CMD_SENT = "CMD_SENT"
 M_DYNAMIC_LOCALE = "DYNAMIC_LOCALE"
 M_SERVER_STARTED_UP = "SERVER_STARTED_UP"
 M_BOT_STARTED_UP = "BOT_STARTED_UP"
+M_BOT_PUBLISH_STATS = "BOT_PUBLISH_STATS"
+M_BOT_SEND_STATS = "BOT_SEND_STATS"
+M_BOT_BROADCAST_STATS = "BOT_BROADCAST_STATS"
+M_BOT_LOCALE_CACHE_STATS = "BOT_LOCALE_CACHE_STATS"
+M_BOT_DB_STATS = "BOT_DB_STATS"
+M_BOT_SESSION_STATS = "BOT_SESSION_STATS"
+M_BOT_LOG_STATS = "BOT_LOG_STATS"
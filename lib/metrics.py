@@ -0,0 +1,198 @@
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from .consts import LOG_METRICS, METRICS_BUCKETS
+from .utility import get_logger
+
+CONTENT_TYPE_METRICS = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in values)
+    return "{" + ",".join("{0}=\"{1}\"".format(k, v) for k, v in zip(names, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, value: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self) -> List[str]:
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} counter".format(self.name)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append("{0}{1} {2}".format(self.name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+
+class Histogram:
+    # Cumulative buckets are built on render, observe only increments one bucket
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                 buckets: Iterable[float] = METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = sorted(buckets)
+        self.lock = threading.Lock()
+        # labels: [count in each bucket and +Inf, sum]
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        pos = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            item = self.values.get(labels)
+            if item is None:
+                item = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            item[0][pos] += 1
+            item[1] += value
+
+    def render(self) -> List[str]:
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} histogram".format(self.name)]
+        with self.lock:
+            values = sorted((k, (list(v[0]), v[1])) for k, v in self.values.items())
+        names = self.label_names + ("le",)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float("inf")], counts):
+                cumulative += count
+                label_text = format_labels(names, labels + (format_value(bound),))
+                lines.append("{0}_bucket{1} {2}".format(self.name, label_text, cumulative))
+            label_text = format_labels(self.label_names, labels)
+            lines.append("{0}_sum{1} {2}".format(self.name, label_text, format_value(total)))
+            lines.append("{0}_count{1} {2}".format(self.name, label_text, cumulative))
+        return lines
+
+
+class Gauge:
+    # Value is read on render by callback, which returns {labels: value}, so nothing is updated on hot paths
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...],
+                 callback: Callable[[], Dict[Tuple, float]]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} gauge".format(self.name)]
+        for labels, value in sorted(self.callback().items()):
+            lines.append("{0}{1} {2}".format(self.name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _add(self, metric):
+        with self.lock:
+            # metric registered again, e.g. gauge of recreated object, replaces old one
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Tuple[str, ...] = (),
+                  buckets: Iterable[float] = METRICS_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, label_names, buckets))
+
+    def gauge(self, name: str, documentation: str, label_names: Tuple[str, ...],
+              callback: Callable[[], Dict[Tuple, float]]) -> Gauge:
+        return self._add(Gauge(name, documentation, label_names, callback))
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+handler_time = registry.histogram("idle_rpg_bot_handler_seconds", "Time of telegram update handling", ("handler",))
+publish_time = registry.histogram("idle_rpg_bot_publish_seconds", "Time of command publishing", ("queue",))
+publish_errors = registry.counter("idle_rpg_bot_publish_errors_total", "Commands failed to publish", ("queue",))
+callback_time = registry.histogram("idle_rpg_bot_callback_seconds", "Time of server message processing",
+                                   ("callback",))
+telegram_time = registry.histogram("idle_rpg_bot_telegram_api_seconds", "Time of telegram API calls", ("method",))
+telegram_errors = registry.counter("idle_rpg_bot_telegram_api_errors_total", "Failed telegram API calls",
+                                   ("method", "error"))
+
+
+def timed(histogram: Histogram, label: str) -> Callable:
+    # decorator, which observes time of each call with the label
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, label)
+        return wrapper
+    return decorator
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE_METRICS)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are too frequent for log
+        pass
+
+
+class MetricsServer:
+    # Serves /metrics for Prometheus scraper in background thread
+    def __init__(self, listen: str, port: int, log_level, metrics_registry: MetricsRegistry = registry):
+        self.listen = listen
+        self.port = port
+        self.logger = get_logger(LOG_METRICS, log_level)
+        self.registry = metrics_registry
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.listen, self.port), MetricsRequestHandler)
+        self.server.daemon_threads = True
+        self.server.registry = self.registry
+        self.thread = threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True)
+        self.thread.start()
+        self.logger.info("Metrics are served on http://{0}:{1}/metrics".format(
+            self.listen, self.server.server_address[1]))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,315 @@
+import collections
+import queue
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+import pika
+
+from .config import Config
+from .consts import LOG_PUBLISHER, LOG_BATCH_PUBLISHER, QUEUE_APP_ID, QUEUE_PUBLISHER_WAIT, QUEUE_PUBLISH_RETRIES, \
+    QUEUE_IDLE_CHECK, QUEUE_HEADER_ERROR
+from .offline import MEMORY_BACKEND, MemoryConnection
+from .utility import get_logger
+
+
+def get_mq_parameters(mq_config: Config) -> pika.ConnectionParameters:
+    if mq_config.queue_password is None:
+        return pika.ConnectionParameters(host=mq_config.queue_host, port=mq_config.queue_port)
+    else:
+        return pika.ConnectionParameters(host=mq_config.queue_host, port=mq_config.queue_port,
+                                         credentials=pika.credentials.PlainCredentials(mq_config.queue_user,
+                                                                                       mq_config.queue_password))
+
+
+def get_mq_connect(mq_config: Config):
+    if mq_config.queue_host == MEMORY_BACKEND:
+        return MemoryConnection()
+    return pika.BlockingConnection(get_mq_parameters(mq_config))
+
+
+def get_message_properties(persistent: bool = True) -> pika.BasicProperties:
+    return pika.BasicProperties(delivery_mode=2 if persistent else None,
+                                content_type="application/json",
+                                content_encoding="UTF-8",
+                                app_id=QUEUE_APP_ID)
+
+
+def get_failed_properties(properties: pika.BasicProperties, error: Exception) -> pika.BasicProperties:
+    # properties to keep message, which can't be delivered, with the reason
+    failed = get_message_properties()
+    if properties is not None:
+        failed.content_type = properties.content_type
+        failed.content_encoding = properties.content_encoding
+        failed.headers = dict(properties.headers or {})
+    if failed.headers is None:
+        failed.headers = {}
+    failed.headers[QUEUE_HEADER_ERROR] = str(error)
+    return failed
+
+
+class PooledChannel:
+    # One connection with one channel, used by only one thread at a time
+    __slots__ = ("connection", "channel", "last_used", "generation")
+
+    def __init__(self, config: Config, generation: int = 0):
+        self.connection = get_mq_connect(config)
+        self.channel = self.connection.channel()
+        self.last_used = time.monotonic()
+        # connections opened before reconnect are closed, when they come back to pool
+        self.generation = generation
+
+    def is_open(self) -> bool:
+        return self.connection.is_open and self.channel.is_open
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+
+
+class Publisher:
+    # Keeps a small pool of long-lived connections for publishing from dispatcher worker threads
+    def __init__(self, config: Config, pool_size: int):
+        self.config = config
+        self.logger = get_logger(LOG_PUBLISHER, config.log_level)
+        self.pool_size = pool_size
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.published = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.generation = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.logger.info("Publisher ready, pool size {0}".format(pool_size))
+
+    def _checkout(self) -> PooledChannel:
+        try:
+            item = self.idle.get_nowait()
+            if item.generation != self.generation:
+                self._discard(item)
+                return self._checkout()
+        except queue.Empty:
+            item = None
+            with self.lock:
+                can_create = self.created < self.pool_size
+                if can_create:
+                    self.created += 1
+            if can_create:
+                try:
+                    item = PooledChannel(self.config, self.generation)
+                except pika.exceptions.AMQPError:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+                self.logger.info("Opened publisher connection {0} of {1}".format(self.created, self.pool_size))
+            else:
+                try:
+                    item = self.idle.get(timeout=QUEUE_PUBLISHER_WAIT)
+                except queue.Empty:
+                    raise pika.exceptions.AMQPConnectionError("No free publisher connection in {0} seconds".
+                                                              format(QUEUE_PUBLISHER_WAIT))
+        # blocking connection processes heartbeats only when used, so wake up idle ones before publish
+        if time.monotonic() - item.last_used > QUEUE_IDLE_CHECK:
+            try:
+                item.connection.process_data_events(0)
+            except pika.exceptions.AMQPError as exc:
+                self.logger.warning("Idle publisher connection lost: {0}".format(exc))
+        return item
+
+    def _checkin(self, item: PooledChannel):
+        if item.generation != self.generation:
+            self._discard(item)
+            return
+        item.last_used = time.monotonic()
+        self.idle.put(item)
+
+    def _discard(self, item: PooledChannel):
+        item.close()
+        with self.lock:
+            self.created -= 1
+
+    def publish(self, queue_name: str, body: str, properties: pika.BasicProperties = None):
+        if properties is None:
+            properties = get_message_properties()
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            item = self._checkout()
+            try:
+                if not item.is_open():
+                    raise pika.exceptions.ConnectionWrongStateError("Publisher connection closed")
+                item.channel.basic_publish(exchange="", routing_key=queue_name, body=body, properties=properties)
+            except pika.exceptions.AMQPError as exc:
+                self._discard(item)
+                if attempt >= QUEUE_PUBLISH_RETRIES:
+                    with self.lock:
+                        self.errors += 1
+                    raise
+                attempt += 1
+                with self.lock:
+                    self.reconnects += 1
+                self.logger.warning("Error {0} when publish in queue {1}, reconnect".format(exc, queue_name))
+                continue
+            self._checkin(item)
+            break
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.published += 1
+            self.total_time += elapsed
+            if elapsed > self.max_time:
+                self.max_time = elapsed
+        self.logger.debug("Published in queue %s in %.2f ms", queue_name, elapsed * 1000)
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return {"published": self.published,
+                    "errors": self.errors,
+                    "reconnects": self.reconnects,
+                    "connections": self.created,
+                    "avg_ms": round(self.total_time / self.published * 1000, 2) if self.published else 0,
+                    "max_ms": round(self.max_time * 1000, 2)}
+
+    def reconnect(self):
+        # after queue settings change: idle connections are closed now, busy ones after publish in progress
+        with self.lock:
+            self.generation += 1
+        while True:
+            try:
+                item = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(item)
+        self.logger.info("Publisher reconnects with new settings")
+
+    def close(self):
+        while True:
+            try:
+                item = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(item)
+        self.logger.info("Publisher closed")
+
+
+class BatchPublisher:
+    # Publishes a stream of messages on one channel with asynchronous publisher confirms,
+    # keeping no more than window messages unconfirmed
+    def __init__(self, config: Config, window: int):
+        self.config = config
+        self.logger = get_logger(LOG_BATCH_PUBLISHER, config.log_level)
+        self.window = window
+        self.connection = None
+        self.channel = None
+        self.queue_name = None
+        self.messages = None
+        self.exhausted = False
+        self.in_flight = collections.OrderedDict()
+        self.next_tag = 1
+        self.sent = 0
+        self.acked = 0
+        self.nacked = 0
+        self.latencies = []
+        self.error = None
+
+    def publish_all(self, queue_name: str, messages: Iterable[Tuple[bytes, pika.BasicProperties]]) -> Dict:
+        self.queue_name = queue_name
+        self.messages = iter(messages)
+        start = time.perf_counter()
+        if self.config.queue_host == MEMORY_BACKEND:
+            self._publish_memory()
+            return self.get_stats(time.perf_counter() - start)
+        self.connection = pika.SelectConnection(get_mq_parameters(self.config),
+                                                on_open_callback=self._on_connection_open,
+                                                on_open_error_callback=self._on_connection_error,
+                                                on_close_callback=self._on_connection_closed)
+        self.connection.ioloop.start()
+        elapsed = time.perf_counter() - start
+        if self.error is not None:
+            raise pika.exceptions.AMQPConnectionError("Batch publish stopped after {0} messages: {1}".
+                                                      format(self.sent, self.error))
+        stats = self.get_stats(elapsed)
+        self.logger.info("Published {0} messages in queue {1} in {2} seconds, {3} msg/s, confirm latency avg {4} ms,"
+                         " p95 {5} ms, max {6} ms, nacked {7}".format(stats["sent"], queue_name, stats["seconds"],
+                                                                      stats["rate"], stats["avg_ms"], stats["p95_ms"],
+                                                                      stats["max_ms"], stats["nacked"]))
+        return stats
+
+    def get_stats(self, elapsed: float) -> Dict:
+        latencies = sorted(self.latencies)
+        cnt = len(latencies)
+        return {"sent": self.sent,
+                "acked": self.acked,
+                "nacked": self.nacked,
+                "seconds": round(elapsed, 3),
+                "rate": round(self.sent / elapsed, 2) if elapsed > 0 else 0,
+                "avg_ms": round(sum(latencies) / cnt * 1000, 2) if cnt else 0,
+                "p95_ms": round(latencies[min(cnt - 1, int(cnt * 0.95))] * 1000, 2) if cnt else 0,
+                "max_ms": round(latencies[-1] * 1000, 2) if cnt else 0}
+
+    def _publish_memory(self):
+        # memory broker confirms every message at once
+        channel = MemoryConnection().channel()
+        for body, properties in self.messages:
+            channel.basic_publish(exchange="", routing_key=self.queue_name, body=body, properties=properties)
+            self.sent += 1
+            self.acked += 1
+            self.latencies.append(0)
+        self.exhausted = True
+
+    def _on_connection_open(self, connection: pika.SelectConnection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection: pika.SelectConnection, exc: BaseException):
+        self.error = exc
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection: pika.SelectConnection, reason: BaseException):
+        if not self.exhausted or self.in_flight:
+            self.error = reason
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=lambda frame: self._pump())
+
+    def _pump(self):
+        while not self.exhausted and len(self.in_flight) < self.window:
+            try:
+                body, properties = next(self.messages)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.channel.basic_publish(exchange="", routing_key=self.queue_name, body=body, properties=properties)
+            self.in_flight[self.next_tag] = time.perf_counter()
+            self.next_tag += 1
+            self.sent += 1
+        if self.exhausted and not self.in_flight:
+            self.connection.close()
+
+    def _on_confirm(self, frame: pika.frame.Method):
+        now = time.perf_counter()
+        method = frame.method
+        is_ack = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = []
+            for tag in self.in_flight:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self.in_flight else []
+        for tag in tags:
+            self.latencies.append(now - self.in_flight.pop(tag))
+            if is_ack:
+                self.acked += 1
+            else:
+                self.nacked += 1
+        if not is_ack:
+            self.logger.error("Broker rejected {0} messages up to delivery tag {1}".format(len(tags),
+                                                                                           method.delivery_tag))
+        self._pump()
@@ -0,0 +1,289 @@
+import datetime
+import itertools
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import pika
+from telegram import Bot, Chat, Message, Update, User
+
+from .consts import LOG_PERSIST, FAKE_BOT_TOKEN
+from .utility import get_logger
+
+MEMORY_BACKEND = "memory"
+FAKE_TELEGRAM_API = "fake"
+
+
+class MemoryBroker:
+    # In-process replacement for RabbitMQ default and direct exchanges: named queues, delivered in publish order
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        # exchange: {routing key: queue names}
+        self.bindings = {}
+
+    def get_queue(self, name: str) -> queue.Queue:
+        with self.lock:
+            if name not in self.queues:
+                self.queues[name] = queue.Queue()
+            return self.queues[name]
+
+    def publish(self, queue_name: str, body, properties: pika.BasicProperties = None):
+        if isinstance(body, str):
+            body = body.encode("UTF-8")
+        self.get_queue(queue_name).put((properties, body))
+
+    def bind(self, queue_name: str, exchange: str, routing_key: str):
+        with self.lock:
+            self.bindings.setdefault(exchange, {}).setdefault(routing_key, set()).add(queue_name)
+
+    def route(self, exchange: str, routing_key: str) -> List[str]:
+        if not exchange:
+            return [routing_key]
+        with self.lock:
+            return list(self.bindings.get(exchange, {}).get(routing_key, ()))
+
+    def get(self, queue_name: str, timeout: float = None):
+        try:
+            return self.get_queue(queue_name).get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def size(self, queue_name: str) -> int:
+        return self.get_queue(queue_name).qsize()
+
+    def purge(self):
+        with self.lock:
+            self.queues = {}
+            self.bindings = {}
+
+
+memory_broker = MemoryBroker()
+
+
+class MemoryChannel:
+    # Subset of pika BlockingChannel used by the bot
+    def __init__(self, broker: MemoryBroker):
+        self.broker = broker
+        self.is_open = True
+        self.delivery_tags = itertools.count(1)
+        self.unacked = {}
+        self.callbacks = {}
+
+    def queue_declare(self, queue: str, durable: bool = False, **kwargs):
+        self.broker.get_queue(queue)
+
+    def exchange_declare(self, exchange: str, exchange_type: str = "direct", durable: bool = False, **kwargs):
+        pass
+
+    def queue_bind(self, queue: str, exchange: str, routing_key: str = None, **kwargs):
+        self.broker.bind(queue, exchange, routing_key if routing_key is not None else queue)
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_qos(self, prefetch_size: int = 0, prefetch_count: int = 0, global_qos: bool = False):
+        pass
+
+    def basic_publish(self, exchange: str, routing_key: str, body, properties: pika.BasicProperties = None,
+                      mandatory: bool = False):
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Channel is closed.")
+        for queue_name in self.broker.route(exchange, routing_key):
+            self.broker.publish(queue_name, body, properties)
+
+    def basic_consume(self, queue: str, on_message_callback, auto_ack: bool = False, **kwargs):
+        self.callbacks[queue] = on_message_callback
+
+    def consume(self, queue: str, auto_ack: bool = False, inactivity_timeout: float = None, **kwargs):
+        while True:
+            item = self.broker.get(queue, inactivity_timeout)
+            if item is None:
+                yield None, None, None
+                continue
+            properties, body = item
+            method = pika.spec.Basic.Deliver(delivery_tag=next(self.delivery_tags), routing_key=queue)
+            if not auto_ack:
+                self.unacked[method.delivery_tag] = (queue, properties, body)
+            # like in RabbitMQ, callback consumer registered on the same queue receives messages as well
+            if queue in self.callbacks:
+                self.callbacks[queue](self, method, properties, body)
+                continue
+            yield method, properties, body
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False):
+        self.unacked.pop(delivery_tag, None)
+
+    def basic_nack(self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True):
+        item = self.unacked.pop(delivery_tag, None)
+        if item is not None and requeue:
+            self.broker.publish(item[0], item[2], item[1])
+
+    def cancel(self):
+        self.callbacks = {}
+        return 0
+
+    def close(self):
+        self.is_open = False
+
+
+class MemoryConnection:
+    # Subset of pika BlockingConnection used by the bot
+    def __init__(self, broker: MemoryBroker = memory_broker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self) -> MemoryChannel:
+        return MemoryChannel(self.broker)
+
+    def process_data_events(self, time_limit: float = 0):
+        pass
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeBot(Bot):
+    # Telegram bot without network: records sent messages and returns updates pushed by test code
+    def __init__(self, latency: float = 0):
+        super().__init__(token=FAKE_BOT_TOKEN)
+        self.latency = latency
+        self.sent = []
+        self.sent_lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        self.updates = queue.Queue()
+        self.listeners = []
+
+    def send_message(self, chat_id, text: str, reply_markup=None, **kwargs) -> Message:
+        if self.latency:
+            time.sleep(self.latency)
+        sent_at = time.perf_counter()
+        with self.sent_lock:
+            self.sent.append((sent_at, chat_id, text, reply_markup))
+        for listener in self.listeners:
+            listener(sent_at, chat_id, text)
+        return Message(message_id=next(self.message_ids), date=datetime.datetime.now(),
+                       chat=Chat(id=chat_id, type=Chat.PRIVATE), text=text, reply_markup=reply_markup)
+
+    def get_sent(self, chat_id: int = None) -> List:
+        with self.sent_lock:
+            return [i for i in self.sent if chat_id is None or i[1] == chat_id]
+
+    def push_update(self, update: Update):
+        self.updates.put(update)
+
+    def get_updates(self, offset: int = None, limit: int = 100, timeout: float = 0, **kwargs) -> List[Update]:
+        res = []
+        try:
+            res.append(self.updates.get(timeout=timeout or None))
+            while len(res) < limit:
+                res.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return res
+
+    def get_me(self, timeout=None, api_kwargs=None) -> User:
+        self._bot = User(id=int(FAKE_BOT_TOKEN.split(":")[0]), first_name="Fake", is_bot=True, username="fake_bot")
+        return self._bot
+
+    def delete_webhook(self, *args, **kwargs) -> bool:
+        return True
+
+    def set_webhook(self, *args, **kwargs) -> bool:
+        return True
+
+
+class MemoryPersist:
+    # Same interface as Persist, but keeps everything in process memory
+    def __init__(self, log_level):
+        self.logger = get_logger(LOG_PERSIST, log_level)
+        self.lock = threading.Lock()
+        self.locales = {}
+        self.broadcasts = {}
+        self.sessions = {}
+        self.was_error = False
+        self.logger.info('Memory persist ready')
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def check_version(self):
+        pass
+
+    def get_stats(self) -> Dict:
+        return {"connections": 0, "in_use": 0, "checkouts": 0, "avg_wait_ms": 0, "max_wait_ms": 0, "errors": 0,
+                "broken": 0}
+
+    def reconnect(self):
+        pass
+
+    def set_locale(self, telegram_id: int, locale: str):
+        with self.lock:
+            self.locales[telegram_id] = locale
+
+    def delete_locale(self, telegram_id: int):
+        with self.lock:
+            self.locales.pop(telegram_id, None)
+
+    def save_session(self, chat_id: int, stage: str, char_class: Optional[str], name: Optional[str],
+                     message_id: Optional[int], expire: float):
+        with self.lock:
+            self.sessions[chat_id] = (stage, char_class, name, message_id, expire)
+
+    def delete_session(self, chat_id: int):
+        with self.lock:
+            self.sessions.pop(chat_id, None)
+
+    def get_sessions(self, chat_ids: List[int]) -> Dict[int, Tuple]:
+        now = time.time()
+        with self.lock:
+            return {i: self.sessions[i] for i in chat_ids if i in self.sessions and self.sessions[i][4] > now}
+
+    def delete_expired_sessions(self) -> int:
+        now = time.time()
+        with self.lock:
+            expired = [k for k, v in self.sessions.items() if v[4] <= now]
+            for i in expired:
+                del self.sessions[i]
+            return len(expired)
+
+    def get_locale(self, telegram_id: int) -> Optional[str]:
+        with self.lock:
+            return self.locales.get(telegram_id)
+
+    def get_locale_users(self) -> List[int]:
+        with self.lock:
+            return list(self.locales)
+
+    def create_broadcast(self, message_key: str, args: List[str], keyboard: str, priority: int,
+                         recipients: List[int]) -> int:
+        with self.lock:
+            broadcast_id = len(self.broadcasts) + 1
+            self.broadcasts[broadcast_id] = {"id": broadcast_id, "message_key": message_key, "args": list(args),
+                                             "keyboard": keyboard, "priority": priority, "total": len(recipients),
+                                             "delivered": 0, "failed": 0, "blocked": 0, "finished": False,
+                                             "statuses": {i: 0 for i in recipients}}
+            return broadcast_id
+
+    def get_unfinished_broadcasts(self) -> List[Dict]:
+        with self.lock:
+            return [dict({k: v for k, v in i.items() if k not in ("statuses", "finished")},
+                         recipients=[k for k, v in i["statuses"].items() if v == 0])
+                    for i in self.broadcasts.values() if not i["finished"]]
+
+    def save_broadcast_progress(self, broadcast_id: int, results: List[Tuple[int, int]], delivered: int,
+                                failed: int, blocked: int, finished: bool = False):
+        with self.lock:
+            broadcast = self.broadcasts[broadcast_id]
+            broadcast["statuses"].update(results)
+            broadcast.update(delivered=delivered, failed=failed, blocked=blocked, finished=finished)
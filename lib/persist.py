@@ -1,70 +1,575 @@
+import array
+import atexit
+import itertools
+import json
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
 import psycopg2
+import psycopg2.extras
 from .config import Config
-from .consts import PERSIST_LOAD_BATCH
+from .consts import PERSIST_LOAD_BATCH, LOG_PERSIST, PERSIST_POOL_WAIT, PERSIST_IDLE_CHECK, PERSIST_RETRIES, \
+    PERSIST_RECONNECT_DELAY, PERSIST_RECONNECT_MAX_DELAY
+from .offline import MEMORY_BACKEND, MemoryPersist
 from .utility import get_logger
 
 
-PERSIST_VERSION = 2
+PERSIST_VERSION = 4
 PERSIST_NAME = 'idle RPG bot'
 
 
+class ConnectionPool:
+    # Bounded pool of DB connections, each used by one thread at a time.
+    # After failed connect new connects are refused for growing delay, so threads don't hang on dead DB
+    def __init__(self, config: Config, size: int, logger):
+        self.config = config
+        self.size = size
+        self.logger = logger
+        # (connection, last used time), last used are taken first, so idle ones can be checked
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.errors = 0
+        self.broken = 0
+        self.connect_failures = 0
+        self.retry_at = 0.0
+        # connections opened before reconnect are closed, when they come back to pool
+        self.generation = 0
+        self.generations = {}
+
+    def _connect(self):
+        now = time.monotonic()
+        with self.lock:
+            if now < self.retry_at:
+                raise psycopg2.OperationalError("DB is unavailable, next connect in {0:.1f} seconds".
+                                                format(self.retry_at - now))
+        try:
+            conn = psycopg2.connect(dbname=self.config.db_name, user=self.config.db_user,
+                                    password=self.config.db_password, host=self.config.db_host,
+                                    port=self.config.db_port)
+        except psycopg2.Error as exc:
+            with self.lock:
+                self.connect_failures += 1
+                delay = min(PERSIST_RECONNECT_DELAY * 2 ** (self.connect_failures - 1), PERSIST_RECONNECT_MAX_DELAY)
+                self.retry_at = time.monotonic() + delay
+            self.logger.error("Error {0} when connect to DB, next try in {1} seconds".format(exc, delay))
+            raise
+        with self.lock:
+            self.connect_failures = 0
+            self.retry_at = 0.0
+            self.generations[conn] = self.generation
+        return conn
+
+    def _is_alive(self, conn) -> bool:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("select 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as exc:
+            self.logger.warning("Idle DB connection lost: {0}".format(exc))
+            return False
+
+    def checkout(self):
+        start = time.perf_counter()
+        try:
+            conn, last_used = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_create = self.created < self.size
+                if can_create:
+                    self.created += 1
+            if can_create:
+                conn, last_used = None, None
+            else:
+                try:
+                    conn, last_used = self.idle.get(timeout=PERSIST_POOL_WAIT)
+                except queue.Empty:
+                    with self.lock:
+                        self.errors += 1
+                    raise psycopg2.OperationalError("No free DB connection in {0} seconds".format(PERSIST_POOL_WAIT))
+        if conn is not None and self._is_stale(conn):
+            self._close(conn)
+            conn = None
+        elif conn is not None and (conn.closed or
+                                   time.monotonic() - last_used > PERSIST_IDLE_CHECK and not self._is_alive(conn)):
+            self._close(conn)
+            with self.lock:
+                self.broken += 1
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                with self.lock:
+                    self.created -= 1
+                    self.errors += 1
+                raise
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_wait += elapsed
+            if elapsed > self.max_wait:
+                self.max_wait = elapsed
+        return conn
+
+    def release(self, conn, error: Exception = None):
+        with self.lock:
+            self.in_use -= 1
+            if error is not None:
+                self.errors += 1
+        if conn.closed:
+            # next checkout opens new connection instead
+            self._close(conn)
+            with self.lock:
+                self.created -= 1
+                self.broken += 1
+            return
+        if self._is_stale(conn):
+            self._close(conn)
+            with self.lock:
+                self.created -= 1
+            return
+        self.idle.put((conn, time.monotonic()))
+
+    def _is_stale(self, conn) -> bool:
+        with self.lock:
+            return self.generations.get(conn) != self.generation
+
+    def _close(self, conn):
+        with self.lock:
+            self.generations.pop(conn, None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def reconnect(self):
+        # after DB settings change: idle connections are closed now, busy ones when their operation ends
+        with self.lock:
+            self.generation += 1
+            self.connect_failures = 0
+            self.retry_at = 0.0
+        self.close()
+        self.logger.info("DB connections are reopened with new settings")
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(conn)
+            with self.lock:
+                self.created -= 1
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return {"connections": self.created,
+                    "in_use": self.in_use,
+                    "checkouts": self.checkouts,
+                    "avg_wait_ms": round(self.total_wait / self.checkouts * 1000, 2) if self.checkouts else 0,
+                    "max_wait_ms": round(self.max_wait * 1000, 2),
+                    "errors": self.errors,
+                    "broken": self.broken}
+
+
 class Persist:
     def __init__(self, config: Config):
-        self.logger = get_logger("LOG_PERSIST", config.log_level)
-        self.conn = psycopg2.connect(dbname=config.db_name, user=config.db_user,
-                                     password=config.db_password, host=config.db_host, port=config.db_port)
-        self.cursor = self.conn.cursor()
+        self.logger = get_logger(LOG_PERSIST, config.log_level)
+        self.pool = ConnectionPool(config, config.db_pool_size, self.logger)
         self.was_error = False
-        self.logger.info('Persist ready')
+        # write behind: last change of user locale or session by id, None to delete, saved by writer thread
+        self.cond = threading.Condition()
+        self.pending_locales = {}
+        self.pending_sessions = {}
+        # changes being written now, still visible for reads
+        self.flushing_locales = {}
+        self.flushing_sessions = {}
+        # batches are written one by one, so older batch can't overwrite newer
+        self.flush_lock = threading.Lock()
+        self.flush_time = config.db_flush_time
+        self.flush_size = config.db_flush_size
+        self.writer = None
+        self.is_stopped = False
+        self.flushed = 0
+        # rows fetched from server side cursor at once by bulk reads
+        self.itersize = config.db_itersize
+        self.cursor_ids = itertools.count()
+        self.logger.info('Persist ready, pool size {0}'.format(config.db_pool_size))
+
+    def start(self):
+        # without writer thread locale changes are written at once
+        self.writer = threading.Thread(target=self._write_behind, name="PersistWriter", daemon=True)
+        self.writer.start()
+        # changes in queue are written also when process exits without admin shutdown
+        atexit.register(self.stop)
+        self.logger.info("Persist writer started, flush every {0} seconds or {1} changes".format(self.flush_time,
+                                                                                                 self.flush_size))
+
+    def stop(self):
+        # writes all pending changes before return, repeated call does nothing
+        with self.cond:
+            if self.is_stopped:
+                return
+            self.is_stopped = True
+            self.cond.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        try:
+            self.flush()
+        except psycopg2.Error as exc:
+            self.logger.critical("Error {0} when save changes on stop, {1} changes lost".format(
+                exc, self._get_pending_count()))
+        else:
+            self.logger.info("Persist writer stopped, {0} changes saved".format(self.flushed))
+        self.pool.close()
+
+    def _run(self, operation: Callable, *args):
+        # runs operation(cursor, *args) in own transaction on pooled connection.
+        # If connection is lost before commit, operation is repeated on new one
+        # Connection goes back to pool after any error, it's dropped by pool only if closed
+        attempt = 0
+        while True:
+            conn = self.pool.checkout()
+            committing = False
+            error = None
+            try:
+                with conn.cursor() as cursor:
+                    result = operation(cursor, *args)
+                committing = True
+                conn.commit()
+                return result
+            except psycopg2.Error as exc:
+                error = exc
+                self._rollback(conn)
+                if conn.closed and not committing and attempt < PERSIST_RETRIES:
+                    attempt += 1
+                    self.logger.warning("Error {0} on DB connection, retry".format(exc))
+                    continue
+                raise
+            except BaseException:
+                # not DB error, e.g. bad stored data, connection is fine after rollback
+                self._rollback(conn)
+                raise
+            finally:
+                self.pool.release(conn, error)
+
+    @staticmethod
+    def _rollback(conn):
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
 
-    def renew(self, config: Config):
-        self.conn.close()
-        self.__init__(config)
+    def get_stats(self) -> Dict:
+        return self.pool.get_stats()
 
-    def commit(self):
-        self.conn.commit()
+    def reconnect(self):
+        self.pool.reconnect()
 
     def check_version(self):
-        self.cursor.execute("""
-            select n_version from idle_rpg_bot.persist_version where v_name = %s
-        """, (PERSIST_NAME, ))
-        ver = self.cursor.fetchone()[0]
+        def operation(cursor):
+            cursor.execute("""
+                select n_version from idle_rpg_bot.persist_version where v_name = %s
+            """, (PERSIST_NAME, ))
+            return cursor.fetchone()[0]
+        ver = self._run(operation)
         self.logger.info("DB version {0}. Persist version {1}".format(ver, PERSIST_VERSION))
         assert ver == PERSIST_VERSION
 
     def set_locale(self, telegram_id: int, locale: str):
-        # TODO: do named binds
-        # Where my MERGE?
-        # check row blocks when on conflict
-        self.cursor.execute(
-            """insert into idle_rpg_bot.user_locales as l (telegram_id, locale)
-                    values(%s, %s)
-                    on conflict (telegram_id) do update
-                      set locale = %s where l.telegram_id = %s
-            """, (telegram_id, locale, locale, telegram_id)
-        )
-        self.commit()
+        self._put(self.pending_locales, telegram_id, locale)
 
     def delete_locale(self, telegram_id: int):
-        self.cursor.execute(
-            """delete from idle_rpg_bot.user_locales l where l.telegram_id = %s""",
-            (telegram_id,)
-        )
-        self.commit()
-
-    def get_all_locale(self):
-        locales = {}
-        cnt = 0
-        self.cursor.execute(
-            """
-            select telegram_id, locale from idle_rpg_bot.user_locales
-            """
-        )
-        for telegram_id, locale in self.cursor:
-            locales[telegram_id] = locale
-            cnt += 1
-            if cnt % PERSIST_LOAD_BATCH == 0:
-                self.logger.info("Was loaded {0} user locales".format(cnt))
-        self.logger.info("Was loaded {0} user locale settings".format(cnt))
-        self.commit()
-        return locales
+        self._put(self.pending_locales, telegram_id, None)
+
+    def _get_pending_count(self) -> int:
+        return len(self.pending_locales) + len(self.pending_sessions)
+
+    def _put(self, pending: Dict, key: int, value):
+        # only last change matters, so repeated changes of one user replace each other in queue
+        with self.cond:
+            pending[key] = value
+            if self.writer is not None and not self.is_stopped:
+                if self._get_pending_count() >= self.flush_size:
+                    self.cond.notify_all()
+                return
+        self.flush()
+
+    def _write_behind(self):
+        # after error next flush waits with backoff, full queue doesn't wake writer until DB is back
+        delay = None
+        while True:
+            with self.cond:
+                if delay is not None:
+                    self.cond.wait_for(lambda: self.is_stopped, delay)
+                elif not self.is_stopped and self._get_pending_count() < self.flush_size:
+                    self.cond.wait(self.flush_time)
+                if self.is_stopped:
+                    break
+            try:
+                self.flush()
+            except psycopg2.Error as exc:
+                # changes are kept in queue and written next time, error is logged once per outage
+                if delay is None:
+                    delay = self.flush_time
+                    self.logger.error("Error {0} when save changes, {1} changes wait".format(
+                        exc, self._get_pending_count()))
+                else:
+                    delay = min(delay * 2, max(self.flush_time, PERSIST_RECONNECT_MAX_DELAY))
+            else:
+                if delay is not None:
+                    delay = None
+                    self.logger.info("Changes saved after DB error")
+
+    @staticmethod
+    def _write_changes(cursor, locales: Dict[int, Optional[str]], sessions: Dict[int, Optional[Tuple]]):
+        upserts = [(k, v) for k, v in locales.items() if v is not None]
+        if upserts:
+            psycopg2.extras.execute_values(
+                cursor,
+                """insert into idle_rpg_bot.user_locales as l (telegram_id, locale) values %s
+                        on conflict (telegram_id) do update set locale = excluded.locale
+                """, upserts, page_size=PERSIST_LOAD_BATCH
+            )
+        deletes = [(k,) for k, v in locales.items() if v is None]
+        if deletes:
+            psycopg2.extras.execute_values(
+                cursor,
+                """delete from idle_rpg_bot.user_locales l using (values %s) as v (telegram_id)
+                    where l.telegram_id = v.telegram_id
+                """, deletes, page_size=PERSIST_LOAD_BATCH
+            )
+        upserts = [(k,) + v for k, v in sessions.items() if v is not None]
+        if upserts:
+            psycopg2.extras.execute_values(
+                cursor,
+                """insert into idle_rpg_bot.sessions as s (chat_id, stage, char_class, char_name, message_id, dt_expire)
+                        values %s
+                        on conflict (chat_id) do update
+                          set stage = excluded.stage, char_class = excluded.char_class,
+                              char_name = excluded.char_name, message_id = excluded.message_id,
+                              dt_expire = excluded.dt_expire
+                """, upserts, template="(%s, %s, %s, %s, %s, to_timestamp(%s))", page_size=PERSIST_LOAD_BATCH
+            )
+        deletes = [(k,) for k, v in sessions.items() if v is None]
+        if deletes:
+            psycopg2.extras.execute_values(
+                cursor,
+                """delete from idle_rpg_bot.sessions s using (values %s) as v (chat_id)
+                    where s.chat_id = v.chat_id
+                """, deletes, page_size=PERSIST_LOAD_BATCH
+            )
+
+    def flush(self):
+        with self.flush_lock:
+            with self.cond:
+                locales = dict(self.pending_locales)
+                sessions = dict(self.pending_sessions)
+                self.pending_locales.clear()
+                self.pending_sessions.clear()
+                self.flushing_locales = locales
+                self.flushing_sessions = sessions
+            if not locales and not sessions:
+                return
+            try:
+                self._run(self._write_changes, locales, sessions)
+            except psycopg2.Error:
+                with self.cond:
+                    # changes made while writing are newer
+                    for changes, pending in ((locales, self.pending_locales), (sessions, self.pending_sessions)):
+                        for key, value in changes.items():
+                            pending.setdefault(key, value)
+                    self.flushing_locales = {}
+                    self.flushing_sessions = {}
+                raise
+            with self.cond:
+                self.flushing_locales = {}
+                self.flushing_sessions = {}
+            self.flushed += len(locales) + len(sessions)
+
+    def save_session(self, chat_id: int, stage: str, char_class: Optional[str], name: Optional[str],
+                     message_id: Optional[int], expire: float):
+        # expire is unix time
+        self._put(self.pending_sessions, chat_id, (stage, char_class, name, message_id, expire))
+
+    def delete_session(self, chat_id: int):
+        self._put(self.pending_sessions, chat_id, None)
+
+    def get_sessions(self, chat_ids: List[int]) -> Dict[int, Tuple]:
+        # not expired sessions of chats as (stage, class, name, message_id, expire unix time)
+        sessions = {}
+        missing = []
+        with self.cond:
+            for chat_id in chat_ids:
+                for changes in (self.pending_sessions, self.flushing_sessions):
+                    if chat_id in changes:
+                        if changes[chat_id] is not None:
+                            sessions[chat_id] = changes[chat_id]
+                        break
+                else:
+                    missing.append(chat_id)
+        if not missing:
+            return sessions
+
+        def operation(cursor):
+            cursor.execute(
+                """select chat_id, stage, char_class, char_name, message_id, extract(epoch from dt_expire)
+                     from idle_rpg_bot.sessions where chat_id = any(%s) and dt_expire > current_timestamp
+                """, (missing,)
+            )
+            return cursor.fetchall()
+        for row in self._run(operation):
+            sessions[row[0]] = (row[1], row[2], row[3], row[4], float(row[5]))
+        return sessions
+
+    def delete_expired_sessions(self) -> int:
+        def operation(cursor):
+            cursor.execute("""delete from idle_rpg_bot.sessions where dt_expire <= current_timestamp""")
+            return cursor.rowcount
+        return self._run(operation)
+
+    def get_locale(self, telegram_id: int) -> Optional[str]:
+        with self.cond:
+            # not saved yet change is the latest
+            for changes in (self.pending_locales, self.flushing_locales):
+                if telegram_id in changes:
+                    return changes[telegram_id]
+
+        def operation(cursor):
+            cursor.execute(
+                """select locale from idle_rpg_bot.user_locales where telegram_id = %s""",
+                (telegram_id,)
+            )
+            return cursor.fetchone()
+        row = self._run(operation)
+        return row[0] if row is not None else None
+
+    def _read_ids(self, cursor, query: str, params: Tuple = ()) -> array.array:
+        # named cursor is read on server by itersize rows, so client memory doesn't depend on table size.
+        # It lives until the end of transaction
+        ids = array.array("q")
+        with cursor.connection.cursor(name="bulk_read_{0}".format(next(self.cursor_ids))) as bulk_cursor:
+            bulk_cursor.itersize = self.itersize
+            bulk_cursor.execute(query, params)
+            for telegram_id, in bulk_cursor:
+                ids.append(telegram_id)
+                if len(ids) % self.itersize == 0:
+                    self.logger.debug("Was loaded {0} rows".format(len(ids)))
+        return ids
+
+    def get_locale_users(self) -> array.array:
+        # telegram_id of every user with chosen language
+        self.flush()
+        users = self._run(self._read_ids, """select telegram_id from idle_rpg_bot.user_locales""")
+        self.logger.info("Was loaded {0} users with locale settings".format(len(users)))
+        return users
+
+    def create_broadcast(self, message_key: str, args: List[str], keyboard: str, priority: int,
+                         recipients: List[int]) -> int:
+        def operation(cursor):
+            cursor.execute(
+                """insert into idle_rpg_bot.broadcasts (message_key, args, keyboard, priority, n_total)
+                        values(%s, %s, %s, %s, %s) returning id
+                """, (message_key, json.dumps(args), keyboard, priority, len(recipients))
+            )
+            broadcast_id = cursor.fetchone()[0]
+            psycopg2.extras.execute_values(
+                cursor,
+                """insert into idle_rpg_bot.broadcast_recipients (broadcast_id, telegram_id) values %s
+                        on conflict do nothing
+                """, ((broadcast_id, i) for i in recipients), page_size=PERSIST_LOAD_BATCH
+            )
+            return broadcast_id
+        return self._run(operation)
+
+    def get_unfinished_broadcasts(self) -> List[Dict]:
+        def operation(cursor):
+            cursor.execute(
+                """
+                select id, message_key, args, keyboard, priority, n_total, n_delivered, n_failed, n_blocked
+                  from idle_rpg_bot.broadcasts where dt_finish is null order by id
+                """
+            )
+            broadcasts = [{"id": row[0], "message_key": row[1], "args": json.loads(row[2]), "keyboard": row[3],
+                           "priority": row[4], "total": row[5], "delivered": row[6], "failed": row[7],
+                           "blocked": row[8]}
+                          for row in cursor.fetchall()]
+            for i in broadcasts:
+                i["recipients"] = self._read_ids(
+                    cursor,
+                    """
+                    select telegram_id from idle_rpg_bot.broadcast_recipients
+                     where broadcast_id = %s and status = 0
+                    """, (i["id"],)
+                )
+            return broadcasts
+        return self._run(operation)
+
+    def save_broadcast_progress(self, broadcast_id: int, results: List[Tuple[int, int]], delivered: int,
+                                failed: int, blocked: int, finished: bool = False):
+        # results are (telegram_id, status) of recipients processed since last save
+        def operation(cursor):
+            if results:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    """update idle_rpg_bot.broadcast_recipients r set status = v.status
+                         from (values %s) as v (broadcast_id, telegram_id, status)
+                        where r.broadcast_id = v.broadcast_id and r.telegram_id = v.telegram_id
+                    """, [(broadcast_id, telegram_id, status) for telegram_id, status in results],
+                    page_size=PERSIST_LOAD_BATCH
+                )
+            cursor.execute(
+                """update idle_rpg_bot.broadcasts
+                      set n_delivered = %s, n_failed = %s, n_blocked = %s,
+                          dt_finish = case when %s then current_timestamp end
+                    where id = %s
+                """, (delivered, failed, blocked, finished, broadcast_id)
+            )
+        self._run(operation)
+
+
+class PersistSessionBackend:
+    # Sessions are saved in DB in batches by persist writer, so any bot process can continue the dialog
+    is_shared = True
+
+    def __init__(self, persist: Persist):
+        self.persist = persist
+
+    def load(self, chat_ids: List[int]) -> Optional[Dict[int, Tuple]]:
+        try:
+            return self.persist.get_sessions(chat_ids)
+        except psycopg2.Error as exc:
+            self.persist.logger.error("Error {0} when load sessions of {1}".format(exc, chat_ids))
+            return None
+
+    def save(self, session, expire: float):
+        self.persist.save_session(session.chat_id, session.stage.value, session.char_class, session.name,
+                                  session.message_id, expire)
+
+    def delete(self, chat_id: int):
+        self.persist.delete_session(chat_id)
+
+    def delete_expired(self):
+        try:
+            deleted = self.persist.delete_expired_sessions()
+        except psycopg2.Error as exc:
+            self.persist.logger.error("Error {0} when delete expired sessions".format(exc))
+            return
+        self.persist.logger.debug("Deleted {0} expired sessions".format(deleted))
+
+
+def get_persist(config: Config):
+    if config.db_host == MEMORY_BACKEND:
+        return MemoryPersist(config.log_level)
+    return Persist(config)
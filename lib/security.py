@@ -1,5 +1,6 @@
 from cryptography.fernet import Fernet
 import base64
+import functools
 
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
@@ -10,6 +11,8 @@ def is_password_encrypted(password: str) -> bool:
     return password is not None and password[-4:] == '????'
 
 
+# key derivation is slow by design, so key is derived once per server name and port in process
+@functools.lru_cache(maxsize=None)
 def set_up_encryption(server_name: str, port: int) -> Fernet:
     salt = bytes(port)
     # TODO: rewrite to AES
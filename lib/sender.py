@@ -0,0 +1,278 @@
+import collections
+import heapq
+import itertools
+import queue
+import threading
+import time
+from typing import Callable, Dict
+
+from telegram import Bot, error as tlg_error
+
+from .consts import LOG_SENDER, SEND_RETRIES, SEND_RETRY_DELAY, SEND_RATE_WINDOW, SEND_BUCKET_CLEANUP
+from .metrics import telegram_errors, telegram_time
+from .utility import get_logger
+
+PRIORITY_ADMIN = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = {PRIORITY_ADMIN: "admin", PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+
+class TokenBucket:
+    # Reserves send slots: tokens may go below zero, then the caller has to wait returned number of seconds
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        if self.rate <= 0:
+            return 0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def is_idle(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class OutgoingMessage:
+    __slots__ = ("priority", "seq", "chat_id", "text", "reply_markup", "on_done", "created", "due", "reserved",
+                 "holding", "attempt")
+
+    def __init__(self, priority: int, seq: int, chat_id: int, text: str, reply_markup, on_done: Callable):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.on_done = on_done
+        self.created = time.monotonic()
+        self.due = 0
+        self.reserved = False
+        # message holds its chat while being sent, next messages to the chat wait for it to keep order
+        self.holding = False
+        self.attempt = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SendScheduler:
+    # Owns every message sent to telegram: global and per chat rate limits, priority lanes, flood control.
+    # Scheduler thread decides, when message can be sent, pool of workers sends them concurrently
+    def __init__(self, bot: Bot, log_level, global_rate: float, chat_rate: float, chat_burst: float, workers: int,
+                 max_queue: int):
+        self.bot = bot
+        self.logger = get_logger(LOG_SENDER, log_level)
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.cond = threading.Condition()
+        self.pending = []
+        self.delayed = []
+        self.seq = itertools.count()
+        now = time.monotonic()
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate), now)
+        self.chat_buckets = {}
+        self.busy_chats = {}
+        self.paused_until = 0
+        self.is_stopped = False
+        self.thread = None
+        self.workers = workers
+        self.worker_threads = []
+        self.ready = queue.Queue(maxsize=workers)
+        self.max_queue = max_queue
+        self.size = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.total_wait = 0.0
+        self.sent_times = collections.deque()
+        self.queued = {i: 0 for i in PRIORITY_NAMES}
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="SendScheduler", daemon=True)
+        self.thread.start()
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work, name="SendWorker-{0}".format(i), daemon=True)
+            worker.start()
+            self.worker_threads.append(worker)
+        self.logger.info("Send scheduler started, global rate {0}/s, chat rate {1}/s, {2} workers".
+                         format(self.global_rate, self.chat_rate, self.workers))
+
+    def stop(self, timeout: float = None):
+        # send everything already queued, then stop
+        with self.cond:
+            self.is_stopped = True
+            self.cond.notify_all()
+        for thread in [self.thread] + self.worker_threads:
+            if thread is not None:
+                thread.join(timeout)
+        self.logger.info("Send scheduler stopped")
+
+    def send(self, chat_id: int, text: str, reply_markup=None, priority: int = PRIORITY_INTERACTIVE,
+             on_done: Callable = None):
+        # blocks while queue is full, so producers slow down instead of piling up messages in memory
+        item = OutgoingMessage(priority, next(self.seq), chat_id, text, reply_markup, on_done)
+        with self.cond:
+            while self.size >= self.max_queue and not self.is_stopped:
+                self.cond.wait()
+            heapq.heappush(self.pending, item)
+            self.queued[priority] += 1
+            self.size += 1
+            self.cond.notify_all()
+
+    def _next(self):
+        # returns message ready to send and time to wait before sending, None when stopped and queue is empty
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    heapq.heappush(self.pending, heapq.heappop(self.delayed)[2])
+                if not self.pending:
+                    if self.is_stopped and self.size == 0:
+                        return None, 0
+                    self.cond.wait(self.delayed[0][0] - now if self.delayed else None)
+                    continue
+                if self.paused_until > now:
+                    self.cond.wait(self.paused_until - now)
+                    continue
+                item = heapq.heappop(self.pending)
+                if not item.holding and item.chat_id in self.busy_chats:
+                    self.busy_chats[item.chat_id].append(item)
+                    continue
+                if not item.reserved:
+                    bucket = self.chat_buckets.get(item.chat_id)
+                    if bucket is None:
+                        bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+                        self.chat_buckets[item.chat_id] = bucket
+                    item.reserved = True
+                    wait = bucket.reserve(now)
+                    if wait > 0:
+                        self._delay(item, now + wait)
+                        continue
+                if not item.holding:
+                    item.holding = True
+                    self.busy_chats[item.chat_id] = []
+                self.queued[item.priority] -= 1
+                self.in_flight += 1
+                return item, self.global_bucket.reserve(now)
+
+    def _delay(self, item: OutgoingMessage, due: float):
+        item.due = due
+        heapq.heappush(self.delayed, (due, item.seq, item))
+
+    def _run(self):
+        while True:
+            item, wait = self._next()
+            if item is None:
+                break
+            if wait > 0:
+                time.sleep(wait)
+            self.ready.put(item)
+        for i in range(self.workers):
+            self.ready.put(None)
+
+    def _work(self):
+        while True:
+            item = self.ready.get()
+            if item is None:
+                break
+            try:
+                self._deliver(item)
+            except Exception as exc:
+                # worker thread must survive anything, or the pool shrinks
+                self.logger.error("Error {0} when deliver message to chat {1}".format(exc, item.chat_id))
+
+    def _send(self, item: OutgoingMessage):
+        # telegram API call with its time and errors in metrics
+        start = time.perf_counter()
+        try:
+            self.bot.send_message(chat_id=item.chat_id, text=item.text, reply_markup=item.reply_markup)
+        except tlg_error.TelegramError as exc:
+            telegram_errors.inc("sendMessage", type(exc).__name__)
+            raise
+        finally:
+            telegram_time.observe(time.perf_counter() - start, "sendMessage")
+
+    def _deliver(self, item: OutgoingMessage):
+        # message is finished unless it's queued again, so chat and worker slot are always released
+        item.attempt += 1
+        error = None
+        is_finished = True
+        try:
+            self._send(item)
+        except tlg_error.RetryAfter as exc:
+            self.logger.warning("Flood control, pause sending for {0} seconds".format(exc.retry_after))
+            is_finished = False
+            with self.cond:
+                self.retry_after += 1
+                self.in_flight -= 1
+                self.paused_until = max(self.paused_until, time.monotonic() + exc.retry_after)
+                heapq.heappush(self.pending, item)
+                self.queued[item.priority] += 1
+                self.cond.notify_all()
+        except (tlg_error.TimedOut, tlg_error.NetworkError) as exc:
+            error = exc
+            if item.attempt <= SEND_RETRIES and not isinstance(exc, tlg_error.BadRequest):
+                self.logger.warning("Error {0} when send message to chat {1}, retry".format(exc, item.chat_id))
+                is_finished = False
+                with self.cond:
+                    self.in_flight -= 1
+                    self._delay(item, time.monotonic() + SEND_RETRY_DELAY * item.attempt)
+                    self.queued[item.priority] += 1
+                    self.cond.notify_all()
+        except Exception as exc:
+            # telegram error or bug, message is dropped
+            error = exc
+        finally:
+            if is_finished:
+                self._finish(item, error)
+
+    def _finish(self, item: OutgoingMessage, exc: Exception = None):
+        now = time.monotonic()
+        with self.cond:
+            if exc is None:
+                self.sent += 1
+                self.total_wait += now - item.created
+                self.sent_times.append(now)
+            else:
+                self.failed += 1
+            self.size -= 1
+            self.in_flight -= 1
+            # let next messages to the chat go
+            for i in self.busy_chats.pop(item.chat_id, []):
+                heapq.heappush(self.pending, i)
+            self.cond.notify_all()
+            while self.sent_times and self.sent_times[0] < now - SEND_RATE_WINDOW:
+                self.sent_times.popleft()
+            if (self.sent + self.failed) % SEND_BUCKET_CLEANUP == 0:
+                self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if not v.is_idle(now)}
+        if exc is not None:
+            self.logger.error("Error {0} when send message to chat {1}".format(exc, item.chat_id))
+        if item.on_done is not None:
+            try:
+                item.on_done(exc)
+            except Exception as error:
+                self.logger.error("Error {0} in callback of message to chat {1}".format(error, item.chat_id))
+
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        with self.cond:
+            while self.sent_times and self.sent_times[0] < now - SEND_RATE_WINDOW:
+                self.sent_times.popleft()
+            return {"sent": self.sent,
+                    "failed": self.failed,
+                    "retry_after": self.retry_after,
+                    "queued": {PRIORITY_NAMES[k]: v for k, v in self.queued.items()},
+                    "in_flight": self.in_flight,
+                    "rate": round(len(self.sent_times) / SEND_RATE_WINDOW, 2),
+                    "avg_wait_ms": round(self.total_wait / self.sent * 1000, 2) if self.sent else 0}
@@ -0,0 +1,232 @@
+import collections
+import enum
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from .consts import LOG_SESSIONS
+from .utility import get_logger
+
+
+class Stage(enum.Enum):
+    SELECT_CLASS = "select_class"
+    CHOOSE_NAME = "choose_name"
+    CONFIRM_NAME = "confirm_name"
+    CONFIRM_DELETION = "confirm_deletion"
+    SEND_FEEDBACK = "send_feedback"
+    READ_FEEDBACK = "read_feedback"
+    REPLY_FEEDBACK = "reply_feedback"
+
+
+class Session:
+    # State of multi step dialog with user, one per chat
+    __slots__ = ("chat_id", "stage", "char_class", "name", "message_id", "expires", "slot", "loaded")
+
+    def __init__(self, chat_id: int, stage: Stage):
+        self.chat_id = chat_id
+        self.stage = stage
+        self.char_class = None
+        self.name = None
+        # feedback message, which admin reads or replies
+        self.message_id = None
+        self.expires = 0.0
+        # timer wheel slot the session is in
+        self.slot = None
+        # when the session was read from or written to backend
+        self.loaded = 0.0
+
+
+class MemorySessionBackend:
+    # Sessions live only in this process, so there is nothing to load or save
+    is_shared = False
+
+    def load(self, chat_ids: Iterable[int]) -> Optional[Dict[int, Tuple]]:
+        return {}
+
+    def save(self, session: Session, expire: float):
+        pass
+
+    def delete(self, chat_id: int):
+        pass
+
+    def delete_expired(self):
+        pass
+
+
+class SessionStore:
+    # Dialog sessions by chat_id. Sessions idle longer than ttl are evicted by timer wheel:
+    # each slot holds sessions expiring in one tick, so every tick checks only sessions due then.
+    # With shared backend local sessions are near cache: they, and known absence of session, are trusted
+    # for cache_time, then read from backend again, because other bot process could change them
+    def __init__(self, ttl: float, tick: float, log_level, backend=None, cache_time: float = 0):
+        self.ttl = ttl
+        self.tick = tick
+        self.logger = get_logger(LOG_SESSIONS, log_level)
+        self.backend = backend if backend is not None else MemorySessionBackend()
+        self.cache_time = cache_time
+        self.lock = threading.Lock()
+        self.sessions = {}
+        # chat_id: time, when backend had no session for the chat
+        self.absent = collections.OrderedDict()
+        # one more slot than ttl takes, so the slot being checked never receives new sessions
+        self.wheel = [set() for _ in range(int(ttl // tick) + 2)]
+        self.by_stage = {i: 0 for i in Stage}
+        self.started = 0
+        self.expired = 0
+        self.loads = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="SessionStore", daemon=True)
+        self.thread.start()
+        self.logger.info("Session store started, sessions expire after {0} seconds".format(self.ttl))
+
+    def stop(self):
+        self.stopped.set()
+
+    def _slot(self, expires: float) -> int:
+        return int(expires // self.tick) % len(self.wheel)
+
+    def _touch(self, session: Session, now: float, expires: float = None):
+        session.expires = now + self.ttl if expires is None else expires
+        slot = self._slot(session.expires)
+        if slot != session.slot:
+            if session.slot is not None:
+                self.wheel[session.slot].discard(session.chat_id)
+            self.wheel[slot].add(session.chat_id)
+            session.slot = slot
+            return True
+        return False
+
+    def _save(self, session: Session, now: float):
+        session.loaded = now
+        self.backend.save(session, time.time() + session.expires - now)
+
+    def _add(self, session: Session):
+        self.sessions[session.chat_id] = session
+        self.absent.pop(session.chat_id, None)
+        self.by_stage[session.stage] += 1
+
+    def _remove(self, chat_id: int) -> Optional[Session]:
+        session = self.sessions.pop(chat_id, None)
+        if session is not None:
+            self.wheel[session.slot].discard(chat_id)
+            self.by_stage[session.stage] -= 1
+        return session
+
+    def begin(self, chat_id: int, stage: Stage, message_id: int = None) -> Session:
+        # replaces any other dialog of the chat
+        session = Session(chat_id, stage)
+        session.message_id = message_id
+        now = time.monotonic()
+        with self.lock:
+            self._remove(chat_id)
+            self._add(session)
+            self.started += 1
+            self._touch(session, now)
+            self._save(session, now)
+        return session
+
+    def _is_fresh(self, chat_id: int, session: Optional[Session], now: float) -> bool:
+        if not self.backend.is_shared:
+            return True
+        if session is not None:
+            return now - session.loaded < self.cache_time
+        checked = self.absent.get(chat_id)
+        return checked is not None and now - checked < self.cache_time
+
+    def get(self, chat_id: int) -> Optional[Session]:
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(chat_id)
+            if self._is_fresh(chat_id, session, now):
+                # expiration in backend is renewed not more often than once a tick
+                if session is not None and self._touch(session, now):
+                    self._save(session, now)
+                return session
+            self.loads += 1
+        rows = self.backend.load([chat_id])
+        with self.lock:
+            if rows is None:
+                # backend failed, local copy is better than nothing
+                session = self.sessions.get(chat_id)
+                if session is not None:
+                    self._touch(session, now)
+                return session
+            self._remove(chat_id)
+            row = rows.get(chat_id)
+            if row is None:
+                self.absent[chat_id] = now
+                self.absent.move_to_end(chat_id)
+                return None
+            stage, char_class, name, message_id, expire = row
+            session = Session(chat_id, Stage(stage))
+            session.char_class = char_class
+            session.name = name
+            session.message_id = message_id
+            session.loaded = now
+            self._add(session)
+            # place by saved expiration, then renew it as for any access
+            self._touch(session, now, now + expire - time.time())
+            if self._touch(session, now):
+                self._save(session, now)
+            return session
+
+    def move(self, session: Session, stage: Stage):
+        now = time.monotonic()
+        with self.lock:
+            if self.sessions.get(session.chat_id) is not session:
+                # session was ended or replaced meanwhile
+                return
+            self.by_stage[session.stage] -= 1
+            self.by_stage[stage] += 1
+            session.stage = stage
+            self._touch(session, now)
+            self._save(session, now)
+
+    def end(self, chat_id: int):
+        # called for every server response, so backend is written only if there can be a session to delete
+        now = time.monotonic()
+        with self.lock:
+            session = self._remove(chat_id)
+            known_absent = session is None and (not self.backend.is_shared or self._is_fresh(chat_id, None, now))
+            self.absent[chat_id] = now
+            self.absent.move_to_end(chat_id)
+            if not known_absent:
+                self.backend.delete(chat_id)
+
+    def _run(self):
+        slot_time = time.monotonic() // self.tick * self.tick
+        cleanup_time = slot_time + self.ttl
+        while not self.stopped.wait(max(0.0, slot_time + self.tick - time.monotonic())):
+            slot_time += self.tick
+            self.evict(slot_time)
+            if slot_time >= cleanup_time:
+                # sessions expired in other processes or before restart
+                cleanup_time = slot_time + self.ttl
+                self.backend.delete_expired()
+
+    def evict(self, now: float) -> int:
+        # ends sessions of the slot, which has just passed
+        expired = 0
+        with self.lock:
+            slot = self.wheel[self._slot(now - self.tick)]
+            for chat_id in list(slot):
+                if self.sessions[chat_id].expires <= now:
+                    self._remove(chat_id)
+                    expired += 1
+            self.expired += expired
+            while self.absent and next(iter(self.absent.values())) <= now - self.cache_time:
+                self.absent.popitem(last=False)
+        if expired:
+            self.logger.debug("Evicted {0} idle sessions".format(expired))
+        return expired
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            return {"active": len(self.sessions),
+                    "by_stage": {k.value: v for k, v in self.by_stage.items() if v},
+                    "started": self.started,
+                    "expired": self.expired,
+                    "loads": self.loads}
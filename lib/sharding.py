@@ -0,0 +1,82 @@
+import bisect
+import hashlib
+import threading
+from typing import Dict, Iterable, List
+
+from .consts import LOG_SHARDING, SHARD_VNODES, QUEUE_EXCHANGE_RESPONSES, QUEUE_NAME_INSTANCE_PREFIX
+from .utility import get_logger
+
+
+def get_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("UTF-8")).digest()[:8], "big")
+
+
+class HashRing:
+    # Consistent hashing: key belongs to the first instance point after key hash on the ring,
+    # so when instance joins or leaves, only keys of its neighbours change owner
+    def __init__(self, instances: Iterable[str], vnodes: int = SHARD_VNODES):
+        points = sorted((get_hash("{0}#{1}".format(instance, i)), instance)
+                        for instance in set(instances) for i in range(vnodes))
+        self.hashes = [i[0] for i in points]
+        self.instances = [i[1] for i in points]
+
+    def get(self, key: str) -> str:
+        pos = bisect.bisect(self.hashes, get_hash(key)) % len(self.hashes)
+        return self.instances[pos]
+
+
+def get_instance_queue(instance: str) -> str:
+    return QUEUE_NAME_INSTANCE_PREFIX + instance
+
+
+class Sharding:
+    # Each bot instance owns chats by consistent hashing. Commands carry reply_to with owner instance,
+    # server sends responses to direct exchange with it as routing key, so they come to owner's own queue.
+    # Queues of retired instances are drained by the instance owning their name, responses sent before
+    # rebalancing are not lost
+    def __init__(self, instance: str, instances: List[str], retired: List[str], log_level):
+        self.instance = instance
+        self.logger = get_logger(LOG_SHARDING, log_level)
+        self.lock = threading.Lock()
+        self.instances = []
+        self.retired = []
+        self.ring = None
+        self.update(instances, retired)
+
+    def update(self, instances: List[str], retired: List[str]):
+        instances = sorted(set(instances) | {self.instance})
+        retired = sorted(set(retired) - set(instances))
+        ring = HashRing(instances)
+        with self.lock:
+            changed = instances != self.instances or retired != self.retired
+            self.ring = ring
+            self.instances = instances
+            self.retired = retired
+        if changed:
+            self.logger.info("Instance {0} in ring of {1}, drains queues of {2}".format(
+                self.instance, instances, self.get_drained()))
+
+    def get_reply_to(self, chat_id: int) -> str:
+        return self.ring.get(str(chat_id))
+
+    def get_drained(self) -> List[str]:
+        # retired instances, whose queues this instance takes over
+        ring = self.ring
+        return [i for i in self.retired if ring.get(i) == self.instance]
+
+    def get_queues(self) -> List[str]:
+        return [get_instance_queue(i) for i in [self.instance] + self.get_drained()]
+
+    def get_bindings(self) -> Dict[str, str]:
+        # queue: routing key for every instance, which can be in reply_to, so responses for instance,
+        # which has not started yet, wait in its queue instead of being dropped by exchange
+        with self.lock:
+            instances = self.instances + self.retired
+        return {get_instance_queue(i): i for i in instances}
+
+    def declare(self, channel):
+        # idempotent, called on every connect, consumers reconnect after update, so new bindings are made then
+        channel.exchange_declare(exchange=QUEUE_EXCHANGE_RESPONSES, exchange_type="direct", durable=True)
+        for queue_name, routing_key in self.get_bindings().items():
+            channel.queue_declare(queue=queue_name, durable=True)
+            channel.queue_bind(queue=queue_name, exchange=QUEUE_EXCHANGE_RESPONSES, routing_key=routing_key)
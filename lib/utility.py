@@ -1,14 +1,23 @@
+import atexit
+import queue
 import sys
 import logging
+import threading
+import time
 from logging import INFO
-from logging.handlers import RotatingFileHandler
-from typing import Union
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Tuple, Union
+
+from .consts import LOG_QUEUE_SIZE, LOG_RATE, LOG_BURST
 
 FORMATTER = logging.Formatter("[%(levelname)s] [%(name)s] - [%(asctime)s]: %(message)s")
 LOG_DIR = "logs//"
 
 global log_level
 
+# names of loggers made by get_logger, their level follows LOG_LEVEL on config reload
+logger_names = set()
+
 
 def get_console_handler(is_system: bool = False):
     if is_system:
@@ -26,18 +35,150 @@ def get_file_handler(logger_name: str):
     return file_handler
 
 
+class RateLimitFilter(logging.Filter):
+    # Token bucket for each logger and place in code: not more than rate records per second with bursts up to burst.
+    # Warnings and errors always pass
+    def __init__(self, rate: float, burst: float):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        # (logger, file, line): [tokens, last time]
+        self.buckets = {}
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                self.dropped += 1
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+
+class LogQueueHandler(QueueHandler):
+    # Passes records to writer thread as they are, so message is formatted there, not in calling thread.
+    # When writer falls behind and queue is full, records are dropped instead of blocking caller
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogRouter(logging.Handler):
+    # Runs in writer thread, passes record to console and file handlers of its logger
+    def __init__(self):
+        super().__init__()
+        self.handlers = {}
+
+    def add(self, logger_name: str, is_system: bool = False):
+        self.handlers[logger_name] = (get_console_handler(is_system), get_file_handler(logger_name))
+
+    def emit(self, record: logging.LogRecord):
+        for handler in self.handlers.get(record.name, ()):
+            handler.handle(record)
+
+
+class LogWriter(QueueListener):
+    def enqueue_sentinel(self):
+        # waits for free place, so records before stop are written
+        self.queue.put(self._sentinel)
+
+
+log_queue = queue.Queue(LOG_QUEUE_SIZE)
+log_router = LogRouter()
+log_handler = LogQueueHandler(log_queue)
+log_filter = RateLimitFilter(LOG_RATE, LOG_BURST)
+log_lock = threading.Lock()
+log_writer = None
+
+
+def stop_logging():
+    # writes records left in queue
+    global log_writer
+    with log_lock:
+        writer, log_writer = log_writer, None
+    if writer is not None:
+        writer.stop()
+
+
 def get_logger(logger_name: str, level: Union[int, str] = INFO, is_system: bool = False):
+    # all loggers write files and console in one background thread, so callers don't wait for disk
+    global log_writer
     logger = logging.getLogger(logger_name)
     logger.setLevel(level)
-    logger.addHandler(get_console_handler(is_system))
-    logger.addHandler(get_file_handler(logger_name))
+    with log_lock:
+        if logger_name not in logger_names:
+            logger_names.add(logger_name)
+            log_router.add(logger_name, is_system)
+            logger.addHandler(log_handler)
+            logger.addFilter(log_filter)
+        if log_writer is None:
+            log_writer = LogWriter(log_queue, log_router)
+            log_writer.start()
+            atexit.register(stop_logging)
     # with this pattern, it's rarely necessary to propagate the error up to parent
     logger.propagate = False
     return logger
 
 
+def set_log_rate(rate: float, burst: float):
+    # 0 rate turns limit off
+    with log_filter.lock:
+        log_filter.rate = rate
+        log_filter.burst = burst
+        log_filter.buckets.clear()
+
+
+def get_log_stats() -> Dict:
+    return {"queued": log_queue.qsize(),
+            "dropped_queue_full": log_handler.dropped,
+            "dropped_rate_limit": log_filter.dropped}
+
+
 def set_basic_logging(logger_name: str, level: Union[int, str] = INFO):
     logging.basicConfig(format=FORMATTER,
                         level=level,
                         validate=False,
                         handlers=[get_file_handler("System"), get_console_handler(True)], force=True)
+
+
+def set_log_level(level: Union[int, str]):
+    for logger_name in list(logger_names):
+        logging.getLogger(logger_name).setLevel(level)
+
+
+class PhaseTimer:
+    # Durations of consecutive phases, e.g. of startup, to see where time goes
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last = self.started
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str):
+        # ends phase, which began on previous mark
+        now = time.monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def get_report(self) -> str:
+        return "{0:.3f} s ({1})".format(self.last - self.started,
+                                        ", ".join("{0} {1:.3f} s".format(k, v) for k, v in self.phases))
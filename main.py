@@ -1,32 +1,41 @@
 import argparse
 import datetime
-import json
+import functools
 import os
+import signal
 import sys
 import time
 
 import pika
+import psycopg2
 import psutil
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, error as tlg_error
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CommandHandler, Filters, MessageHandler, Updater, CallbackQueryHandler
 from telegram.ext.callbackcontext import CallbackContext
 from telegram.update import Update
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional, Set, Tuple
 
-from lib.config import Config
+from lib.async_bot import AsyncBot
+from lib.broadcast import Broadcaster
+from lib.codec import Codec
+from lib.config import CONFIG_DB_SETTINGS, CONFIG_QUEUE_SETTINGS, Config, ConfigWatcher
 from lib.consts import MAX_MENU_LENGTH, MAIN_MENU_CREATE, MAIN_MENU_ABOUT, MAIN_MENU_DELETE, MAIN_MENU_STATUS, \
     MAIN_MENU_SETTINGS, MAIN_MENU_FEEDBACK, MAIN_MENU_ADMIN, ADMIN_MENU_STATS, ADMIN_MENU_BOT_STATS, \
     ADMIN_MENU_SHUTDOWN_BASIC, ADMIN_MENU_GET_FEEDBACK, READ_MENU_DONE, READ_MENU_REPLY, LOCALE_PREFIX, \
-    SHUTDOWN_MENU_BOT, SHUTDOWN_MENU_IMMEDIATE, SHUTDOWN_MENU_NORMAL, CMD_GET_CHARACTER_STATUS, STAGE_SELECT_CLASS, \
-    STAGE_CONFIRM_DELETION, CMD_GET_FEEDBACK, CMD_GET_SERVER_STATS, CMD_SERVER_SHUTDOWN_IMMEDIATE, \
-    CMD_SERVER_SHUTDOWN_NORMAL, STAGE_CHOOSE_NAME, CMD_CONFIRM_FEEDBACK, QUEUE_NAME_INIT, QUEUE_NAME_CMD, \
-    QUEUE_APP_ID, CHARACTER_NAME_MAX_LENGTH, CMD_CREATE_CHARACTER, CMD_DELETE_CHARACTER, CMD_REPLY_FEEDBACK, \
+    SHUTDOWN_MENU_BOT, SHUTDOWN_MENU_IMMEDIATE, SHUTDOWN_MENU_NORMAL, CMD_GET_CHARACTER_STATUS, \
+    CMD_GET_FEEDBACK, CMD_GET_SERVER_STATS, CMD_SERVER_SHUTDOWN_IMMEDIATE, \
+    CMD_SERVER_SHUTDOWN_NORMAL, CMD_CONFIRM_FEEDBACK, QUEUE_NAME_INIT, QUEUE_NAME_CMD, \
+    CHARACTER_NAME_MAX_LENGTH, CMD_CREATE_CHARACTER, CMD_DELETE_CHARACTER, CMD_REPLY_FEEDBACK, \
     MAX_FEEDBACK_LENGTH, \
     CMD_FEEDBACK, CMD_SET_CLASS_LIST, CMD_SET_CLASS_DESCRIPTION, CMD_SET_SERVER_STATS, CMD_SERVER_OK, \
     CMD_SENT_FEEDBACK, \
     CMD_FEEDBACK_RECEIVE, LOG_MAIN, LOG_QUEUE, LOG_TELEGRAM, QUEUE_NAME_DICT, QUEUE_NAME_RESPONSES, CMD_GET_CLASS_LIST,\
-    CMD_SERVER_STARTUP
-from lib.l18n import L18n
+    CMD_SERVER_STARTUP, QUEUE_CONFIRM_WINDOW, SEND_STOP_TIMEOUT, QUEUE_NAME_FAILED, QUEUE_PREFETCH, CMD_BROADCAST, \
+    SESSION_WHEEL_TICK, SESSION_BACKEND_DB
+from lib.keyboards import KEYBOARD_MAIN, KEYBOARD_ADMIN, KEYBOARD_READ, KEYBOARD_SHUTDOWN, KEYBOARD_LOCALE, \
+    KEYBOARD_CLASS, KeyboardCache
+from lib.l18n import CatalogWatcher, L18n
+from lib.locale_cache import LocaleCache
 from lib.messages import M_ADMIN_LABEL, M_BOT_STATS, M_SERVER_STATS, M_SHUTDOWN_LABEL, M_GET_FEEDBACK, \
     M_FEEDBACK_REPLY, \
     M_FEEDBACK_DONE, M_DYNAMIC_LOCALE, M_SHUTDOWN_NORMAL, M_SHUTDOWN_IMMEDIATE, M_SHUTDOWN_BOT, M_REQUESTED_STATUS, \
@@ -36,55 +45,83 @@ from lib.messages import M_ADMIN_LABEL, M_BOT_STATS, M_SERVER_STATS, M_SHUTDOWN_
     M_SENT_SHUTDOWN_BOT, M_ENTER_NAME, M_FEEDBACK_SENT, M_PRINT_REPLY, M_NAME_TOO_LONG, M_CHECK_NAME, \
     M_SENT_CHAR_DELETE, M_CANCEL_REQUEST, M_FEEDBACK_TOO_LONG, M_FEEDBACK_SUCCESS, M_FEEDBACK_STRING, M_ADMIN_ANSWER, \
     M_NEW_CHARACTER, M_ABOUT_LABEL, M_DELETE_CHARACTER, M_GET_CHARACTER, M_SETTINGS, M_FEEDBACK, M_ABOUT_ME, \
-    M_SERVER_STARTED_UP, M_BOT_STARTED_UP
-from lib.persist import Persist
-from lib.utility import get_logger
+    M_SERVER_STARTED_UP, M_BOT_STARTED_UP, M_BOT_PUBLISH_STATS, M_BOT_SEND_STATS, M_BOT_BROADCAST_STATS, \
+    M_BOT_LOCALE_CACHE_STATS, M_BOT_DB_STATS, M_BOT_SESSION_STATS, M_BOT_LOG_STATS
+from lib.metrics import MetricsServer, callback_time, handler_time, publish_errors, publish_time, registry, timed
+from lib.mq import BatchPublisher, Publisher, get_mq_connect, get_failed_properties
+from lib.offline import FAKE_TELEGRAM_API, FakeBot
+from lib.persist import PersistSessionBackend, get_persist
+from lib.sessions import MemorySessionBackend, SessionStore, Stage
+from lib.sender import PRIORITY_ADMIN, PRIORITY_INTERACTIVE, SendScheduler
+from lib.sharding import Sharding
+from lib.utility import PhaseTimer, get_log_stats, get_logger, set_log_level, set_log_rate
 
 global class_list
 global class_descriptions
 global out_channel
-global creation_process
-global deletion_process
-global feedback_process
-global feedback_reading
-global feedback_replying
+global sessions
 global characters
 global updater
 global queue_logger
 global telegram_logger
 global config
 global is_shutdown
+global is_queue_changed
+global async_bot
 global user_locales
 global translations
 global startup_time
 global user_settings
+global publisher
+global codec
+global sender
+global broadcaster
+global keyboards
+global sharding
 
 
 def get_locale(update: Update, chat_id: int = None):
     global user_locales
     global translations
+    global telegram_logger
     if update is not None or chat_id is not None:
         if chat_id is None:
             chat_id = update.effective_chat.id
-        locale = user_locales.get(chat_id)
+        try:
+            locale = user_locales.get(chat_id)
+        except psycopg2.Error as exc:
+            telegram_logger.error("Error {0} when read locale of user {1}".format(exc, chat_id))
+            locale = None
         if locale is None and update is not None:
+            # language of telegram client, if user didn't choose one
             if update.callback_query is not None:
                 locale = update.callback_query.from_user.language_code
             else:
                 locale = update.message.from_user.language_code
-            user_locales[chat_id] = locale
 
         if locale in translations:
             return translations[locale]
     return translations['ru']
 
 
+def send_message(chat_id: int, text: str, reply_markup: InlineKeyboardMarkup = None,
+                 priority: int = PRIORITY_INTERACTIVE, on_done: Callable = None):
+    global sender
+    sender.send(chat_id, text, reply_markup, priority, on_done)
+
+
+def render_broadcast(chat_id: int, message_key: str, args: List[str], keyboard: str):
+    trans = get_locale(None, chat_id)
+    return trans.get_message(message_key).format(*args), get_keyboard(keyboard, trans, chat_id)
+
+
+@timed(handler_time, "start")
 def start(update: Update, context: CallbackContext):
     global telegram_logger
     trans = get_locale(update)
     msg = trans.get_message(M_ABOUT_ME)
-    reply_markup = InlineKeyboardMarkup(main_keyboard(update.effective_chat.id, trans))
-    context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+    reply_markup = get_keyboard(KEYBOARD_MAIN, trans, update.effective_chat.id)
+    send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
     telegram_logger.info("Proceed start command from user {0}".format(update.effective_chat.id))
 
 
@@ -100,7 +137,7 @@ def pretty_menu(menu: List):
     return res
 
 
-def class_keyboard(trans: L18n):
+def class_keyboard(trans: L18n, is_admin: bool = False):
     global class_list
     keyboard = []
     if not class_list:
@@ -110,8 +147,7 @@ def class_keyboard(trans: L18n):
     return pretty_menu(keyboard)
 
 
-def main_keyboard(chat_id: int, trans: L18n):
-    global config
+def main_keyboard(trans: L18n, is_admin: bool = False):
     keyboard = [
         InlineKeyboardButton(trans.get_message(M_NEW_CHARACTER), callback_data=MAIN_MENU_CREATE),
         InlineKeyboardButton(trans.get_message(M_ABOUT_LABEL), callback_data=MAIN_MENU_ABOUT),
@@ -120,13 +156,13 @@ def main_keyboard(chat_id: int, trans: L18n):
         InlineKeyboardButton(trans.get_message(M_SETTINGS), callback_data=MAIN_MENU_SETTINGS),
         InlineKeyboardButton(trans.get_message(M_FEEDBACK), callback_data=MAIN_MENU_FEEDBACK),
     ]
-    if chat_id in config.admin_list:
+    if is_admin:
         keyboard.append(InlineKeyboardButton(trans.get_message(M_ADMIN_LABEL), callback_data=MAIN_MENU_ADMIN))
 
     return pretty_menu(keyboard)
 
 
-def admin_keyboard(trans: L18n):
+def admin_keyboard(trans: L18n, is_admin: bool = False):
     keyboard = [
         InlineKeyboardButton(trans.get_message(M_SERVER_STATS), callback_data=ADMIN_MENU_STATS),
         InlineKeyboardButton(trans.get_message(M_BOT_STATS), callback_data=ADMIN_MENU_BOT_STATS),
@@ -137,7 +173,7 @@ def admin_keyboard(trans: L18n):
     return pretty_menu(keyboard)
 
 
-def read_keyboard(trans: L18n):
+def read_keyboard(trans: L18n, is_admin: bool = False):
     keyboard = [
         InlineKeyboardButton(trans.get_message(M_FEEDBACK_DONE), callback_data=READ_MENU_DONE),
         InlineKeyboardButton(trans.get_message(M_FEEDBACK_REPLY), callback_data=READ_MENU_REPLY)
@@ -146,7 +182,7 @@ def read_keyboard(trans: L18n):
     return pretty_menu(keyboard)
 
 
-def shutdown_keyboard(trans: L18n):
+def shutdown_keyboard(trans: L18n, is_admin: bool = False):
     keyboard = [
          InlineKeyboardButton(trans.get_message(M_SHUTDOWN_NORMAL), callback_data=SHUTDOWN_MENU_NORMAL),
          InlineKeyboardButton(trans.get_message(M_SHUTDOWN_IMMEDIATE), callback_data=SHUTDOWN_MENU_IMMEDIATE),
@@ -156,7 +192,7 @@ def shutdown_keyboard(trans: L18n):
     return pretty_menu(keyboard)
 
 
-def locale_keyboard(trans: L18n):
+def locale_keyboard(trans: L18n, is_admin: bool = False):
     global translations
     keyboard = []
     for i in translations:
@@ -167,71 +203,47 @@ def locale_keyboard(trans: L18n):
     return pretty_menu(keyboard)
 
 
+def get_keyboard(kind: str, trans: L18n, chat_id: int = None) -> InlineKeyboardMarkup:
+    global keyboards
+    global config
+    return keyboards.get(kind, trans, chat_id in config.admin_list)
+
+
 def status(update: Update, context: CallbackContext):
     global telegram_logger
     trans = get_locale(update)
     cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_GET_CHARACTER_STATUS, "locale": trans.code}
     msg = trans.get_message(M_REQUESTED_STATUS)
-    context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+    send_message(chat_id=update.effective_chat.id, text=msg)
     enqueue_command(cmd)
     telegram_logger.info("Proceed status command from user {0}".format(update.effective_chat.id))
 
 
-def reset_process(user_id: int,
-                  creation: bool = False,
-                  deletion: bool = False,
-                  feedback_send: bool = False,
-                  feedback_read: bool = False,
-                  feedback_reply: bool = False):
-    global creation_process
-    global deletion_process
-    global feedback_process
-    global feedback_reading
-    global feedback_replying
-    if not creation:
-        if user_id in creation_process:
-            del creation_process[user_id]
-    if not deletion:
-        if user_id in deletion_process:
-            del deletion_process[user_id]
-    if not feedback_send:
-        if user_id in feedback_process:
-            del feedback_process[user_id]
-    if not feedback_read:
-        if user_id in feedback_reading:
-            del feedback_reading[user_id]
-    if not feedback_replying:
-        if user_id in feedback_replying:
-            del feedback_replying[user_id]
-
-
+@timed(handler_time, "create")
 def create(update: Update, context: CallbackContext):
-    global creation_process
+    global sessions
     global telegram_logger
     trans = get_locale(update)
-    keyboard = class_keyboard(trans)
-    if keyboard is not None:
+    reply_markup = get_keyboard(KEYBOARD_CLASS, trans)
+    if reply_markup is not None:
         msg = trans.get_message(M_CHOOSE_CLASS)
-        creation_process[update.effective_chat.id] = {"stage": STAGE_SELECT_CLASS}
-        reset_process(user_id=update.effective_chat.id, creation=True)
+        sessions.begin(update.effective_chat.id, Stage.SELECT_CLASS)
         telegram_logger.info("Initialized character creation from user {0}".format(update.effective_chat.id))
     else:
         msg = trans.get_message(M_REPEAT_LATER)
-        keyboard = main_keyboard(update.effective_chat.id, trans)
+        reply_markup = get_keyboard(KEYBOARD_MAIN, trans, update.effective_chat.id)
         telegram_logger.info("Can't initialize character creation from user {0}, class list is empty".
                              format(update.effective_chat.id))
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+    send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
 
 
 def delete(update: Update, context: CallbackContext):
-    global deletion_process
+    global sessions
     global telegram_logger
-    deletion_process[update.effective_chat.id] = {"stage": STAGE_CONFIRM_DELETION}
-    reset_process(user_id=update.effective_chat.id, deletion=True)
+    sessions.begin(update.effective_chat.id, Stage.CONFIRM_DELETION)
     trans = get_locale(update)
     msg = trans.get_message(M_PRINT_CONFIRM)
-    context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+    send_message(chat_id=update.effective_chat.id, text=msg)
     telegram_logger.info("Initialized character deletion from user {0}".format(update.effective_chat.id))
 
 
@@ -240,24 +252,23 @@ def settings(update: Update, context: CallbackContext):
     global translations
     trans = get_locale(update)
     msg = trans.get_message(M_CHOOSE_LANGUAGE)
-    keyboard = locale_keyboard(trans)
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+    reply_markup = get_keyboard(KEYBOARD_LOCALE, trans)
+    send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
     telegram_logger.info("Sent language settings menu to user {0}".format(update.effective_chat.id))
 
 
 def feedback(update: Update, context: CallbackContext):
     global telegram_logger
     global translations
-    global feedback_process
+    global sessions
     trans = get_locale(update)
     msg = trans.get_message(M_FEEDBACK_PROMPT)
-    feedback_process[update.effective_chat.id] = 1
-    reset_process(user_id=update.effective_chat.id, feedback_send=True)
-    context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+    sessions.begin(update.effective_chat.id, Stage.SEND_FEEDBACK)
+    send_message(chat_id=update.effective_chat.id, text=msg)
     telegram_logger.info("Sent feedback prompt to user {0}".format(update.effective_chat.id))
 
 
+@timed(handler_time, "set_locale")
 def set_locale(update: Update, context: CallbackContext):
     global telegram_logger
     global translations
@@ -265,29 +276,26 @@ def set_locale(update: Update, context: CallbackContext):
     global user_settings
     language = update["callback_query"]["data"][7:]
     if language in translations:
-        user_locales[update.effective_chat.id] = language
+        user_locales.set(update.effective_chat.id, language)
         user_settings.set_locale(update.effective_chat.id, language)
         trans = get_locale(update)
         msg = trans.get_message(M_LANGUAGE_CHOSEN).format(language)
-        keyboard = main_keyboard(update.effective_chat.id, trans)
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+        reply_markup = get_keyboard(KEYBOARD_MAIN, trans, update.effective_chat.id)
+        send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
         telegram_logger.info("Set locale {1} for user {0}".format(update.effective_chat.id, language))
     elif language == M_DYNAMIC_LOCALE:
-        del user_locales[update.effective_chat.id]
+        user_locales.delete(update.effective_chat.id)
         user_settings.delete_locale(update.effective_chat.id)
         trans = get_locale(update)
         msg = trans.get_message(M_LANGUAGE_RESET)
-        keyboard = main_keyboard(update.effective_chat.id, trans)
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+        reply_markup = get_keyboard(KEYBOARD_MAIN, trans, update.effective_chat.id)
+        send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
         telegram_logger.info("Deleted locale settings for user {0}".format(update.effective_chat.id))
     else:
         trans = get_locale(update)
         msg = trans.get_message(M_INCORRECT_LANGUAGE).format(language)
-        keyboard = main_keyboard(update.effective_chat.id, trans)
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+        reply_markup = get_keyboard(KEYBOARD_MAIN, trans, update.effective_chat.id)
+        send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
         telegram_logger.error("Can't set not existent locale {1} for user {0}".format(update.effective_chat.id,
                                                                                       language))
 
@@ -296,9 +304,8 @@ def about(update: Update, context: CallbackContext):
     global telegram_logger
     trans = get_locale(update)
     msg = trans.get_message(M_ABOUT_TEXT)
-    keyboard = main_keyboard(update.effective_chat.id, trans)
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+    reply_markup = get_keyboard(KEYBOARD_MAIN, trans, update.effective_chat.id)
+    send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
     telegram_logger.info("Sent \"About\" to user {0}".format(update.effective_chat.id))
 
 
@@ -308,9 +315,8 @@ def admin(update: Update, context: CallbackContext):
     if update.effective_chat.id in config.admin_list:
         trans = get_locale(update)
         msg = trans.get_message(M_ABOUT_TEXT)
-        keyboard = admin_keyboard(trans)
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+        reply_markup = get_keyboard(KEYBOARD_ADMIN, trans)
+        send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup, priority=PRIORITY_ADMIN)
         telegram_logger.info("Sent \"Admin menu\" to user {0}".format(update.effective_chat.id))
     else:
         telegram_logger.error("Illegal access to \"Admin menu\" from user {0}".format(update.effective_chat.id))
@@ -322,9 +328,8 @@ def shutdown(update: Update, context: CallbackContext):
     if update.effective_chat.id in config.admin_list:
         trans = get_locale(update)
         msg = trans.get_message(M_SHUTDOWN_PANEL)
-        keyboard = shutdown_keyboard(trans)
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+        reply_markup = get_keyboard(KEYBOARD_SHUTDOWN, trans)
+        send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup, priority=PRIORITY_ADMIN)
         telegram_logger.info("Sent \"shutdown menu\" to user {0}".format(update.effective_chat.id))
     else:
         telegram_logger.error("Illegal access to \"shutdown menu\" from user {0}".format(update.effective_chat.id))
@@ -338,7 +343,7 @@ def get_feedback(update: Update, context: CallbackContext):
         msg = trans.get_message(M_CMD_SENT)
         cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_GET_FEEDBACK, "locale": trans.code}
         enqueue_command(cmd, True)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+        send_message(chat_id=update.effective_chat.id, text=msg, priority=PRIORITY_ADMIN)
         telegram_logger.info("Sent get_feedback from user {0}".format(update.effective_chat.id))
     else:
         telegram_logger.error("Illegal access to \"feedback menu\" from user {0}".format(update.effective_chat.id))
@@ -351,7 +356,7 @@ def ask_server_stats(update, context):
         trans = get_locale(update)
         msg = trans.get_message(M_REQUESTED_SERVER_STATUS)
         cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_GET_SERVER_STATS, "locale": trans.code}
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+        send_message(chat_id=update.effective_chat.id, text=msg, priority=PRIORITY_ADMIN)
         enqueue_command(cmd, True)
         telegram_logger.info("Sent server stats request from user {0}".format(update.effective_chat.id))
     else:
@@ -362,6 +367,9 @@ def show_bot_stats(update: Update, context: CallbackContext):
     global telegram_logger
     global config
     global startup_time
+    global user_locales
+    global user_settings
+    global sessions
     if update.effective_chat.id in config.admin_list:
         trans = get_locale(update)
         process = psutil.Process(os.getpid())
@@ -378,9 +386,42 @@ def show_bot_stats(update: Update, context: CallbackContext):
         msg += chr(10)
         msg += trans.get_message(M_BOT_CPU_PERCENT).format(cpu_percent)
         msg += chr(10)
+        publish_stats = publisher.get_stats()
+        msg += trans.get_message(M_BOT_PUBLISH_STATS).format(publish_stats["published"], publish_stats["avg_ms"],
+                                                             publish_stats["max_ms"], publish_stats["errors"])
+        msg += chr(10)
+        send_stats = sender.get_stats()
+        msg += trans.get_message(M_BOT_SEND_STATS).format(send_stats["sent"], send_stats["failed"],
+                                                          send_stats["retry_after"], send_stats["queued"],
+                                                          send_stats["rate"])
+        msg += chr(10)
+        broadcast_stats = broadcaster.get_stats()
+        msg += trans.get_message(M_BOT_BROADCAST_STATS).format(broadcast_stats["active"], broadcast_stats["finished"],
+                                                               broadcast_stats["pending"],
+                                                               broadcast_stats["delivered"],
+                                                               broadcast_stats["failed"], broadcast_stats["blocked"])
+        msg += chr(10)
+        locale_stats = user_locales.get_stats()
+        msg += trans.get_message(M_BOT_LOCALE_CACHE_STATS).format(locale_stats["size"], locale_stats["hits"],
+                                                                  locale_stats["negative_hits"],
+                                                                  locale_stats["misses"], locale_stats["evicted"])
+        msg += chr(10)
+        db_stats = user_settings.get_stats()
+        msg += trans.get_message(M_BOT_DB_STATS).format(db_stats["connections"], db_stats["in_use"],
+                                                        db_stats["avg_wait_ms"], db_stats["max_wait_ms"],
+                                                        db_stats["errors"], db_stats["broken"])
+        msg += chr(10)
+        session_stats = sessions.get_stats()
+        msg += trans.get_message(M_BOT_SESSION_STATS).format(session_stats["active"], session_stats["by_stage"],
+                                                             session_stats["expired"])
+        msg += chr(10)
+        log_stats = get_log_stats()
+        msg += trans.get_message(M_BOT_LOG_STATS).format(log_stats["queued"], log_stats["dropped_queue_full"],
+                                                         log_stats["dropped_rate_limit"])
+        msg += chr(10)
         trans = get_locale(update)
-        reply_markup = InlineKeyboardMarkup(admin_keyboard(trans))
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+        reply_markup = get_keyboard(KEYBOARD_ADMIN, trans)
+        send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup, priority=PRIORITY_ADMIN)
         telegram_logger.info("Sent server stats request from user {0}".format(update.effective_chat.id))
     else:
         telegram_logger.error("Illegal access to \"show_bot_stats\" from user {0}".format(update.effective_chat.id))
@@ -393,7 +434,7 @@ def send_shutdown_immediate(update: Update, context: CallbackContext):
         trans = get_locale(update)
         msg = trans.get_message(M_SENT_SHUTDOWN_IMMEDIATE)
         cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_SERVER_SHUTDOWN_IMMEDIATE, "locale": trans.code}
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg,)
+        send_message(chat_id=update.effective_chat.id, text=msg, priority=PRIORITY_ADMIN)
         enqueue_command(cmd, True)
         telegram_logger.info("Sent command on immediate shutdown from user {0}".format(update.effective_chat.id))
     else:
@@ -409,7 +450,7 @@ def send_shutdown_bot(update: Update, context: CallbackContext):
         trans = get_locale(update)
         msg = trans.get_message(M_SENT_SHUTDOWN_BOT)
         telegram_logger.info("Shutdown requested")
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg, )
+        send_message(chat_id=update.effective_chat.id, text=msg, priority=PRIORITY_ADMIN)
         is_shutdown = True
     else:
         telegram_logger.error("Illegal access to \"send_shutdown_bot\" from user {0}".format(update.effective_chat.id))
@@ -422,7 +463,7 @@ def send_shutdown_normal(update: Update, context: CallbackContext):
         trans = get_locale(update)
         msg = trans.get_message(M_SENT_SHUTDOWN)
         cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_SERVER_SHUTDOWN_NORMAL, "locale": trans.code}
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg,)
+        send_message(chat_id=update.effective_chat.id, text=msg, priority=PRIORITY_ADMIN)
         enqueue_command(cmd, True)
         telegram_logger.info("Sent command on shutdown from user {0}".format(update.effective_chat.id))
     else:
@@ -430,30 +471,26 @@ def send_shutdown_normal(update: Update, context: CallbackContext):
                               format(update.effective_chat.id))
 
 
+@timed(handler_time, "class_menu")
 def class_menu(update: Update, context: CallbackContext):
-    global creation_process
+    global sessions
     global telegram_logger
     global class_descriptions
-    is_correct = False
-    is_restart = False
-    if update.effective_chat.id in creation_process:
-        if creation_process[update.effective_chat.id]["stage"] == STAGE_SELECT_CLASS:
-            is_correct = True
-        elif creation_process[update.effective_chat.id]["stage"] == STAGE_CHOOSE_NAME:
-            is_restart = True
+    session = sessions.get(update.effective_chat.id)
+    stage = session.stage if session is not None else None
+    is_correct = stage == Stage.SELECT_CLASS
+    is_restart = stage == Stage.CHOOSE_NAME
     if is_correct or is_restart:
         char_class = update["callback_query"]["data"][6:]
-        creation_process[update.effective_chat.id]["class"] = char_class
-        creation_process[update.effective_chat.id]["stage"] = STAGE_CHOOSE_NAME
-        reset_process(user_id=update.effective_chat.id, creation=True)
+        session.char_class = char_class
+        sessions.move(session, Stage.CHOOSE_NAME)
         trans = get_locale(update)
         descr_code = char_class + "_description"
         if trans.is_message_exists(descr_code):
             msg = trans.get_message(descr_code)
-            context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+            send_message(chat_id=update.effective_chat.id, text=msg)
         msg = trans.get_message(M_ENTER_NAME)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg.
-                                 format(trans.get_message(char_class)))
+        send_message(chat_id=update.effective_chat.id, text=msg.format(trans.get_message(char_class)))
         if is_correct:
             telegram_logger.info("Character creation by user {0} advanced to name input stage".
                                  format(update.effective_chat.id))
@@ -467,21 +504,20 @@ def class_menu(update: Update, context: CallbackContext):
 
 
 def read_done(update: Update, context: CallbackContext):
-    global feedback_reading
+    global sessions
     global telegram_logger
-    is_correct = False
-    if update.effective_chat.id in feedback_reading:
-        is_correct = True
+    session = sessions.get(update.effective_chat.id)
+    is_correct = session is not None and session.stage in (Stage.READ_FEEDBACK, Stage.REPLY_FEEDBACK)
     if is_correct:
         trans = get_locale(update)
         msg = trans.get_message(M_FEEDBACK_SENT)
         cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_CONFIRM_FEEDBACK, "locale": trans.code,
-               "message_id": feedback_reading[update.effective_chat.id]}
+               "message_id": session.message_id}
         enqueue_command(cmd, True)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+        send_message(chat_id=update.effective_chat.id, text=msg, priority=PRIORITY_ADMIN)
         telegram_logger.info("Reading message id {0} done by user {1} send".
-                             format(feedback_reading[update.effective_chat.id], update.effective_chat.id))
-        del feedback_reading[update.effective_chat.id]
+                             format(session.message_id, update.effective_chat.id))
+        sessions.end(update.effective_chat.id)
     else:
         telegram_logger.warning("Message expire (on read done), requested new message in chat_id {0}".
                                 format(update.effective_chat.id))
@@ -489,25 +525,24 @@ def read_done(update: Update, context: CallbackContext):
 
 
 def read_reply(update: Update, context: CallbackContext):
-    global feedback_reading
-    global feedback_replying
+    global sessions
     global telegram_logger
-    is_correct = False
-    if update.effective_chat.id in feedback_reading:
-        is_correct = True
+    session = sessions.get(update.effective_chat.id)
+    is_correct = session is not None and session.stage in (Stage.READ_FEEDBACK, Stage.REPLY_FEEDBACK)
     if is_correct:
         trans = get_locale(update)
         msg = trans.get_message(M_PRINT_REPLY)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+        send_message(chat_id=update.effective_chat.id, text=msg, priority=PRIORITY_ADMIN)
         telegram_logger.info("Ask for reply on message id {0} user {1}".
-                             format(feedback_reading[update.effective_chat.id], update.effective_chat.id))
-        feedback_replying[update.effective_chat.id] = 1
+                             format(session.message_id, update.effective_chat.id))
+        sessions.move(session, Stage.REPLY_FEEDBACK)
     else:
         telegram_logger.warning("Message expire (on read reply), requested new message in chat_id {0}".
                                 format(update.effective_chat.id))
         get_feedback(update, context)
 
 
+@timed(handler_time, "main_menu")
 def main_menu(update: Update, context: CallbackContext):
     global telegram_logger
     global config
@@ -537,9 +572,10 @@ def main_menu(update: Update, context: CallbackContext):
     else:
         telegram_logger.error("Received unknown command {0} from user {1} in main menu".
                               format(cur_item, update.effective_chat.id))
-        context.bot.send_message(chat_id=update.effective_chat.id, text="Unknown command")
+        send_message(chat_id=update.effective_chat.id, text="Unknown command")
 
 
+@timed(handler_time, "admin_menu")
 def admin_menu(update: Update, context: CallbackContext):
     global telegram_logger
     cur_item = update["callback_query"]["data"]
@@ -556,9 +592,10 @@ def admin_menu(update: Update, context: CallbackContext):
     else:
         telegram_logger.error("Received unknown command {0} from user {1} in admin menu".
                               format(cur_item, update.effective_chat.id))
-        context.bot.send_message(chat_id=update.effective_chat.id, text="Unknown command")
+        send_message(chat_id=update.effective_chat.id, text="Unknown command", priority=PRIORITY_ADMIN)
 
 
+@timed(handler_time, "shutdown_menu")
 def shutdown_menu(update: Update, context: CallbackContext):
     global telegram_logger
     cur_item = update["callback_query"]["data"]
@@ -573,9 +610,10 @@ def shutdown_menu(update: Update, context: CallbackContext):
     else:
         telegram_logger.error("Received unknown command {0} from user {1} in shutdown menu".
                               format(cur_item, update.effective_chat.id))
-        context.bot.send_message(chat_id=update.effective_chat.id, text="Unknown command")
+        send_message(chat_id=update.effective_chat.id, text="Unknown command", priority=PRIORITY_ADMIN)
 
 
+@timed(handler_time, "read_menu")
 def read_menu(update: Update, context: CallbackContext):
     global telegram_logger
     cur_item = update["callback_query"]["data"]
@@ -588,211 +626,327 @@ def read_menu(update: Update, context: CallbackContext):
     else:
         telegram_logger.error("Received unknown command {0} from user {1} in read menu".
                               format(cur_item, update.effective_chat.id))
-        context.bot.send_message(chat_id=update.effective_chat.id, text="Unknown command")
+        send_message(chat_id=update.effective_chat.id, text="Unknown command", priority=PRIORITY_ADMIN)
+
+
+def prepare_command(obj: Dict) -> Tuple[bytes, pika.BasicProperties]:
+    global config
+    global codec
+    global sharding
+    obj["sent_by_admin"] = obj.get("user_id") in config.admin_list
+    if sharding is None or obj.get("user_id") is None:
+        return codec.encode(obj)
+    # server sends response to exchange QUEUE_EXCHANGE_RESPONSES with this routing key
+    obj["reply_to"] = sharding.get_reply_to(obj["user_id"])
+    msg_body, properties = codec.encode(obj)
+    properties.reply_to = obj["reply_to"]
+    return msg_body, properties
+
+
+def get_response_queues() -> List[str]:
+    global sharding
+    if sharding is None:
+        return [QUEUE_NAME_RESPONSES]
+    # shared queue is still read for responses to commands without reply_to
+    return [QUEUE_NAME_RESPONSES] + sharding.get_queues()
+
+
+def get_consumers() -> Dict[str, Callable]:
+    consumers = {i: cmd_response_callback for i in get_response_queues()}
+    consumers[QUEUE_NAME_DICT] = dict_response_callback
+    return consumers
+
+
+def open_response_channel():
+    global config
+    global sharding
+    out_queue = get_mq_connect(config)
+    out_channel = out_queue.channel()
+    out_channel.basic_qos(prefetch_count=QUEUE_PREFETCH)
+    if sharding is not None:
+        sharding.declare(out_channel)
+    return out_queue, out_channel
+
+
+def on_config_change(changed: Set[str]):
+    # called by config watcher, only clients with changed settings reconnect
+    global config
+    global sharding
+    global publisher
+    global user_settings
+    global async_bot
+    global is_queue_changed
+    if "log_level" in changed:
+        set_log_level(config.log_level)
+    if changed & {"log_rate", "log_burst"}:
+        set_log_rate(config.log_rate, config.log_burst)
+    reconnect_consumers = bool(changed & CONFIG_QUEUE_SETTINGS)
+    if sharding is not None and changed & {"shard_instances", "shard_retired"}:
+        sharding.update(config.shard_instances, config.shard_retired)
+        # queues to drain could change
+        reconnect_consumers = True
+    if changed & CONFIG_QUEUE_SETTINGS:
+        publisher.reconnect()
+    if reconnect_consumers:
+        if async_bot is not None:
+            async_bot.reconnect(get_consumers())
+        else:
+            is_queue_changed = True
+    if changed & CONFIG_DB_SETTINGS:
+        user_settings.reconnect()
 
 
 def enqueue_command(obj: Dict, system: bool = False):
     global queue_logger
-    global config
+    global publisher
     if system:
         queue_name = QUEUE_NAME_INIT
     else:
         queue_name = QUEUE_NAME_CMD
-    obj["sent_by_admin"] = obj.get("user_id") in config.admin_list
-    msg_body = json.dumps(obj)
+    msg_body, properties = prepare_command(obj)
+    start_time = time.perf_counter()
     try:
-        queue = get_mq_connect(config)
-        channel = queue.channel()
-        channel.basic_publish(exchange="", routing_key=queue_name,
-                              body=msg_body, properties=pika.BasicProperties(delivery_mode=2,
-                                                                             content_type="application/json",
-                                                                             content_encoding="UTF-8",
-                                                                             app_id=QUEUE_APP_ID))
-        queue.close()
-        queue_logger.info("Sent command {0} in queue {1}".format(msg_body, queue))
+        publisher.publish(queue_name, msg_body, properties)
+        publish_time.observe(time.perf_counter() - start_time, queue_name)
+        # formatted by log writer thread, if record passes rate limit
+        queue_logger.info("Sent command %s in queue %s", obj, queue_name)
     except pika.exceptions.AMQPError as exc:
-        queue_logger.critical("Error {2} when Sent command {0} in queue {1}".format(msg_body, queue_name, exc))
+        publish_errors.inc(queue_name)
+        queue_logger.critical("Error {2} when Sent command {0} in queue {1}".format(obj, queue_name, exc))
 
 
+@timed(handler_time, "echo")
 def echo(update: Update, context: CallbackContext):
-    global creation_process
-    global deletion_process
-    global feedback_process
-    global feedback_reading
-    global feedback_replying
+    global sessions
     global telegram_logger
     telegram_logger.debug("Echo: update: {0}, context {1}".format(update, context))
     trans = get_locale(update, update.effective_chat.id)
+    session = sessions.get(update.effective_chat.id)
+    stage = session.stage if session is not None else None
     is_correct = False
-    if update.effective_chat.id in creation_process:
-        if creation_process[update.effective_chat.id]["stage"] == STAGE_CHOOSE_NAME:
-            if CHARACTER_NAME_MAX_LENGTH < len(update["message"]["text"]):
-                msg = trans.get_message(M_NAME_TOO_LONG).format(CHARACTER_NAME_MAX_LENGTH)
-                context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
-            else:
-                is_correct = True
+    if stage == Stage.CHOOSE_NAME:
+        if CHARACTER_NAME_MAX_LENGTH < len(update["message"]["text"]):
+            msg = trans.get_message(M_NAME_TOO_LONG).format(CHARACTER_NAME_MAX_LENGTH)
+            send_message(chat_id=update.effective_chat.id, text=msg)
+        else:
+            is_correct = True
     if is_correct:
-        creation_process[update.effective_chat.id]["stage"] = "confirm"
-        creation_process[update.effective_chat.id]["name"] = update["message"]["text"]
+        session.name = update["message"]["text"]
+        sessions.move(session, Stage.CONFIRM_NAME)
         msg = trans.get_message(M_CHECK_NAME)
-        context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+        send_message(chat_id=update.effective_chat.id, text=msg)
         cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_CREATE_CHARACTER,
-               "name": creation_process[update.effective_chat.id].get("name"),
-               "class": creation_process[update.effective_chat.id].get("class"),
+               "name": session.name,
+               "class": session.char_class,
                "locale": trans.code}
         enqueue_command(cmd)
-    elif update.effective_chat.id in deletion_process:
-        if deletion_process[update.effective_chat.id]["stage"] == STAGE_CONFIRM_DELETION:
-            if update["message"]["text"] == "CONFIRM":
-                cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_DELETE_CHARACTER, "locale": trans.code}
-                msg = trans.get_message(M_SENT_CHAR_DELETE)
-                context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
-                enqueue_command(cmd)
-            else:
-                del deletion_process[update.effective_chat.id]
-                msg = trans.get_message(M_CANCEL_REQUEST)
-                context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
-                start(update, context)
-    elif update.effective_chat.id in feedback_process:
+    elif stage == Stage.CONFIRM_DELETION:
+        if update["message"]["text"] == "CONFIRM":
+            cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_DELETE_CHARACTER, "locale": trans.code}
+            msg = trans.get_message(M_SENT_CHAR_DELETE)
+            send_message(chat_id=update.effective_chat.id, text=msg)
+            enqueue_command(cmd)
+        else:
+            sessions.end(update.effective_chat.id)
+            msg = trans.get_message(M_CANCEL_REQUEST)
+            send_message(chat_id=update.effective_chat.id, text=msg)
+            start(update, context)
+    elif stage == Stage.SEND_FEEDBACK:
         if len(update["message"]["text"]) <= MAX_FEEDBACK_LENGTH:
-            del feedback_process[update.effective_chat.id]
+            sessions.end(update.effective_chat.id)
             cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_FEEDBACK, "locale": trans.code,
                    "message": update["message"]["text"], "user_name": update.effective_chat.username}
             msg = trans.get_message(M_FEEDBACK_SENT)
-            context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
+            send_message(chat_id=update.effective_chat.id, text=msg)
             enqueue_command(cmd)
         else:
             msg = trans.get_message(M_FEEDBACK_TOO_LONG).format(MAX_FEEDBACK_LENGTH)
-            reply_markup = InlineKeyboardMarkup(main_keyboard(None, trans))
-            context.bot.send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
-    elif update.effective_chat.id in feedback_replying:
-        if update.effective_chat.id in feedback_reading:
-            cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_REPLY_FEEDBACK, "locale": trans.code,
-                   "message": update["message"]["text"], "message_id": feedback_reading.get(update.effective_chat.id)}
-            msg = trans.get_message(M_FEEDBACK_SUCCESS)
-            context.bot.send_message(chat_id=update.effective_chat.id, text=msg)
-            enqueue_command(cmd)
-        else:
-            get_feedback(update, context)
-
+            reply_markup = get_keyboard(KEYBOARD_MAIN, trans)
+            send_message(chat_id=update.effective_chat.id, text=msg, reply_markup=reply_markup)
+    elif stage == Stage.REPLY_FEEDBACK:
+        cmd = {"user_id": update.effective_chat.id, "cmd_type": CMD_REPLY_FEEDBACK, "locale": trans.code,
+               "message": update["message"]["text"], "message_id": session.message_id}
+        msg = trans.get_message(M_FEEDBACK_SUCCESS)
+        send_message(chat_id=update.effective_chat.id, text=msg)
+        enqueue_command(cmd)
     else:
         telegram_logger.info("User {0} sent message {1}".format(update.effective_chat.id, update.message.text))
 
 
-def class_list_callback(ch, method: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+def class_list_callback(msg: Dict):
     global class_list
     global translations
-    buf = json.loads(body).get("class_list")
-    class_list = []
+    global keyboards
+    buf = msg.get("class_list")
+    new_class_list = []
     for i in buf:
-        class_list.append(i)
+        new_class_list.append(i)
         for j in buf[i]:
             if j in translations:
                 translations[j].add_message(i, buf[i][j])
+    class_list = new_class_list
+    # class names changed, class keyboards will be rebuilt on next use
+    keyboards.invalidate(KEYBOARD_CLASS)
 
 
-def class_description_callback(ch, method: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+def class_description_callback(msg: Dict):
     global class_descriptions
     global translations
-    class_name = json.loads(body).get("class_name")
-    class_description = json.loads(body).get("class_description")
-    class_stats = json.loads(body).get("class_stats")
-    locale = json.loads(body).get("locale")
+    class_name = msg.get("class_name")
+    class_description = msg.get("class_description")
+    class_stats = msg.get("class_stats")
+    locale = msg.get("locale")
     if locale in translations:
         translations[locale].add_message(str(class_name) + "_description", class_description + chr(10) + class_stats)
 
 
-def dict_response_callback(ch, method: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+@timed(callback_time, "dict_response")
+def dict_response_callback(msg: Dict, on_done: Callable = None):
     global queue_logger
-    global feedback_reading
+    global sessions
     global config
-    queue_logger.info("Received server command " + str(body) + ", started callback")
-    msg = json.loads(body)
+    global user_settings
+    global user_locales
+    queue_logger.info("Received server command " + str(msg) + ", started callback")
     cmd_type = msg.get("cmd_type")
     chat_id = msg.get("user_id")
     trans = get_locale(None, chat_id)
     if cmd_type == CMD_SET_CLASS_LIST:
-        class_list_callback(ch, method, properties, body)
+        class_list_callback(msg)
+        if on_done is not None:
+            on_done(None)
     elif cmd_type == CMD_SET_CLASS_DESCRIPTION:
-        class_description_callback(ch, method, properties, body)
+        class_description_callback(msg)
+        if on_done is not None:
+            on_done(None)
     elif cmd_type == CMD_SET_SERVER_STATS:
-        reply_markup = InlineKeyboardMarkup(admin_keyboard(trans))
-        updater.dispatcher.bot.send_message(chat_id=chat_id, text=msg.get("server_info"), reply_markup=reply_markup)
+        reply_markup = get_keyboard(KEYBOARD_ADMIN, trans)
+        send_message(chat_id=chat_id, text=msg.get("server_info"), reply_markup=reply_markup,
+                     priority=PRIORITY_ADMIN, on_done=on_done)
     elif cmd_type == CMD_SERVER_OK:
-        reply_markup = InlineKeyboardMarkup(admin_keyboard(trans))
-        updater.dispatcher.bot.send_message(chat_id=chat_id, text=msg.get("message"), reply_markup=reply_markup)
+        reply_markup = get_keyboard(KEYBOARD_ADMIN, trans)
+        send_message(chat_id=chat_id, text=msg.get("message"), reply_markup=reply_markup, priority=PRIORITY_ADMIN,
+                     on_done=on_done)
     elif cmd_type == CMD_SERVER_STARTUP:
-        for i in config.admin_list:
-            trans = get_locale(None, i)
-            reply_markup = InlineKeyboardMarkup(admin_keyboard(trans))
-            updater.dispatcher.bot.send_message(chat_id=i,
-                                                text=trans.get_message(M_SERVER_STARTED_UP).format(msg.get("datetime")),
-                                                reply_markup=reply_markup)
+        broadcaster.broadcast(M_SERVER_STARTED_UP, config.admin_list, [msg.get("datetime")], KEYBOARD_ADMIN,
+                              PRIORITY_ADMIN, on_created=on_done)
+    elif cmd_type == CMD_BROADCAST:
+        # server announcement for all known users or only admins
+        error = check_broadcast_message(msg.get("message_key"), msg.get("args", []))
+        if error is not None:
+            # message can't be rendered for anybody, so it's rejected once instead of failing for each recipient
+            queue_logger.error("Rejected broadcast {0}: {1}".format(msg, error))
+            if on_done is not None:
+                on_done(None)
+        else:
+            if msg.get("admins_only"):
+                recipients = list(config.admin_list)
+            else:
+                # all users are read from DB by broadcaster thread, queue consumer doesn't wait for it
+                recipients = functools.partial(get_broadcast_recipients, list(config.admin_list))
+            broadcaster.broadcast(msg.get("message_key"), recipients, msg.get("args", []), on_created=on_done)
     elif cmd_type == CMD_SENT_FEEDBACK:
-        reply_markup = InlineKeyboardMarkup(read_keyboard(trans))
-        feedback_reading[chat_id] = msg.get("message_id")
-        reset_process(user_id=chat_id, feedback_read=True)
-        updater.dispatcher.bot.send_message(chat_id=chat_id,
-                                            text=trans.get_message(M_FEEDBACK_STRING).
-                                            format(msg.get("user_sent_id"), msg.get("user_sent_nick"),
-                                                   msg.get("message"), msg.get("message_id")),
-                                            reply_markup=reply_markup)
+        reply_markup = get_keyboard(KEYBOARD_READ, trans)
+        sessions.begin(chat_id, Stage.READ_FEEDBACK, msg.get("message_id"))
+        send_message(chat_id=chat_id,
+                     text=trans.get_message(M_FEEDBACK_STRING).
+                     format(msg.get("user_sent_id"), msg.get("user_sent_nick"), msg.get("message"),
+                            msg.get("message_id")),
+                     reply_markup=reply_markup, priority=PRIORITY_ADMIN, on_done=on_done)
     else:
         if chat_id is not None:
-            updater.dispatcher.bot.send_message(chat_id=chat_id, text="Unknown message {0}".format(msg))
-        queue_logger.error("Received unknown server command " + str(body) + ", started callback")
+            send_message(chat_id=chat_id, text="Unknown message {0}".format(msg), priority=PRIORITY_ADMIN,
+                         on_done=on_done)
+        elif on_done is not None:
+            on_done(None)
+        queue_logger.error("Received unknown server command " + str(msg) + ", started callback")
+
+
+def check_broadcast_message(message_key: str, args: List) -> Optional[str]:
+    # returns error, if message is not rendered in some locale
+    global translations
+    for trans in translations.values():
+        try:
+            trans.get_message(message_key).format(*[str(i) for i in args])
+        except (KeyError, IndexError, ValueError) as exc:
+            return str(exc)
+    return None
+
+
+def get_broadcast_recipients(admins: List[int]) -> List[int]:
+    global user_settings
+    global user_locales
+    return admins + list(user_settings.get_locale_users()) + user_locales.get_cached()
+
+
+def on_dict_message(ch, method: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
+    global codec
+    dict_response_callback(codec.decode(body, properties))
+
 
+def get_ack_callback(connection, channel, method_frame: pika.spec.Basic.Deliver, properties: pika.BasicProperties,
+                     body: bytes) -> Callable:
+    # server message is acknowledged only when reply is sent to telegram or message is moved to failed queue,
+    # so messages are not lost, if bot stops before sending them
+    global publisher
+    global queue_logger
+
+    def on_done(exc: Exception = None):
+        ack = functools.partial(channel.basic_ack, method_frame.delivery_tag)
+        if exc is not None:
+            try:
+                publisher.publish(QUEUE_NAME_FAILED, body, get_failed_properties(properties, exc))
+                queue_logger.error("Message {0} with delivery_tag {1} was not delivered because of {2}, moved to {3}".
+                                   format(body, method_frame.delivery_tag, exc, QUEUE_NAME_FAILED))
+            except pika.exceptions.AMQPError as publish_exc:
+                queue_logger.critical("Error {0} when move message {1} to {2}, rejected".
+                                      format(publish_exc, body, QUEUE_NAME_FAILED))
+                ack = functools.partial(channel.basic_nack, method_frame.delivery_tag, requeue=False)
+        try:
+            # channel belongs to consuming thread
+            connection.add_callback_threadsafe(ack)
+        except pika.exceptions.AMQPError as ack_exc:
+            queue_logger.error("Error {0} when acknowledge message with delivery_tag {1}, it will be redelivered".
+                               format(ack_exc, method_frame.delivery_tag))
+            return
+        queue_logger.info("Message %s with delivery_tag %s from %s acknowledged", body, method_frame.delivery_tag,
+                          method_frame.routing_key)
 
-def cmd_response_callback(ch, method: pika.spec.Basic.Deliver, properties: pika.BasicProperties, body: bytes):
-    global creation_process
-    global deletion_process
+    return on_done
+
+
+@timed(callback_time, "cmd_response")
+def cmd_response_callback(msg: Dict, on_done: Callable = None):
+    global sessions
     global updater
     global queue_logger
     global telegram_logger
-    queue_logger.info("Received command " + str(body) + ", started callback")
-    msg = json.loads(body)
+    queue_logger.info("Received command " + str(msg) + ", started callback")
     chat_id = msg.get("user_id")
     trans = get_locale(None, chat_id)
-    reply_markup = InlineKeyboardMarkup(main_keyboard(chat_id, trans))
-    try:
-        if chat_id is not None:
-            if msg.get("cmd_type") == CMD_GET_CHARACTER_STATUS:
-                updater.dispatcher.bot.send_message(chat_id=chat_id, text=msg.get("char_info"), reply_markup=reply_markup)
-            elif msg.get("cmd_type") == CMD_FEEDBACK_RECEIVE:
-                updater.dispatcher.bot.send_message(chat_id=chat_id, text=trans.get_message(M_FEEDBACK_SUCCESS),
-                                                    reply_markup=reply_markup)
-            elif msg.get("cmd_type") == CMD_REPLY_FEEDBACK:
-                updater.dispatcher.bot.send_message(chat_id=chat_id,
-                                                    text=trans.get_message(M_ADMIN_ANSWER).format(msg.get("message")),
-                                                    reply_markup=reply_markup)
-            else:
-                updater.dispatcher.bot.send_message(chat_id=chat_id, text=msg.get("message"), reply_markup=reply_markup)
-                queue_logger.info("Sent message {0}, received from server to user {1}".format(msg.get("message"), chat_id))
-            # clear current operations state, if any
-            reset_process(user_id=chat_id)
-    except tlg_error.BadRequest as exc:
-        telegram_logger.error(exc)
-        telegram_logger.error("for chat id: {0}", format(chat_id))
-        reset_process(user_id=chat_id)
-
-
-def get_mq_connect(mq_config: Config):
-    if mq_config.queue_password is None:
-        return pika.BlockingConnection(pika.ConnectionParameters(host=mq_config.queue_host, port=mq_config.queue_port))
-    else:
-        return pika.BlockingConnection(pika.ConnectionParameters(host=mq_config.queue_host, port=mq_config.queue_port,
-                                                                 credentials=pika.credentials.PlainCredentials(
-                                                                     mq_config.queue_user, mq_config.queue_password)))
+    reply_markup = get_keyboard(KEYBOARD_MAIN, trans, chat_id)
+    if chat_id is not None:
+        if msg.get("cmd_type") == CMD_GET_CHARACTER_STATUS:
+            send_message(chat_id=chat_id, text=msg.get("char_info"), reply_markup=reply_markup, on_done=on_done)
+        elif msg.get("cmd_type") == CMD_FEEDBACK_RECEIVE:
+            send_message(chat_id=chat_id, text=trans.get_message(M_FEEDBACK_SUCCESS), reply_markup=reply_markup,
+                         on_done=on_done)
+        elif msg.get("cmd_type") == CMD_REPLY_FEEDBACK:
+            send_message(chat_id=chat_id, text=trans.get_message(M_ADMIN_ANSWER).format(msg.get("message")),
+                         reply_markup=reply_markup, on_done=on_done)
+        else:
+            send_message(chat_id=chat_id, text=msg.get("message"), reply_markup=reply_markup, on_done=on_done)
+            queue_logger.info("Sent message {0}, received from server to user {1}".format(msg.get("message"), chat_id))
+        # clear current operations state, if any
+        sessions.end(chat_id)
+    elif on_done is not None:
+        on_done(None)
 
 
 def main():
     global class_list
     global class_descriptions
-    global creation_process
-    global deletion_process
-    global feedback_process
-    global feedback_reading
-    global feedback_replying
+    global sessions
     global characters
     global out_channel
     global updater
@@ -800,21 +954,25 @@ def main():
     global telegram_logger
     global config
     global is_shutdown
+    global is_queue_changed
+    global async_bot
     global user_locales
     global translations
     global startup_time
     global user_settings
+    global publisher
+    global codec
+    global sender
+    global broadcaster
+    global keyboards
+    global sharding
 
     is_shutdown = False
+    is_queue_changed = False
+    async_bot = None
     class_list = []
     class_descriptions = {}
-    creation_process = {}
-    deletion_process = {}
-    feedback_process = {}
-    feedback_reading = {}
-    feedback_replying = {}
     characters = {}
-    user_locales = {}
     translations = {}
     startup_time = datetime.datetime.now().replace(microsecond=0)
 
@@ -822,40 +980,86 @@ def main():
     parser.add_argument("--config", '-cfg', help="Path to config file", action="store", default="cfg//main.json")
     parser.add_argument("--test_users", help="Number of test users of each class created", action="store", default=None)
     parser.add_argument("--delay", help="Number of test users of each class created", action="store", default=None)
+    parser.add_argument("--asyncio", help="Run telegram and queue consumers on one event loop", action="store_true")
     args = parser.parse_args()
     if args.delay is not None:
         time.sleep(int(args.delay))
+    startup_timer = PhaseTimer()
     config = Config(args.config)
+    set_log_rate(config.log_rate, config.log_burst)
+    startup_timer.mark("config")
 
     logger = get_logger(LOG_MAIN, config.log_level)
     queue_logger = get_logger(LOG_QUEUE, config.log_level)
     telegram_logger = get_logger(LOG_TELEGRAM, config.log_level)
     # set_basic_logging(config.log_level)
 
-    user_settings = Persist(config)
+    publisher = Publisher(config, config.queue_pool_size)
+    codec = Codec(config.queue_content_type, config.queue_compress_threshold)
+    startup_timer.mark("publisher")
+
+    user_settings = get_persist(config)
     user_settings.check_version()
-    user_locales = user_settings.get_all_locale()
+    user_locales = LocaleCache(user_settings.get_locale, config.locale_cache_size, config.locale_cache_ttl,
+                               config.locale_cache_negative_ttl)
+    user_settings.start()
+    if config.session_backend == SESSION_BACKEND_DB:
+        session_backend = PersistSessionBackend(user_settings)
+    else:
+        session_backend = MemorySessionBackend()
+    if config.shard_instance is not None:
+        sharding = Sharding(config.shard_instance, config.shard_instances, config.shard_retired, config.log_level)
+        if config.session_backend != SESSION_BACKEND_DB:
+            logger.warning("Sharding is used with sessions in memory, dialogs break, when chat changes instance")
+    else:
+        sharding = None
+    sessions = SessionStore(config.session_ttl, SESSION_WHEEL_TICK, config.log_level, session_backend,
+                            config.session_cache_time)
+    sessions.start()
+    startup_timer.mark("db")
 
     for dirpath, dirnames, filenames in os.walk("l18n"):
         for lang_file in filenames:
             logger.info("Start process localization file {0}".format(lang_file))
             translations[lang_file[:2]] = L18n()
             translations[lang_file[:2]].set_locale(lang_file[:-4])
+            for problem in translations[lang_file[:2]].problems:
+                logger.warning("Localization problem: {0}".format(problem))
             logger.info("Finish process localization file {0}".format(filenames))
-
-    updater = Updater(token=config.secret, use_context=True)
+    keyboards = KeyboardCache({KEYBOARD_MAIN: main_keyboard, KEYBOARD_ADMIN: admin_keyboard,
+                               KEYBOARD_READ: read_keyboard, KEYBOARD_SHUTDOWN: shutdown_keyboard,
+                               KEYBOARD_LOCALE: locale_keyboard, KEYBOARD_CLASS: class_keyboard})
+    keyboards.warm(translations.values())
+    if config.l18n_reload_time:
+        l18n_watcher = CatalogWatcher(translations, config.l18n_reload_time, config.log_level,
+                                      lambda names: keyboards.invalidate())
+        l18n_watcher.start()
+    startup_timer.mark("localization")
+
+    if config.telegram_api == FAKE_TELEGRAM_API:
+        updater = Updater(bot=FakeBot(config.fake_telegram_latency), workers=max(config.dispatcher_workers, 1),
+                          use_context=True)
+    else:
+        updater = Updater(token=config.secret, workers=max(config.dispatcher_workers, 1), use_context=True)
     dispatcher = updater.dispatcher
-
-    start_handler = CommandHandler('start', start)
-    create_handler = CommandHandler('create', create)
+    sender = SendScheduler(updater.bot, config.log_level, config.telegram_global_rate, config.telegram_chat_rate,
+                           config.telegram_chat_burst, config.telegram_send_workers, config.telegram_send_queue)
+    sender.start()
+    broadcaster = Broadcaster(user_settings, sender, render_broadcast, config.log_level)
+    broadcaster.start()
+
+    # with dispatcher workers updates of different users are handled concurrently
+    run_async = config.dispatcher_workers > 0
+    start_handler = CommandHandler('start', start, run_async=run_async)
+    create_handler = CommandHandler('create', create, run_async=run_async)
     # TODO: make patterns with regexp
-    class_menu_handler = CallbackQueryHandler(class_menu, pattern="class_")
-    main_menu_handler = CallbackQueryHandler(main_menu, pattern="main_")
-    admin_menu_handler = CallbackQueryHandler(admin_menu, pattern="admin_")
-    shutdown_menu_handler = CallbackQueryHandler(shutdown_menu, pattern="shutdown_")
-    locale_menu_handler = CallbackQueryHandler(set_locale, pattern=LOCALE_PREFIX)
-    read_menu_handler = CallbackQueryHandler(read_menu, pattern="confirm_")
-    echo_handler = MessageHandler(Filters.text & (~Filters.command), echo)
+    class_menu_handler = CallbackQueryHandler(class_menu, pattern="class_", run_async=run_async)
+    main_menu_handler = CallbackQueryHandler(main_menu, pattern="main_", run_async=run_async)
+    admin_menu_handler = CallbackQueryHandler(admin_menu, pattern="admin_", run_async=run_async)
+    shutdown_menu_handler = CallbackQueryHandler(shutdown_menu, pattern="shutdown_", run_async=run_async)
+    locale_menu_handler = CallbackQueryHandler(set_locale, pattern=LOCALE_PREFIX, run_async=run_async)
+    read_menu_handler = CallbackQueryHandler(read_menu, pattern="confirm_", run_async=run_async)
+    echo_handler = MessageHandler(Filters.text & (~Filters.command), echo, run_async=run_async)
     dispatcher.add_handler(start_handler)
     dispatcher.add_handler(create_handler)
     dispatcher.add_handler(main_menu_handler)
@@ -865,6 +1069,7 @@ def main():
     dispatcher.add_handler(shutdown_menu_handler)
     dispatcher.add_handler(locale_menu_handler)
     dispatcher.add_handler(read_menu_handler)
+    startup_timer.mark("telegram")
 
     out_queue = get_mq_connect(config)
     out_channel = out_queue.channel()
@@ -872,17 +1077,20 @@ def main():
     out_channel.queue_declare(queue=QUEUE_NAME_CMD, durable=True)
     out_channel.queue_declare(queue=QUEUE_NAME_RESPONSES, durable=True)
     out_channel.queue_declare(queue=QUEUE_NAME_DICT, durable=True)
+    out_channel.queue_declare(queue=QUEUE_NAME_FAILED, durable=True)
+    if sharding is not None:
+        sharding.declare(out_channel)
+    # limits messages, which wait for delivery to telegram, until they acknowledged
+    out_channel.basic_qos(prefetch_count=QUEUE_PREFETCH)
 
-    msg = {"cmd_type": CMD_GET_CLASS_LIST}
-    out_channel.basic_publish(exchange="", routing_key=QUEUE_NAME_INIT, body=json.dumps(msg),
-                              properties=pika.BasicProperties(content_type="application/json",
-                                                              content_encoding="UTF-8",
-                                                              app_id=QUEUE_APP_ID))
+    msg_body, properties = codec.encode({"cmd_type": CMD_GET_CLASS_LIST}, persistent=False)
+    out_channel.basic_publish(exchange="", routing_key=QUEUE_NAME_INIT, body=msg_body, properties=properties)
 
     logger.info("Asked server for class list")
+    startup_timer.mark("queue")
 
     if args.test_users is not None:
-        out_channel.basic_consume(queue=QUEUE_NAME_DICT, on_message_callback=dict_response_callback, auto_ack=True)
+        out_channel.basic_consume(queue=QUEUE_NAME_DICT, on_message_callback=on_dict_message, auto_ack=True)
 
         for method_frame, properties, body in out_channel.consume(QUEUE_NAME_DICT, inactivity_timeout=1):
             if class_list:
@@ -890,65 +1098,103 @@ def main():
         out_channel.cancel()
         logger.info("Class list received")
         test_start_time = datetime.datetime.now()
-        cnt_users = 0
         logger.info("Started create test users")
-        for i in range(int(args.test_users)):
-            for j in class_list:
-                cmd = {"cmd_type": CMD_CREATE_CHARACTER, "name": j + '_' + str(i + 1), "class": j, "locale": "en"}
-                cnt_users += 1
-                enqueue_command(cmd)
+        test_users = (prepare_command({"cmd_type": CMD_CREATE_CHARACTER, "name": j + '_' + str(i + 1), "class": j,
+                                       "locale": "en"})
+                      for i in range(int(args.test_users)) for j in class_list)
+        stats = BatchPublisher(config, QUEUE_CONFIRM_WINDOW).publish_all(QUEUE_NAME_CMD, test_users)
         test_finish_time = datetime.datetime.now()
-        logger.info("Finish create test users, was created {}. Started at {}, finish at {}".format(cnt_users,
+        logger.info("Finish create test users, was created {}. Started at {}, finish at {}".format(stats["acked"],
                                                                                                    test_start_time,
                                                                                                    test_finish_time))
-
-    updater.start_polling()
-
+        logger.info("Test users publish rate {0} msg/s, confirm latency avg {1} ms, p95 {2} ms, max {3} ms, "
+                    "rejected {4}".format(stats["rate"], stats["avg_ms"], stats["p95_ms"], stats["max_ms"],
+                                          stats["nacked"]))
+
+    if config.webhook_listen is not None:
+        updater.start_webhook(listen=config.webhook_listen, port=config.webhook_port, url_path=config.webhook_path,
+                              webhook_url=config.webhook_url)
+        logger.info("Listen telegram updates on {0}:{1}/{2}".format(config.webhook_listen, config.webhook_port,
+                                                                    config.webhook_path))
+    elif not args.asyncio:
+        updater.start_polling()
+
+    startup_timer.mark("test users and updates")
+    if config.metrics_port is not None:
+        registry.gauge("idle_rpg_bot_sessions", "Active dialogs by stage", ("stage",),
+                       lambda: {(k,): v for k, v in sessions.get_stats()["by_stage"].items()})
+        registry.gauge("idle_rpg_bot_send_queue", "Messages waiting for sending to telegram by priority",
+                       ("priority",), lambda: {(k,): v for k, v in sender.get_stats()["queued"].items()})
+        registry.gauge("idle_rpg_bot_db_connections_in_use", "DB connections in use", (),
+                       lambda: {(): user_settings.get_stats()["in_use"]})
+        metrics_server = MetricsServer(config.metrics_listen, config.metrics_port, config.log_level)
+        metrics_server.start()
+    logger.info("Startup took {0}".format(startup_timer.get_report()))
+    if config.reload_time:
+        config_watcher = ConfigWatcher(config, on_config_change)
+        config_watcher.start()
     logger.info("Start listen server responses")
 
-    for i in config.admin_list:
-        trans = get_locale(None, i)
-        reply_markup = InlineKeyboardMarkup(admin_keyboard(trans))
-        updater.dispatcher.bot.send_message(chat_id=i,
-                                            text=trans.get_message(M_BOT_STARTED_UP).format(datetime.datetime.now()),
-                                            reply_markup=reply_markup)
+    broadcaster.broadcast(M_BOT_STARTED_UP, config.admin_list, [datetime.datetime.now()], KEYBOARD_ADMIN,
+                          PRIORITY_ADMIN)
+    if args.asyncio:
+        out_queue.close()
+        async_bot = AsyncBot(config, dispatcher, codec, get_consumers(), lambda: is_shutdown,
+                             poll_updates=config.webhook_listen is None,
+                             bindings=sharding.get_bindings if sharding is not None else None)
+        async_bot.run()
+        if config.webhook_listen is not None:
+            updater.stop()
+        broadcaster.stop(SEND_STOP_TIMEOUT)
+        user_settings.stop()
+        sender.stop(SEND_STOP_TIMEOUT)
+        publisher.close()
+        sys.exit(0)
     while True:
         try:
-            for method_frame, properties, body in out_channel.consume(QUEUE_NAME_RESPONSES, inactivity_timeout=5,
-                                                                      auto_ack=False):
-                if body is not None:
-                    logger.info("Received user message {0} with delivery_tag {1}".format(body,
-                                                                                         method_frame.delivery_tag))
-                    cmd_response_callback(None, method_frame, properties, body)
-                    out_channel.basic_ack(method_frame.delivery_tag)
-                    logger.info("User message " + str(body) + " with delivery_tag " +
-                                str(method_frame.delivery_tag) + " acknowledged")
-                else:
-                    logger.info("No more messages in {0}".format(QUEUE_NAME_RESPONSES))
-                    out_channel.cancel()
-                    break
+            for queue_name in get_response_queues():
+                for method_frame, properties, body in out_channel.consume(queue_name, inactivity_timeout=5,
+                                                                          auto_ack=False):
+                    if body is not None:
+                        logger.info("Received user message %s with delivery_tag %s", body,
+                                    method_frame.delivery_tag)
+                        cmd_response_callback(codec.decode(body, properties),
+                                              get_ack_callback(out_queue, out_channel, method_frame, properties,
+                                                               body))
+                    else:
+                        logger.info("No more messages in {0}".format(queue_name))
+                        out_channel.cancel()
+                        break
             for method_frame, properties, body in out_channel.consume(QUEUE_NAME_DICT, inactivity_timeout=5,
                                                                       auto_ack=False):
                 if body is not None:
-                    logger.info("Received server message {0} with delivery_tag {1}".format(body,
-                                                                                           method_frame.delivery_tag))
-                    dict_response_callback(None, method_frame, properties, body)
-                    out_channel.basic_ack(method_frame.delivery_tag)
-                    logger.info("Received server message " + str(body) + " with delivery_tag " +
-                                str(method_frame.delivery_tag) + " acknowledged")
+                    logger.info("Received server message %s with delivery_tag %s", body, method_frame.delivery_tag)
+                    dict_response_callback(codec.decode(body, properties),
+                                           get_ack_callback(out_queue, out_channel, method_frame, properties, body))
                 else:
                     logger.info("No more messages in {0}".format(QUEUE_NAME_DICT))
                     out_channel.cancel()
                     break
+            if is_queue_changed:
+                # messages not acknowledged yet are redelivered to new connection
+                is_queue_changed = False
+                logger.info("Reconnect to queue with new settings")
+                out_queue.close()
+                out_queue, out_channel = open_response_channel()
         except pika.exceptions.AMQPError as exc:
             logger.critical("Error {0} when consume in queue, reconnect.".format(exc))
-            out_queue = get_mq_connect(config)
-            out_channel = out_queue.channel()
+            out_queue, out_channel = open_response_channel()
         # should be in QUEUE_NAME_DICT listener, but to make things easier put it here
         if is_shutdown:
             updater.stop()
+            broadcaster.stop(SEND_STOP_TIMEOUT)
+            user_settings.stop()
+            sender.stop(SEND_STOP_TIMEOUT)
+            publisher.close()
             sys.exit(0)
 
 
 if __name__ == '__main__':
+    # SIGTERM exits normally, so atexit handlers write changes in queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     main()
@@ -0,0 +1,25 @@
+create table idle_rpg_bot.broadcasts
+(
+  id          serial primary key,
+  message_key text,
+  args        text,
+  keyboard    text,
+  priority    integer,
+  n_total     integer,
+  n_delivered integer default 0,
+  n_failed    integer default 0,
+  n_blocked   integer default 0,
+  dt_start    timestamp with time zone default current_timestamp,
+  dt_finish   timestamp with time zone
+);
+alter table  idle_rpg_bot.broadcasts owner to idle_rpg_bot;
+create table idle_rpg_bot.broadcast_recipients
+(
+  broadcast_id integer,
+  telegram_id  bigint,
+  status       smallint default 0
+);
+alter table  idle_rpg_bot.broadcast_recipients owner to idle_rpg_bot;
+create unique index ind_broadcast_recipients_u on idle_rpg_bot.broadcast_recipients(broadcast_id, telegram_id);
+update idle_rpg_bot.persist_version set n_version=3, dt_update = current_timestamp where v_name = 'idle RPG bot' ;
+commit;
\ No newline at end of file
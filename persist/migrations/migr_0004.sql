@@ -0,0 +1,13 @@
+create table idle_rpg_bot.sessions
+(
+  chat_id    bigint primary key,
+  stage      text,
+  char_class text,
+  char_name  text,
+  message_id bigint,
+  dt_expire  timestamp with time zone
+);
+alter table  idle_rpg_bot.sessions owner to idle_rpg_bot;
+create index ind_sessions_dt_expire on idle_rpg_bot.sessions(dt_expire);
+update idle_rpg_bot.persist_version set n_version=4, dt_update = current_timestamp where v_name = 'idle RPG bot' ;
+commit;
\ No newline at end of file
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# Checks localization files before deploy: every message used by the bot exists and is translated,
+# templates are valid and have the same placeholders as in the default locale.
+# Usage: python utility/check_l18n.py
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from lib.l18n import L18N_DIR, CatalogRegistry  # noqa: E402
+
+
+def check() -> int:
+    problems = []
+    # always compile from sources
+    registry = CatalogRegistry(cache_directory=None)
+    for file_name in sorted(os.listdir(L18N_DIR)):
+        if file_name.endswith(".lng"):
+            problems += registry.get(file_name[:-4]).problems
+    for i in problems:
+        print(i, file=sys.stderr)
+    print("{0} problems found".format(len(problems)))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(check())